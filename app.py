@@ -6,9 +6,11 @@ from flask import Flask, render_template, session, redirect, url_for, g, request
 from flask_wtf.csrf import CSRFProtect
 from db import init_db, get_db, close_db, ensure_history_table, ensure_categories_table
 import locale
+import os
 import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta
+import click
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'ponpay-secret-key-2025'
@@ -30,6 +32,22 @@ app.config['DATABASE'] = 'ponpay.db'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # 2MB max file size
 
+# Interval (detik) scheduler tagihan berulang saat dijalankan via `python app.py`; 0 = nonaktif
+app.config['BILL_SCHEDULER_INTERVAL'] = 3600
+
+# Snapshot laporan read-only: interval refresh (detik, 0 = nonaktif) dan umur maksimal sebelum laporan kembali membaca database live
+app.config['REPORT_SNAPSHOT_INTERVAL'] = 300
+app.config['REPORT_SNAPSHOT_MAX_AGE'] = 900
+
+# Penulis riwayat batch (thread latar belakang, dimulai saat entri riwayat pertama): jeda flush (detik, 0 = tulis langsung), ukuran batch, batas antrean
+app.config['HISTORY_FLUSH_INTERVAL'] = 1.0
+app.config['HISTORY_BATCH_SIZE'] = 500
+app.config['HISTORY_QUEUE_SIZE'] = 10000
+
+# Retensi riwayat: entri lebih tua dari N bulan dipindah ke arsip gzip per bulan (HISTORY_ARCHIVE_DIR, default archive/ di samping database)
+app.config['HISTORY_RETENTION_MONTHS'] = 12
+app.config['HISTORY_ARCHIVE_DIR'] = None
+
 # Configure logging
 if not app.debug:
     # Production logging
@@ -50,28 +68,85 @@ csrf_handler.setFormatter(logging.Formatter(
 csrf_logger.addHandler(csrf_handler)
 
 # Inisialisasi database
+def init_database():
+    """Buat/migrasi skema pada database aktif (default atau cabang, lihat tenants.use_tenant)"""
+    from tenants import current_tenant, DEFAULT_TENANT
+    # Data contoh (admin/admin123, santri dummy, saldo awal) hanya untuk database default
+    init_db(seed=current_tenant() == DEFAULT_TENANT)
+    # ensure history table exists even if DB already present
+    try:
+        ensure_history_table()
+    except Exception:
+        pass
+    try:
+        from db import ensure_history_indexes
+        ensure_history_indexes()
+    except Exception:
+        pass
+    try:
+        from db import ensure_bills_table, ensure_transactions_bill_id_column, ensure_bills_paid_amount_column
+        ensure_bills_table()
+        ensure_transactions_bill_id_column()
+        ensure_bills_paid_amount_column()
+    except Exception:
+        pass
+    try:
+        from db import ensure_students_name_key_columns, ensure_students_search_index, ensure_classes_table
+        ensure_students_name_key_columns()
+        ensure_students_search_index()
+        ensure_classes_table()
+    except Exception:
+        pass
+    try:
+        from db import ensure_bill_templates_table
+        ensure_bill_templates_table()
+    except Exception:
+        pass
+    try:
+        from db import ensure_data_versions, ensure_transactions_user_date_index
+        ensure_data_versions()
+        ensure_transactions_user_date_index()
+    except Exception:
+        pass
+    try:
+        from db import ensure_transaction_rollup
+        ensure_transaction_rollup()
+    except Exception:
+        pass
+    try:
+        from db import ensure_idempotency_table
+        ensure_idempotency_table()
+    except Exception:
+        pass
+    try:
+        from db import ensure_statement_tables
+        ensure_statement_tables()
+    except Exception:
+        pass
+    # Ensure categories table exists
+    try:
+        ensure_categories_table()
+    except Exception:
+        pass
+
 def init_app():
-    """Inisialisasi aplikasi Flask"""
-    with app.app_context():
-        init_db()
-        # ensure history table exists even if DB already present
-        try:
-            ensure_history_table()
-        except Exception:
-            pass
-        try:
-            from db import ensure_bills_table, ensure_transactions_bill_id_column
-            ensure_bills_table()
-            ensure_transactions_bill_id_column()
-        except Exception:
-            pass
-        # Ensure categories table exists
-        try:
-            ensure_categories_table()
-        except Exception:
-            pass
-        
+    """Inisialisasi aplikasi Flask: registry tenant + skema setiap database cabang"""
+    from tenants import ensure_tenant_registry, for_each_tenant
     app.teardown_appcontext(close_db)
+    with app.app_context():
+        ensure_tenant_registry()
+        for_each_tenant(init_database)
+
+# Pilih database cabang (tenant) untuk setiap request dari session
+@app.before_request
+def select_tenant():
+    from tenants import use_tenant, TenantError, DEFAULT_TENANT
+    try:
+        use_tenant(session.get('tenant', DEFAULT_TENANT))
+    except TenantError:
+        # Cabang dinonaktifkan/dihapus: paksa login ulang
+        session.clear()
+        use_tenant(DEFAULT_TENANT)
 
 # Custom Jinja2 filter untuk format Rupiah
 @app.template_filter('rupiah')
@@ -107,6 +182,21 @@ def format_date(date_string):
     except:
         return str(date_string)
 
+# Kunci idempotensi untuk form pembayaran: {{ idempotency_key() }}
+@app.template_global('idempotency_key')
+def idempotency_key_global():
+    from utils.idempotency import new_idempotency_key
+    return new_idempotency_key()
+
+# Pengaturan aplikasi (nama pondok, dll.) untuk semua template: {{ app_settings.pondok_name }}
+@app.context_processor
+def inject_app_settings():
+    from db import get_settings, SETTINGS_SCHEMA
+    try:
+        return {'app_settings': get_settings()}
+    except Exception:
+        return {'app_settings': {key: default for key, (kind, default) in SETTINGS_SCHEMA.items()}}
+
 # Import routes setelah membuat app
 from routes import auth_bp, dashboard_bp, transaction_bp, statistics_bp, wallet_bp, settings_bp, students_bp, history_bp, create_home_routes, users_bp, payments_bp, categories_bp
 
@@ -126,6 +216,93 @@ app.register_blueprint(categories_bp)
 # Create home routes
 create_home_routes(app)
 
+# CLI: generate tagihan berulang (untuk cron / task scheduler), untuk setiap cabang
+@app.cli.command('generate-bills')
+def generate_bills_command():
+    """Buat tagihan periode berjalan dari semua template tagihan aktif"""
+    from scheduler import run_scheduler_tick
+    from tenants import for_each_tenant
+    init_app()
+    with app.app_context():
+        results = for_each_tenant(run_scheduler_tick)
+    for tenant, created in results.items():
+        click.echo(f"[{tenant}] {sum(created.values())} tagihan baru dari {len(created)} template")
+
+# CLI: hitung ulang bills.paid_amount dari ledger transaksi
+@app.cli.command('reconcile-bills')
+def reconcile_bills_command():
+    """Cocokkan paid_amount setiap tagihan dengan total transaksi tertaut"""
+    from db import reconcile_bill_paid_amounts
+    from tenants import for_each_tenant
+    init_app()
+    with app.app_context():
+        results = for_each_tenant(reconcile_bill_paid_amounts)
+    for tenant, fixed in results.items():
+        click.echo(f"[{tenant}] {fixed} tagihan dikoreksi")
+
+# CLI: bangun ulang rollup statistik dari ledger transaksi
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Hitung ulang tabel transaction_rollup (harian/mingguan/bulanan)"""
+    from db import rebuild_transaction_rollup
+    from tenants import for_each_tenant
+    init_app()
+    with app.app_context():
+        results = for_each_tenant(rebuild_transaction_rollup)
+    for tenant, rows in results.items():
+        click.echo(f"[{tenant}] {rows} baris rollup")
+
+# CLI: perbarui snapshot laporan read-only (untuk cron bila thread refresher tidak dipakai)
+@app.cli.command('refresh-snapshot')
+def refresh_snapshot_command():
+    """Salin database setiap cabang ke snapshot laporan (SQLite online backup)"""
+    from snapshot import refresh_snapshot
+    from tenants import for_each_tenant
+    init_app()
+    with app.app_context():
+        results = for_each_tenant(refresh_snapshot)
+    for tenant, written in results.items():
+        click.echo(f"[{tenant}] {'disalin' if written else 'tidak berubah'}")
+
+# CLI: arsipkan riwayat lama (untuk cron bulanan)
+@app.cli.command('archive-history')
+@click.option('--months', default=None, type=int, help='Simpan N bulan terakhir di tabel live (default HISTORY_RETENTION_MONTHS)')
+def archive_history_command(months):
+    """Pindahkan riwayat lama setiap cabang ke arsip gzip NDJSON per bulan"""
+    from history_archive import archive_history
+    from tenants import for_each_tenant
+    init_app()
+    with app.app_context():
+        results = for_each_tenant(lambda: archive_history(months))
+    for tenant, moved in results.items():
+        click.echo(f"[{tenant}] {sum(moved.values())} entri diarsipkan dari {len(moved)} bulan")
+
+# CLI: daftarkan cabang pondok baru (database terpisah)
+@app.cli.command('add-tenant')
+@click.argument('slug')
+@click.argument('name')
+@click.option('--database', default=None, help='Path file database (default: tenants/<slug>.db)')
+@click.option('--admin-username', required=True, help='Username admin pertama cabang')
+@click.option('--admin-password', prompt=True, hide_input=True, confirmation_prompt=True,
+              help='Password admin pertama cabang')
+def add_tenant_command(slug, name, database, admin_username, admin_password):
+    """Daftarkan cabang baru: skema kosong (tanpa data contoh) + admin pertama"""
+    from db import create_admin_account, set_settings
+    from tenants import register_tenant, use_tenant, TenantError
+    if len(admin_password) < 6:
+        raise click.ClickException('Password admin minimal 6 karakter')
+    init_app()
+    with app.app_context():
+        try:
+            tenant = register_tenant(slug, name, database)
+        except TenantError as e:
+            raise click.ClickException(str(e))
+        use_tenant(tenant['slug'])
+        init_database()
+        create_admin_account(admin_username.strip(), admin_password, f"Admin {tenant['name']}")
+        set_settings({'pondok_name': tenant['name']})
+    click.echo(f"Cabang {tenant['slug']} ({tenant['name']}) -> {tenant['database']}, admin: {admin_username.strip()}")
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
@@ -156,4 +333,11 @@ def handle_csrf_error(e):
 
 if __name__ == '__main__':
     init_app()
+    # Hindari thread ganda pada proses induk reloader debug
+    if app.config['BILL_SCHEDULER_INTERVAL'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from scheduler import start_background_scheduler
+        start_background_scheduler(app, app.config['BILL_SCHEDULER_INTERVAL'])
+    if app.config['REPORT_SNAPSHOT_INTERVAL'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from snapshot import start_snapshot_refresher
+        start_snapshot_refresher(app, app.config['REPORT_SNAPSHOT_INTERVAL'])
     app.run(debug=True)
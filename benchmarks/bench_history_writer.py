@@ -0,0 +1,61 @@
+"""
+Benchmark record_history: INSERT + commit per entri vs penulis batch (history_writer)
+
+Mengukur waktu yang dihabiskan pemanggil (request) untuk mencatat N entri
+riwayat, dan total waktu sampai semua entri benar-benar tertulis.
+
+Jalankan dari root proyek:
+    python benchmarks/bench_history_writer.py [5000]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from db import close_db, init_db, query_db, ensure_history_table, ensure_history_indexes, record_history
+from history_writer import writer
+
+
+def record_many(entries, tag):
+    for i in range(entries):
+        record_history(1, 'create', tag, i, f'entri {i}')
+
+
+def main(entries):
+    app = Flask(__name__)
+    tmpdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    app.teardown_appcontext(close_db)
+
+    with app.app_context():
+        init_db()
+        ensure_history_table()
+        ensure_history_indexes()
+
+        start = time.perf_counter()
+        record_many(entries, 'sync')
+        sync = time.perf_counter() - start
+
+        writer.start()
+        start = time.perf_counter()
+        record_many(entries, 'batch')
+        caller = time.perf_counter() - start
+        writer.flush(timeout=60)
+        total = time.perf_counter() - start
+        writer.stop()
+
+        written = query_db("SELECT COUNT(*) as n FROM history WHERE target_type = 'batch'", one=True)['n']
+        stats = writer.stats()
+        print(f"{entries} entri riwayat")
+        print(f"  langsung (commit per entri)   {sync * 1000:8.1f} ms")
+        print(f"  batch: pemanggil              {caller * 1000:8.1f} ms")
+        print(f"  batch: sampai tertulis        {total * 1000:8.1f} ms   "
+              f"({stats['batches']} batch, maks {stats['max_batch']}, tertulis {written})")
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args or [5000]))
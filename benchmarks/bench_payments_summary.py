@@ -0,0 +1,99 @@
+"""
+Benchmark ringkasan tagihan per santri (payments.index_payments)
+
+Membandingkan query lama (subquery berkorelasi ke transactions per santri,
+semua santri sekaligus) dengan get_summarized_student_bills yang membaca
+bills.paid_amount dan mengembalikan satu halaman.
+
+Jalankan dari root proyek:
+    python benchmarks/bench_payments_summary.py [5000 24]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from db import (get_db, close_db, init_db, query_db, ensure_bills_table, ensure_transactions_bill_id_column,
+                ensure_bills_paid_amount_column, ensure_classes_table, reconcile_bill_paid_amounts,
+                get_summarized_student_bills)
+
+LEGACY_SQL = '''
+    SELECT
+        s.id,
+        s.name,
+        s.nisn,
+        s.kelas,
+        COUNT(b.id) as bill_count,
+        SUM(b.amount) as total_amount,
+        (SELECT COALESCE(SUM(t.amount), 0)
+         FROM transactions t
+         WHERE t.student_id = s.id AND t.type = 'income' AND t.bill_id IS NOT NULL) as total_paid
+    FROM students s
+    JOIN bills b ON s.id = b.student_id
+    GROUP BY s.id
+    ORDER BY s.name ASC
+'''
+
+
+def seed(students, bills_per_student):
+    """Santri x tagihan bulanan; dua pertiga tagihan sudah dibayar (satu transaksi per tagihan)"""
+    db = get_db()
+    db.executemany('''
+        INSERT INTO students (name, nisn, kelas, jenis_kelamin, status) VALUES (?, ?, ?, 'Laki-laki', 'aktif')
+    ''', ((f'Santri {i:05d}', f'B{i:08d}', f'Kelas {i % 6 + 1}') for i in range(students)))
+    db.executemany('''
+        INSERT INTO bills (student_id, title, amount, status) VALUES (?, ?, 150000, ?)
+    ''', ((sid, f'SPP {m}', 'paid' if m % 3 else 'unpaid')
+          for sid in range(1, students + 1) for m in range(bills_per_student)))
+    db.execute('''
+        INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
+        SELECT 1, student_id, 'income', 'Pembayaran Santri', amount, title, '2026-01-10', id
+        FROM bills WHERE status = 'paid'
+    ''')
+    db.commit()
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(students, bills_per_student):
+    app = Flask(__name__)
+    tmpdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    app.teardown_appcontext(close_db)
+
+    with app.app_context():
+        init_db()
+        ensure_bills_table()
+        ensure_transactions_bill_id_column()
+        ensure_bills_paid_amount_column()
+        ensure_classes_table()
+        seed(students, bills_per_student)
+        # Transaksi seed ditulis langsung, paid_amount diisi dari ledger
+        reconcile_bill_paid_amounts()
+
+        print(f"{students} santri x {bills_per_student} tagihan")
+        legacy, rows = timed(lambda: query_db(LEGACY_SQL))
+        print(f"  lama (semua baris, subquery)   : {legacy * 1000:8.1f} ms  ({len(rows)} baris)")
+        first, (rows, total) = timed(lambda: get_summarized_student_bills(page=1))
+        print(f"  baru halaman 1                 : {first * 1000:8.1f} ms  ({len(rows)} dari {total})")
+        last_page = (total + 49) // 50
+        last, _ = timed(lambda: get_summarized_student_bills(page=last_page))
+        print(f"  baru halaman {last_page:<17} : {last * 1000:8.1f} ms")
+        partial, (_, total) = timed(lambda: get_summarized_student_bills(status='partial'))
+        print(f"  baru filter cicilan            : {partial * 1000:8.1f} ms  ({total} santri)")
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args or [5000, 24]))
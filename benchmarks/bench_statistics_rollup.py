@@ -0,0 +1,83 @@
+"""
+Benchmark statistik per kategori (statistics.api/categories)
+
+Membandingkan agregasi langsung dari ledger transactions dengan
+get_rollup_totals yang membaca transaction_rollup (cube harian/mingguan/
+bulanan) untuk beberapa rentang tanggal.
+
+Jalankan dari root proyek:
+    python benchmarks/bench_statistics_rollup.py [1000000]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from db import (get_db, close_db, init_db, query_db, ensure_transactions_user_date_index,
+                ensure_transaction_rollup, get_rollup_totals)
+
+LEDGER_SQL = '''
+    SELECT category, SUM(amount) as total
+    FROM transactions
+    WHERE user_id = 1 AND type = 'income' AND date BETWEEN ? AND ?
+    GROUP BY category
+    ORDER BY total DESC
+'''
+
+CATEGORIES = ('Pembayaran Santri', 'Donasi', 'Infaq', 'Operasional', 'Konsumsi', 'Listrik', 'Gaji', 'Lainnya')
+
+
+def seed(transactions, students=2000):
+    """Transaksi acak tersebar lima tahun terakhir (2021-2025)"""
+    rng = random.Random(1)
+    first = date(2021, 1, 1)
+    db = get_db()
+    db.executemany('''
+        INSERT INTO transactions (user_id, student_id, type, category, amount, date) VALUES (1, ?, ?, ?, ?, ?)
+    ''', ((rng.randint(1, students), rng.choice(('income', 'expense')), rng.choice(CATEGORIES),
+           rng.randint(1, 200) * 5000, (first + timedelta(days=rng.randint(0, 1825))).isoformat())
+          for _ in range(transactions)))
+    db.commit()
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(transactions):
+    app = Flask(__name__)
+    tmpdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    app.teardown_appcontext(close_db)
+
+    with app.app_context():
+        init_db()
+        ensure_transactions_user_date_index()
+        seed(transactions)
+        # Rollup dibangun sekali dari ledger (backfill); setelah itu dipelihara trigger
+        build, _ = timed(ensure_transaction_rollup, repeat=1)
+        cells = query_db('SELECT COUNT(*) as n FROM transaction_rollup', one=True)['n']
+
+        print(f"{transactions} transaksi, {cells} sel rollup (backfill {build:.1f} s)")
+        for start, end in (('2025-09-20', '2025-10-19'), ('2024-10-20', '2025-10-19'),
+                           ('2023-03-17', '2025-08-02'), ('2021-01-01', '2025-12-31')):
+            ledger, rows = timed(lambda: query_db(LEDGER_SQL, (start, end)))
+            cube, cube_rows = timed(lambda: get_rollup_totals(1, start, end, ('category',), trans_type='income'))
+            same = [tuple(r) for r in rows] == [(r['category'], r['total']) for r in cube_rows]
+            print(f"  {start}..{end}  ledger {ledger * 1000:8.1f} ms   rollup {cube * 1000:6.1f} ms   sama: {same}")
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    main(*(args or [1000000]))
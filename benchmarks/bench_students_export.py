@@ -0,0 +1,93 @@
+"""
+Benchmark export data santri (students.export_excel)
+
+Membandingkan puncak memori Python (tracemalloc) antara workbook biasa
+yang menahan seluruh sel di memori dan export streaming write-only.
+
+Jalankan dari root proyek:
+    python benchmarks/bench_students_export.py [1000 10000 100000]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from openpyxl import Workbook
+from db import get_db, close_db, init_db, ensure_classes_table, iter_students, get_all_students
+from utils import excel
+
+HEADERS = ['No.', 'Nama Santri', 'NISN', 'Kelas', 'Jenis Kelamin', 'No. HP', 'Nama Orang Tua', 'No. HP Orang Tua', 'Alamat', 'Status']
+
+
+def _row(idx, s):
+    return [idx, s['name'], s['nisn'], s['kelas'], s['jenis_kelamin'], s['phone'],
+            s['parent_name'], s['parent_phone'], s['alamat'], s['status']]
+
+
+def seed(n):
+    db = get_db()
+    db.execute('DELETE FROM students')
+    db.executemany('''
+        INSERT INTO students (name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', ((f'Santri {i}', f'B{i:08d}', f'Kelas {i % 6 + 1}', 'Laki-laki', '08123456789',
+           f'Wali {i}', '08523456789', f'Jl. Contoh No. {i}', 'aktif') for i in range(n)))
+    db.commit()
+    ensure_classes_table()
+
+
+def export_legacy():
+    """Cara lama: Workbook biasa, semua baris dimuat lalu disimpan ke BytesIO"""
+    from io import BytesIO
+    wb = Workbook()
+    ws = wb.active
+    ws.append(HEADERS)
+    for idx, s in enumerate(get_all_students(), 1):
+        ws.append(_row(idx, s))
+    output = BytesIO()
+    wb.save(output)
+    return output
+
+
+def export_streaming():
+    wb = excel.new_workbook()
+    ws = excel.create_sheet(wb, 'Data Santri')
+    excel.append_header(ws, HEADERS)
+    for idx, s in enumerate(iter_students(), 1):
+        ws.append(_row(idx, s))
+    return excel.save_to_tempfile(wb)
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output.close()
+    return elapsed, peak / (1024 * 1024)
+
+
+def main(sizes):
+    app = Flask(__name__)
+    tmpdir = tempfile.mkdtemp()
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    app.teardown_appcontext(close_db)
+
+    with app.app_context():
+        init_db()
+        print(f"{'santri':>8} | {'legacy (s)':>10} | {'legacy MB':>9} | {'stream (s)':>10} | {'stream MB':>9}")
+        for n in sizes:
+            seed(n)
+            legacy_time, legacy_peak = measure(export_legacy)
+            stream_time, stream_peak = measure(export_streaming)
+            print(f"{n:>8} | {legacy_time:>10.2f} | {legacy_peak:>9.1f} | {stream_time:>10.2f} | {stream_peak:>9.1f}")
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000])
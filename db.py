@@ -2,15 +2,26 @@
 Database Configuration dan Management (SQLite Version)
 """
 import sqlite3
+import json
+import threading
+import time
+from types import MappingProxyType
 from flask import g, current_app
 from datetime import datetime, timedelta
 import random
 from werkzeug.security import generate_password_hash, check_password_hash
+from utils.names import normalize_name, phonetic_key, normalize_class_name
+from utils.cache import VersionedCache
+from utils.statements import digit_runs, StatementError
+
+def database_path():
+    """Path database aktif: milik tenant request ini (lihat tenants.use_tenant) atau DATABASE default"""
+    return g.get('database') or current_app.config['DATABASE']
 
 def get_db():
     """Mendapatkan koneksi database"""
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE'])
+        g.db = sqlite3.connect(database_path())
         g.db.row_factory = sqlite3.Row  # Enable column access by name
     return g.db
 
@@ -20,8 +31,8 @@ def close_db(e=None):
     if db is not None:
         db.close()
 
-def init_db():
-    """Inisialisasi database dengan schema"""
+def init_db(seed=True):
+    """Inisialisasi database dengan schema; seed=False (database cabang baru) tanpa admin/santri contoh"""
     db = get_db()
     c = db.cursor()
     
@@ -88,7 +99,7 @@ def init_db():
     
     # Check if admin exists
     c.execute("SELECT * FROM users WHERE username = 'admin'")
-    if c.fetchone() is None:
+    if seed and c.fetchone() is None:
         # Insert default user (admin)
         admin_pw = generate_password_hash('admin123')
         c.execute('''INSERT INTO users (username, password, email, full_name, role)
@@ -169,6 +180,23 @@ def create_user(username, password, email='', full_name='', role='user'):
     return execute_db('INSERT INTO users (username, password, email, full_name, role) VALUES (?, ?, ?, ?, ?)',
                       (username, pw_hash, email, full_name, role))
 
+def create_admin_account(username, password, full_name=''):
+    """Admin pertama database cabang baru, beserta wallet bersaldo 0"""
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('INSERT INTO users (username, password, full_name, role) VALUES (?, ?, ?, ?)',
+                    (username, generate_password_hash(password), full_name, 'admin'))
+        user_id = cur.lastrowid
+        cur.execute('INSERT INTO wallet (user_id, balance) VALUES (?, 0)', (user_id,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return user_id
+
 def update_user(user_id, username, email, full_name, role):
     return execute_db('UPDATE users SET username = ?, email = ?, full_name = ?, role = ? WHERE id = ?',
                       (username, email, full_name, role, user_id))
@@ -180,34 +208,26 @@ def set_user_password(user_id, new_password):
 def delete_user(user_id):
     return execute_db('DELETE FROM users WHERE id = ?', (user_id,))
 
-def get_dashboard_stats(user_id=1):
-    """Mendapatkan statistik dashboard"""
-    today = datetime.now()
-    start_of_month = datetime(today.year, today.month, 1)
-    
-    # Total pemasukan bulan ini
-    income = query_db('''
-        SELECT COALESCE(SUM(amount), 0) as total
-        FROM transactions
-        WHERE user_id = ? AND type = 'income' AND date >= ?
-    ''', (user_id, start_of_month.strftime('%Y-%m-%d')), one=True)
+_dashboard_cache = VersionedCache(maxsize=256, ttl=30)
 
-    # Total pengeluaran bulan ini
-    expense = query_db('''
-        SELECT COALESCE(SUM(amount), 0) as total
-        FROM transactions
-        WHERE user_id = ? AND type = 'expense' AND date >= ?
-    ''', (user_id, start_of_month.strftime('%Y-%m-%d')), one=True)
 
-    # Jumlah transaksi bulan ini
-    count = query_db('''
-        SELECT COUNT(*) as total
+def ensure_transactions_user_date_index():
+    """Index (user_id, date) untuk statistik dashboard dan grafik bulanan"""
+    get_db().execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions(user_id, date)')
+    get_db().commit()
+
+
+def _compute_dashboard_stats(user_id, month_start):
+    # Pemasukan, pengeluaran, jumlah transaksi bulan ini dan saldo dalam satu query
+    totals = query_db('''
+        SELECT
+            COALESCE(SUM(CASE WHEN type = 'income' THEN amount END), 0) as total_income,
+            COALESCE(SUM(CASE WHEN type = 'expense' THEN amount END), 0) as total_expense,
+            COUNT(*) as total_transactions,
+            (SELECT balance FROM wallet WHERE user_id = ?) as balance
         FROM transactions
         WHERE user_id = ? AND date >= ?
-    ''', (user_id, start_of_month.strftime('%Y-%m-%d')), one=True)
-
-    # Saldo saat ini
-    wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
+    ''', (user_id, user_id, month_start), one=True)
 
     # Transaksi terakhir (5 transaksi)
     recent = query_db('''
@@ -216,49 +236,321 @@ def get_dashboard_stats(user_id=1):
         ORDER BY date DESC, created_at DESC
         LIMIT 5
     ''', (user_id,))
-    
+
     return {
-        'total_income': income['total'] if income else 0,
-        'total_expense': expense['total'] if expense else 0,
-        'total_transactions': count['total'] if count else 0,
-        'balance': wallet['balance'] if wallet else 0,
+        'total_income': totals['total_income'],
+        'total_expense': totals['total_expense'],
+        'total_transactions': totals['total_transactions'],
+        'balance': totals['balance'] or 0,
         'recent_transactions': recent
     }
 
-def get_monthly_stats(user_id=1, months=1):
-    """Mendapatkan statistik per bulan"""
-    today = datetime.now()
-    start_date = today - timedelta(days=30*months)
 
-    data = query_db('''
+def get_dashboard_stats(user_id=1):
+    """Mendapatkan statistik dashboard
+
+    Hasil di-cache per user selama 30 detik dan langsung basi bila ada
+    penulisan ke transactions/wallet (stamp data_versions berubah).
+    """
+    month_start = datetime.now().strftime('%Y-%m-01')
+    version = get_data_version('transactions', 'wallet')
+    return _dashboard_cache.get_or_compute((user_id, month_start), version,
+                                           lambda: _compute_dashboard_stats(user_id, month_start))
+
+def get_branch_summary(today=None):
+    """Ringkasan satu database cabang (semua user): kas bulan ini, saldo, tunggakan, santri aktif"""
+    month_start = (today or datetime.now()).strftime('%Y-%m-01')
+    row = query_db('''
         SELECT
-            strftime('%%Y-%%m', date) as month,
-            type,
-            SUM(amount) as total
-        FROM transactions
-        WHERE user_id = ? AND date >= ?
+            (SELECT COALESCE(SUM(CASE WHEN type = 'income' THEN total END), 0)
+             FROM transaction_rollup WHERE grain = 'month' AND by_student = 0 AND period = ?) as income,
+            (SELECT COALESCE(SUM(CASE WHEN type = 'expense' THEN total END), 0)
+             FROM transaction_rollup WHERE grain = 'month' AND by_student = 0 AND period = ?) as expense,
+            (SELECT COALESCE(SUM(balance), 0) FROM wallet) as balance,
+            (SELECT COALESCE(SUM(amount - paid_amount), 0) FROM bills WHERE status = 'unpaid') as arrears,
+            (SELECT COUNT(*) FROM students WHERE status = 'aktif') as students
+    ''', (month_start, month_start), one=True)
+    return dict(row)
+
+_series_cache = VersionedCache(maxsize=256, ttl=300)
+
+MONTH_ABBR_ID = ['Jan', 'Feb', 'Mar', 'Apr', 'Mei', 'Jun', 'Jul', 'Agu', 'Sep', 'Okt', 'Nov', 'Des']
+
+
+def month_range(months, today=None):
+    """Daftar (tahun, bulan) kalender untuk N bulan terakhir, berakhir di bulan berjalan"""
+    today = today or datetime.now()
+    result = []
+    for i in range(months - 1, -1, -1):
+        year_offset, month_index = divmod(today.month - 1 - i, 12)
+        result.append((today.year + year_offset, month_index + 1))
+    return result
+
+
+def _compute_monthly_series(user_id, months, today):
+    month_list = month_range(months, today)
+    start = '%04d-%02d-01' % month_list[0]
+    last_year, last_month = month_list[-1]
+    end = '%04d-%02d-01' % ((last_year + 1, 1) if last_month == 12 else (last_year, last_month + 1))
+
+    rows = query_db('''
+        SELECT substr(period, 1, 7) as month, type, SUM(total) as total
+        FROM transaction_rollup
+        WHERE user_id = ? AND grain = 'month' AND by_student = 0 AND period >= ? AND period < ?
         GROUP BY month, type
-        ORDER BY month
-    ''', (user_id, start_date.strftime('%Y-%m-%d')))
+    ''', (user_id, start, end))
+    totals = {(r['month'], r['type']): r['total'] for r in rows}
 
-    return data
+    keys = ['%04d-%02d' % ym for ym in month_list]
+    return {
+        'months': keys,
+        'labels': [f"{MONTH_ABBR_ID[m - 1]} {str(y)[2:]}" for y, m in month_list],
+        'income': [totals.get((k, 'income'), 0) for k in keys],
+        'expense': [totals.get((k, 'expense'), 0) for k in keys],
+    }
 
-def get_category_stats(user_id=1, trans_type='expense', months=1):
-    """Mendapatkan statistik per kategori"""
-    today = datetime.now()
-    start_date = today - timedelta(days=30*months)
 
-    data = query_db('''
-        SELECT
-            category,
-            SUM(amount) as total
-        FROM transactions
-        WHERE user_id = ? AND type = ? AND date >= ?
-        GROUP BY category
+def get_monthly_series(user_id=1, months=12, today=None):
+    """Seri pemasukan/pengeluaran tepat N bulan kalender, dibaca dari rollup bulanan.
+
+    Di-cache per user; basi bila ada penulisan transaksi atau setelah 5 menit.
+    """
+    today = today or datetime.now()
+    version = get_data_version('transactions')
+    key = (user_id, months, today.strftime('%Y-%m'))
+    return _series_cache.get_or_compute(key, version, lambda: _compute_monthly_series(user_id, months, today))
+
+
+def get_category_stats(user_id=1, trans_type='expense', months=1, start=None, end=None):
+    """Mendapatkan statistik per kategori (dari rollup) untuk N bulan terakhir atau rentang start..end"""
+    if start is None or end is None:
+        start, end = period_range(months)
+    return get_rollup_totals(user_id, start, end, group_by=('category',), trans_type=trans_type)
+
+
+# ===== ROLLUP TRANSAKSI (cube harian/mingguan/bulanan) =====
+
+# Awal periode per grain sebagai ekspresi SQL atas kolom tanggal; minggu dimulai Senin
+ROLLUP_GRAINS = {
+    'day': "COALESCE(date({col}), '')",
+    'week': "COALESCE(date({col}, 'weekday 0', '-6 days'), '')",
+    'month': "COALESCE(date({col}, 'start of month'), '')",
+}
+# Dimensi yang bisa dipakai untuk GROUP BY di get_rollup_totals
+ROLLUP_DIMENSIONS = {
+    'type': 'r.type',
+    'category': 'r.category',
+    'student_id': 'r.student_id',
+    'kelas': "COALESCE(s.kelas, '-')",
+}
+# Level rollup: 0 = total semua santri (kecil, untuk laporan umum), 1 = rinci per santri
+ROLLUP_LEVELS = {0: '0', 1: 'COALESCE({row}.student_id, 0)'}
+
+
+def _rollup_upsert_sql(row, sign):
+    """Statement trigger: tambah/kurangi satu transaksi (NEW/OLD) ke setiap grain dan level"""
+    statements = []
+    op = '+' if sign > 0 else '-'
+    for grain, expr in ROLLUP_GRAINS.items():
+        period = expr.format(col=f'{row}.date')
+        for level, student_expr in ROLLUP_LEVELS.items():
+            student = student_expr.format(row=row)
+            match = (f"user_id = {row}.user_id AND grain = '{grain}' AND by_student = {level} AND period = {period} "
+                     f"AND type = {row}.type AND category = {row}.category AND student_id = {student}")
+            if sign > 0:
+                statements.append(
+                    f"INSERT OR IGNORE INTO transaction_rollup (user_id, grain, by_student, period, type, category, student_id) "
+                    f"VALUES ({row}.user_id, '{grain}', {level}, {period}, {row}.type, {row}.category, {student});")
+            statements.append(f"UPDATE transaction_rollup SET total = total {op} {row}.amount, "
+                              f"tx_count = tx_count {op} 1 WHERE {match};")
+            if sign < 0:
+                statements.append(f"DELETE FROM transaction_rollup WHERE {match} AND tx_count <= 0;")
+    return '\n'.join(statements)
+
+
+def ensure_transaction_rollup():
+    """Tabel rollup transaksi + trigger yang memeliharanya secara inkremental.
+
+    Kunci: (user, grain, level, awal periode, type, category, student). Kelas
+    tidak disimpan di kunci; diambil dari students saat query sehingga santri
+    yang pindah kelas tidak membuat angka rollup tidak konsisten.
+    """
+    db = get_db()
+    cur = db.cursor()
+    exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transaction_rollup'").fetchone()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS transaction_rollup (
+            user_id INTEGER NOT NULL,
+            grain TEXT NOT NULL,
+            by_student INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            type TEXT NOT NULL,
+            category TEXT NOT NULL,
+            student_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, grain, by_student, period, type, category, student_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_rollup_insert
+        AFTER INSERT ON transactions
+        BEGIN
+            {_rollup_upsert_sql('NEW', 1)}
+        END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_rollup_delete
+        AFTER DELETE ON transactions
+        BEGIN
+            {_rollup_upsert_sql('OLD', -1)}
+        END
+    ''')
+    cur.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_rollup_update
+        AFTER UPDATE OF user_id, student_id, type, category, amount, date ON transactions
+        BEGIN
+            {_rollup_upsert_sql('OLD', -1)}
+            {_rollup_upsert_sql('NEW', 1)}
+        END
+    ''')
+    db.commit()
+    cur.close()
+    if not exists:
+        rebuild_transaction_rollup()
+
+
+def rebuild_transaction_rollup():
+    """Bangun ulang seluruh rollup dari ledger transaksi (backfill / perbaikan)"""
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('DELETE FROM transaction_rollup')
+        for grain, expr in ROLLUP_GRAINS.items():
+            for level, student_expr in ROLLUP_LEVELS.items():
+                cur.execute(f'''
+                    INSERT INTO transaction_rollup (user_id, grain, by_student, period, type, category, student_id, total, tx_count)
+                    SELECT user_id, ?, ?, {expr.format(col='date')} as period, type, category,
+                           {student_expr.format(row='transactions')} as sid, SUM(amount), COUNT(*)
+                    FROM transactions
+                    GROUP BY user_id, period, type, category, sid
+                ''', (grain, level))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return query_db("SELECT COUNT(*) as n FROM transaction_rollup", one=True)['n']
+
+
+def _as_date(value):
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value.date() if isinstance(value, datetime) else value
+
+
+def shift_months(value, months):
+    """Geser tanggal N bulan kalender; tanggal di luar bulan tujuan dijepit ke akhir bulan"""
+    value = _as_date(value)
+    year_offset, month_index = divmod(value.month - 1 + months, 12)
+    year, month = value.year + year_offset, month_index + 1
+    next_first = datetime(year + (month == 12), month % 12 + 1, 1).date()
+    return value.replace(year=year, month=month, day=min(value.day, (next_first - timedelta(days=1)).day))
+
+
+def rollup_segments(start, end, grains=('month', 'week', 'day')):
+    """Pecah rentang [start, end] menjadi run (grain, periode pertama, periode terakhir).
+
+    Bulan penuh dipakai bila muat, lalu minggu penuh (yang tidak melintasi
+    awal bulan), sisanya hari; jumlah run tetap kecil berapa pun panjang
+    rentangnya.
+    """
+    start, end = _as_date(start), _as_date(end)
+    runs = []
+    cursor = start
+    while cursor <= end:
+        next_month = shift_months(cursor.replace(day=1), 1)
+        week_end = cursor + timedelta(days=6)
+        if 'month' in grains and cursor.day == 1 and next_month - timedelta(days=1) <= end:
+            grain, step_end = 'month', next_month
+        elif ('week' in grains and cursor.weekday() == 0 and week_end <= end
+              and ('month' not in grains or week_end < next_month)):
+            grain, step_end = 'week', week_end + timedelta(days=1)
+        else:
+            grain, step_end = 'day', cursor + timedelta(days=1)
+        period = cursor.strftime('%Y-%m-%d')
+        if runs and runs[-1][0] == grain:
+            runs[-1][2] = period
+        else:
+            runs.append([grain, period, period])
+        cursor = step_end
+    return [tuple(r) for r in runs]
+
+
+def get_rollup_totals(user_id, start, end, group_by=('type',), trans_type=None, kelas=None, student_id=None):
+    """Total & jumlah transaksi dalam rentang tanggal bebas, dikelompokkan per dimensi.
+
+    Dibaca dari transaction_rollup, bukan dari ledger: biaya query tergantung
+    jumlah run periode dan kombinasi dimensi, bukan jumlah transaksi.
+    """
+    unknown = [d for d in group_by if d not in ROLLUP_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Dimensi rollup tidak dikenal: {', '.join(unknown)}")
+    runs = rollup_segments(start, end)
+    if not runs:
+        return []
+
+    need_students = bool(kelas or student_id or {'kelas', 'student_id'} & set(group_by))
+    by_student = 1 if need_students else 0
+    # Satu range scan berindeks per run periode; OR di satu WHERE membuat SQLite memindai seluruh tabel
+    parts = ' UNION ALL '.join(
+        'SELECT * FROM transaction_rollup WHERE user_id = ? AND grain = ? AND by_student = ? AND period BETWEEN ? AND ?'
+        for _ in runs)
+    params = [v for grain, first, last in runs for v in (user_id, grain, by_student, first, last)]
+
+    where = []
+    if trans_type:
+        where.append('r.type = ?')
+        params.append(trans_type)
+    if student_id:
+        where.append('r.student_id = ?')
+        params.append(student_id)
+    if kelas:
+        where.append('s.kelas = ?')
+        params.append(kelas)
+
+    columns = [f'{ROLLUP_DIMENSIONS[d]} as {d}' for d in group_by]
+    group = f"GROUP BY {', '.join(ROLLUP_DIMENSIONS[d] for d in group_by)}" if group_by else ''
+    return query_db(f'''
+        SELECT {', '.join(columns + ['SUM(r.total) as total', 'SUM(r.tx_count) as tx_count'])}
+        FROM ({parts}) r
+        {'LEFT JOIN students s ON s.id = r.student_id' if 'kelas' in group_by or kelas else ''}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        {group}
         ORDER BY total DESC
-    ''', (user_id, trans_type, start_date.strftime('%Y-%m-%d')))
+    ''', params)
+
+
+def get_rollup_comparison(user_id, start, end, group_by=('type',), **filters):
+    """Rentang [start, end] dibandingkan dengan rentang yang sama tahun sebelumnya"""
+    start, end = _as_date(start), _as_date(end)
+    prev_start, prev_end = shift_months(start, -12), shift_months(end, -12)
+    return {
+        'start': start.strftime('%Y-%m-%d'),
+        'end': end.strftime('%Y-%m-%d'),
+        'previous_start': prev_start.strftime('%Y-%m-%d'),
+        'previous_end': prev_end.strftime('%Y-%m-%d'),
+        'current': get_rollup_totals(user_id, start, end, group_by, **filters),
+        'previous': get_rollup_totals(user_id, prev_start, prev_end, group_by, **filters),
+    }
+
 
-    return data
+def period_range(months, today=None):
+    """(start, end) untuk N bulan kalender terakhir yang berakhir hari ini"""
+    end = _as_date(today or datetime.now())
+    return shift_months(end, -months) + timedelta(days=1), end
 
 
 # ===== FUNCTIONS UNTUK STUDENTS =====
@@ -266,10 +558,29 @@ def get_category_stats(user_id=1, trans_type='expense', months=1):
 def get_all_students():
     """Mendapatkan semua santri"""
     return query_db('''
-        SELECT * FROM students 
-        ORDER BY kelas, name ASC
+        SELECT s.* FROM students s
+        LEFT JOIN classes c ON c.id = s.class_id
+        ORDER BY c.name, s.class_id, s.name ASC
     ''')
 
+def iter_students(batch_size=500):
+    """Iterasi semua santri langsung dari cursor tanpa memuat seluruh tabel ke memori"""
+    cursor = get_db().cursor()
+    try:
+        cursor.execute('''
+            SELECT s.* FROM students s
+            LEFT JOIN classes c ON c.id = s.class_id
+            ORDER BY c.name, s.class_id, s.name ASC
+        ''')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
 def get_student(student_id):
     """Mendapatkan detail santri"""
     return query_db('SELECT * FROM students WHERE id = ?', (student_id,), one=True)
@@ -322,20 +633,58 @@ def get_student_payment_stats(student_id):
         'last_payment': last_payment
     }
 
+def iter_student_payment_summary(period_start, period_end, batch_size=500):
+    """Iterasi santri beserta total pembayaran (semua waktu dan dalam periode) dalam satu query agregat.
+
+    Urutan sama dengan get_all_students (per kelas, lalu nama).
+    """
+    cursor = get_db().cursor()
+    try:
+        cursor.execute('''
+            SELECT s.*,
+                   COALESCE(p.total_payment, 0) as total_payment,
+                   COALESCE(p.period_payment, 0) as period_payment
+            FROM students s
+            LEFT JOIN (
+                SELECT student_id,
+                       SUM(amount) as total_payment,
+                       SUM(CASE WHEN date >= ? AND date < ? THEN amount ELSE 0 END) as period_payment
+                FROM transactions
+                WHERE type = 'income' AND student_id IS NOT NULL
+                GROUP BY student_id
+            ) p ON p.student_id = s.id
+            LEFT JOIN classes c ON c.id = s.class_id
+            ORDER BY c.name, s.class_id, s.name ASC
+        ''', (period_start, period_end))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
 def add_student(name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status='aktif'):
     """Menambah santri baru"""
+    class_id, kelas = get_or_create_class(kelas)
     return execute_db('''
-        INSERT INTO students (name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status))
+        INSERT INTO students (name, nisn, kelas, class_id, jenis_kelamin, phone, parent_name, parent_phone, alamat, status,
+                              name_key, name_phonetic)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (name, nisn, kelas, class_id, jenis_kelamin, phone, parent_name, parent_phone, alamat, status,
+          normalize_name(name), phonetic_key(name)))
 
 def update_student(student_id, name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status):
     """Update data santri"""
+    class_id, kelas = get_or_create_class(kelas)
     return execute_db('''
         UPDATE students
-        SET name=?, nisn=?, kelas=?, jenis_kelamin=?, phone=?, parent_name=?, parent_phone=?, alamat=?, status=?
+        SET name=?, nisn=?, kelas=?, class_id=?, jenis_kelamin=?, phone=?, parent_name=?, parent_phone=?, alamat=?, status=?,
+            name_key=?, name_phonetic=?
         WHERE id=?
-    ''', (name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status, student_id))
+    ''', (name, nisn, kelas, class_id, jenis_kelamin, phone, parent_name, parent_phone, alamat, status,
+          normalize_name(name), phonetic_key(name), student_id))
 
 
 def update_student_photo(student_id, photo_path):
@@ -351,6 +700,220 @@ def delete_student(student_id):
     return execute_db('DELETE FROM students WHERE id=?', (student_id,))
 
 
+def ensure_students_name_key_columns():
+    """Pastikan kolom name_key/name_phonetic beserta index-nya ada dan terisi (aman dipanggil berulang)"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("PRAGMA table_info(students)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'name_key' not in columns:
+        cur.execute("ALTER TABLE students ADD COLUMN name_key TEXT")
+    if 'name_phonetic' not in columns:
+        cur.execute("ALTER TABLE students ADD COLUMN name_phonetic TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_name_phonetic ON students(name_phonetic)")
+
+    # Backfill baris lama / baris yang dibuat di luar add_student, dan hitung ulang
+    # kunci yang dibuat dengan aturan lama (fonetik per kata, 'an' bukan gelar)
+    rows = cur.execute("SELECT id, name, name_key, name_phonetic FROM students").fetchall()
+    changed = []
+    for student_id, name, name_key, name_phonetic in rows:
+        keys = (normalize_name(name), phonetic_key(name))
+        if keys != (name_key, name_phonetic):
+            changed.append(keys + (student_id,))
+    if changed:
+        cur.executemany("UPDATE students SET name_key = ?, name_phonetic = ? WHERE id = ?", changed)
+    db.commit()
+    cur.close()
+
+
+def find_student_by_name(name, kelas, exclude_id=None):
+    """Cari santri dengan nama ternormalisasi yang sama di kelas yang sama (index probe name_key, class_id).
+
+    Kelas dicocokkan lewat kuncinya, jadi 'kelas 1' dan 'Kelas 1' dianggap kelas yang sama;
+    kelas yang belum terdaftar berarti belum ada santri di dalamnya.
+    """
+    class_id = None
+    key = normalize_class_name(kelas)
+    if key:
+        row = query_db('SELECT id FROM classes WHERE name_key = ?', (key,), one=True)
+        if not row:
+            return None
+        class_id = row['id']
+    return query_db('''
+        SELECT * FROM students
+        WHERE name_key = ? AND class_id IS ? AND id != ?
+        LIMIT 1
+    ''', (normalize_name(name), class_id, exclude_id or 0), one=True)
+
+
+def find_student_by_nisn(nisn, exclude_id=None):
+    """Cari santri berdasarkan NISN"""
+    if not nisn:
+        return None
+    return query_db('SELECT * FROM students WHERE nisn = ? AND id != ? LIMIT 1',
+                    (nisn, exclude_id or 0), one=True)
+
+
+def find_similar_students(name, limit=5, exclude_id=None):
+    """Kandidat santri dengan ejaan nama mirip berdasarkan kunci fonetik"""
+    key = phonetic_key(name)
+    if not key:
+        return []
+    return query_db('''
+        SELECT * FROM students
+        WHERE name_phonetic = ? AND id != ?
+        ORDER BY name ASC
+        LIMIT ?
+    ''', (key, exclude_id or 0, limit))
+
+
+def ensure_students_search_index():
+    """Index untuk pencarian prefix santri berdasarkan kelas (nama dan NISN sudah ter-index)"""
+    db = get_db()
+    db.execute("CREATE INDEX IF NOT EXISTS idx_students_kelas ON students(kelas COLLATE NOCASE, name)")
+    db.commit()
+
+
+def search_students(q, limit=20, offset=0):
+    """Pencarian santri berbasis prefix nama/NISN/kelas; setiap cabang query memakai index range scan"""
+    q = (q or '').strip()
+    if not q:
+        return query_db('''
+            SELECT id, name, nisn, kelas, status FROM students
+            ORDER BY name ASC LIMIT ? OFFSET ?
+        ''', (limit, offset))
+    key = normalize_name(q)
+    return query_db('''
+        SELECT id, name, nisn, kelas, status FROM students WHERE name_key >= ? AND name_key < ?
+        UNION
+        SELECT id, name, nisn, kelas, status FROM students WHERE nisn >= ? AND nisn < ?
+        UNION
+        SELECT id, name, nisn, kelas, status FROM students
+        WHERE kelas >= ? COLLATE NOCASE AND kelas < ? COLLATE NOCASE
+        ORDER BY name ASC LIMIT ? OFFSET ?
+    ''', (key, key + '\uffff', q, q + '\uffff', q, q + '\uffff', limit, offset))
+
+
+### Classes / Kelas helpers ###
+def ensure_classes_table():
+    """Buat tabel classes, kolom students.class_id, dan migrasikan teks kelas lama (aman dipanggil berulang).
+
+    Ejaan kelas yang berbeda tetapi kuncinya sama ('Kelas 1', 'kelas1', 'KLS I')
+    digabung ke satu baris classes; nama yang paling banyak dipakai menjadi nama resmi.
+    """
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS classes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            name_key TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute("PRAGMA table_info(students)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'class_id' not in columns:
+        cur.execute("ALTER TABLE students ADD COLUMN class_id INTEGER REFERENCES classes(id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_class_id ON students(class_id)")
+    # Kunci format lama (token digabung tanpa pemisah) dihitung ulang dari nama kelas
+    for class_id, name, key in cur.execute('SELECT id, name, name_key FROM classes').fetchall():
+        new_key = normalize_class_name(name)
+        if new_key and new_key != key:
+            cur.execute('UPDATE classes SET name_key = ? WHERE id = ?', (new_key, class_id))
+    if 'name_key' in columns:
+        # Cek duplikasi nama per kelas memakai (name_key, class_id), bukan teks kelas
+        cur.execute("DROP INDEX IF EXISTS idx_students_name_key")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_students_name_key_class ON students(name_key, class_id)")
+
+    # Migrasi santri yang belum punya class_id
+    rows = cur.execute('''
+        SELECT kelas, COUNT(*) as total FROM students
+        WHERE class_id IS NULL AND kelas IS NOT NULL AND TRIM(kelas) != ''
+        GROUP BY kelas
+        ORDER BY total DESC
+    ''').fetchall()
+    for kelas, _ in rows:
+        key = normalize_class_name(kelas)
+        if not key:
+            continue
+        # Urutan DESC: ejaan terbanyak tercatat lebih dulu sebagai nama resmi
+        cur.execute('INSERT OR IGNORE INTO classes (name, name_key) VALUES (?, ?)', (kelas.strip(), key))
+        class_id, name = cur.execute('SELECT id, name FROM classes WHERE name_key = ?', (key,)).fetchone()
+        cur.execute('UPDATE students SET class_id = ?, kelas = ? WHERE class_id IS NULL AND kelas = ?',
+                    (class_id, name, kelas))
+    db.commit()
+    cur.close()
+
+
+def get_or_create_class(kelas):
+    """Kembalikan (class_id, nama resmi) untuk teks kelas; buat kelas baru bila belum ada"""
+    key = normalize_class_name(kelas)
+    if not key:
+        return None, kelas
+    row = query_db('SELECT id, name FROM classes WHERE name_key = ?', (key,), one=True)
+    if row:
+        return row['id'], row['name']
+    name = kelas.strip()
+    return execute_db('INSERT INTO classes (name, name_key) VALUES (?, ?)', (name, key)), name
+
+
+def get_all_classes():
+    """Semua kelas beserta jumlah santri (total dan aktif)"""
+    return query_db('''
+        SELECT c.id, c.name,
+               COUNT(s.id) as student_count,
+               COALESCE(SUM(CASE WHEN s.status = 'aktif' THEN 1 ELSE 0 END), 0) as active_count
+        FROM classes c
+        LEFT JOIN students s ON s.class_id = c.id
+        GROUP BY c.id
+        ORDER BY c.name
+    ''')
+
+
+def get_class(class_id):
+    return query_db('SELECT * FROM classes WHERE id = ?', (class_id,), one=True)
+
+
+def rename_class(class_id, new_name):
+    """Ganti nama kelas; jika nama baru sama dengan kelas lain, kedua kelas digabung"""
+    key = normalize_class_name(new_name)
+    if not key:
+        return None
+    other = query_db('SELECT id FROM classes WHERE name_key = ? AND id != ?', (key, class_id), one=True)
+    if other:
+        move_class_students(class_id, other['id'], delete_source=True)
+        return other['id']
+    db = get_db()
+    db.execute('UPDATE classes SET name = ?, name_key = ? WHERE id = ?', (new_name.strip(), key, class_id))
+    db.execute('UPDATE students SET kelas = ? WHERE class_id = ?', (new_name.strip(), class_id))
+    db.commit()
+    return class_id
+
+
+def move_class_students(class_id, target_class_id, delete_source=False):
+    """Pindahkan semua santri satu kelas ke kelas lain (naik kelas / gabung kelas) dalam satu transaksi"""
+    target = get_class(target_class_id)
+    if not target or class_id == target_class_id:
+        return 0
+    db = get_db()
+    cur = db.execute('UPDATE students SET class_id = ?, kelas = ? WHERE class_id = ?',
+                     (target_class_id, target['name'], class_id))
+    moved = cur.rowcount
+    if delete_source:
+        db.execute('DELETE FROM classes WHERE id = ?', (class_id,))
+    db.commit()
+    return moved
+
+
+def set_class_status(class_id, status):
+    """Ubah status semua santri dalam satu kelas (mis. lulus -> non-aktif)"""
+    db = get_db()
+    cur = db.execute('UPDATE students SET status = ? WHERE class_id = ?', (status, class_id))
+    db.commit()
+    return cur.rowcount
+
+
 def ensure_history_table():
     """Ensure history table exists (safe to call multiple times)."""
     db = get_db()
@@ -371,16 +934,118 @@ def ensure_history_table():
 
 
 def record_history(user_id, action, target_type=None, target_id=None, meta=None):
-    """Record an action into history log."""
-    return execute_db('''
-        INSERT INTO history (user_id, action, target_type, target_id, meta)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, action, target_type, target_id, meta))
+    """Record an action into history log.
+
+    - Transaksi pemanggil masih terbuka: entri ikut transaksi itu (commit/rollback bersama).
+    - Selain itu entri diantre ke penulis batch (history_writer, dimulai saat
+      entri pertama), tanpa commit di request ini.
+    - Batch nonaktif (HISTORY_FLUSH_INTERVAL = 0) atau antrean penuh: INSERT +
+      commit langsung seperti biasa.
+    Mengembalikan id entri bila ditulis langsung, None bila diantre.
+    """
+    from history_writer import writer, ensure_history_writer, history_timestamp, INSERT_HISTORY_SQL
+    row = (user_id, action, target_type, target_id, meta, history_timestamp())
+    db = get_db()
+    if db.in_transaction:
+        return db.execute(INSERT_HISTORY_SQL, row).lastrowid
+    if ensure_history_writer(current_app) and writer.submit(database_path(), row):
+        return None
+    return execute_db(INSERT_HISTORY_SQL, row)
+
+
+def flush_history(timeout=5):
+    """Pastikan entri riwayat yang masih diantre sudah tertulis sebelum dibaca"""
+    from history_writer import writer
+    writer.flush(timeout)
+
 
+# Nilai yang dipakai record_history / INSERT history di seluruh aplikasi (untuk filter riwayat)
+HISTORY_ACTIONS = ('create', 'update', 'delete', 'pay', 'allocate', 'bulk_create', 'bulk_pay',
+                   'generate', 'import', 'merge', 'move')
+HISTORY_TARGET_TYPES = ('transaction', 'student', 'bill', 'bill_template', 'category', 'class',
+                        'user', 'settings', 'statement')
 
-def get_history(limit=200):
-    """Get recent history entries ordered by newest first."""
-    return query_db('SELECT * FROM history ORDER BY created_at DESC LIMIT ?', (limit,))
+
+def ensure_history_indexes():
+    """Index (kolom filter, created_at) untuk keyset pagination riwayat; rowid (id) ikut di ujung index"""
+    db = get_db()
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_created ON history(created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_action ON history(action, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_history_target ON history(target_type, target_id, created_at)')
+    db.commit()
+
+
+def history_cursor(entry):
+    """Cursor keyset untuk satu entri: '<created_at>~<id>'"""
+    return f"{entry['created_at']}~{entry['id']}"
+
+
+def _parse_history_cursor(cursor):
+    try:
+        created_at, entry_id = cursor.rsplit('~', 1)
+        return created_at, int(entry_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_history_page(user_id=None, action=None, target_type=None, target_id=None,
+                     date_from=None, date_to=None, before=None, after=None, limit=50):
+    """Satu halaman riwayat (terbaru dulu) dengan keyset pagination pada (created_at, id).
+
+    before -> halaman lebih lama, after -> halaman lebih baru (cursor dari
+    history_cursor). Setiap filter punya index (kolom, created_at) sehingga
+    filter + rentang tanggal + cursor menjadi satu range scan; biaya per
+    halaman tidak tergantung jumlah baris riwayat.
+    Mengembalikan {'entries', 'older', 'newer'}: older/newer berisi cursor atau None.
+    """
+    where, params = [], []
+    if user_id:
+        where.append('h.user_id = ?')
+        params.append(user_id)
+    if action:
+        where.append('h.action = ?')
+        params.append(action)
+    if target_type:
+        where.append('h.target_type = ?')
+        params.append(target_type)
+    if target_id:
+        where.append('h.target_id = ?')
+        params.append(target_id)
+    if date_from:
+        where.append('h.created_at >= ?')
+        params.append(date_from)
+    if date_to:
+        where.append('h.created_at < ?')
+        params.append((_as_date(date_to) + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+    before, after = _parse_history_cursor(before), _parse_history_cursor(after)
+    backwards = bool(after) and not before
+    if before:
+        where.append('(h.created_at, h.id) < (?, ?)')
+        params.extend(before)
+    elif after:
+        where.append('(h.created_at, h.id) > (?, ?)')
+        params.extend(after)
+
+    order = 'ASC' if backwards else 'DESC'
+    rows = query_db(f'''
+        SELECT h.*, u.username
+        FROM history h
+        LEFT JOIN users u ON u.id = h.user_id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY h.created_at {order}, h.id {order}
+        LIMIT ?
+    ''', params + [limit + 1])
+    has_more = len(rows) > limit
+    entries = [dict(r) for r in rows[:limit]]
+    if backwards:
+        entries.reverse()
+    if not entries:
+        return {'entries': [], 'older': None, 'newer': None}
+    older = history_cursor(entries[-1]) if (backwards or has_more) else None
+    newer = history_cursor(entries[0]) if ((backwards and has_more) or (not backwards and before)) else None
+    return {'entries': entries, 'older': older, 'newer': newer}
 
 
 ### Bills / Tagihan helpers ###
@@ -395,12 +1060,14 @@ def ensure_bills_table():
             amount INTEGER NOT NULL,
             due_date TEXT,
             status TEXT DEFAULT 'unpaid',
+            paid_amount INTEGER NOT NULL DEFAULT 0,
             created_by INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             paid_at TIMESTAMP NULL,
             FOREIGN KEY(student_id) REFERENCES students(id)
         )
     ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_bills_student_status ON bills(student_id, status)')
     db.commit()
     cur.close()
 
@@ -421,11 +1088,392 @@ def ensure_transactions_bill_id_column():
         cur.close()
 
 
+def ensure_bills_paid_amount_column():
+    """Kolom bills.paid_amount (total pembayaran tertaut) + index transactions(bill_id), lalu isi ulang dari ledger"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute("PRAGMA table_info(bills)")
+    columns = [row[1] for row in cur.fetchall()]
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_transactions_bill_id ON transactions(bill_id)')
+    if 'paid_amount' not in columns:
+        cur.execute('ALTER TABLE bills ADD COLUMN paid_amount INTEGER NOT NULL DEFAULT 0')
+    db.commit()
+    cur.close()
+    if 'paid_amount' not in columns:
+        reconcile_bill_paid_amounts()
+
+
+def _apply_bill_payment(cur, bill_id, delta):
+    """Tambah/kurangi bills.paid_amount dan sesuaikan status; tanpa commit (ikut transaksi pemanggil)"""
+    if not bill_id or not delta:
+        return
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # Nilai kolom di sisi kanan SET adalah nilai lama, jadi paid_amount + ? = nilai baru
+    cur.execute('''
+        UPDATE bills SET
+            paid_amount = paid_amount + ?,
+            status = CASE WHEN paid_amount + ? >= amount THEN 'paid'
+                          WHEN ? < 0 THEN 'unpaid' ELSE status END,
+            paid_at = CASE WHEN paid_amount + ? >= amount THEN COALESCE(paid_at, ?)
+                           WHEN ? < 0 THEN NULL ELSE paid_at END
+        WHERE id = ?
+    ''', (delta, delta, delta, delta, now, delta, bill_id))
+
+
+def _linked_amount(trans):
+    """Nominal transaksi yang dihitung sebagai pembayaran tagihan"""
+    if trans and trans['bill_id'] and trans['type'] == 'income':
+        return trans['amount']
+    return 0
+
+
+def _wallet_amount(trans_type, amount):
+    """Pengaruh satu transaksi terhadap saldo wallet: income menambah, expense mengurangi"""
+    return amount if trans_type == 'income' else -amount
+
+
+def _apply_wallet(cur, user_id, delta):
+    """balance = balance + delta di dalam transaksi pemanggil (tanpa baca-ubah-tulis)"""
+    if delta:
+        cur.execute('UPDATE wallet SET balance = balance + ? WHERE user_id = ?', (delta, user_id))
+
+
+def add_transaction(user_id, student_id, trans_type, category, amount, description, date):
+    """Catat transaksi dan sesuaikan saldo wallet dalam satu commit; mengembalikan id transaksi"""
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('''
+            INSERT INTO transactions (user_id, student_id, type, category, amount, description, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, student_id, trans_type, category, amount, description, date))
+        trans_id = cur.lastrowid
+        _apply_wallet(cur, user_id, _wallet_amount(trans_type, amount))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return trans_id
+
+
+def pay_bill(bill_id, user_id, amount, date=None):
+    """Catat pembayaran tagihan: transaksi income + paid_amount + saldo wallet dalam satu commit.
+
+    Sisa tagihan dibaca setelah write lock diambil (BEGIN IMMEDIATE), seperti
+    allocate_payment. Raise ValueError bila tagihan sudah lunas atau nominal
+    melebihi sisa. Mengembalikan (transaction_id, bill) dengan bill sesudah pembayaran.
+    """
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        bill = cur.execute('''
+            SELECT student_id, title, status, amount - paid_amount as remaining FROM bills WHERE id = ?
+        ''', (bill_id,)).fetchone()
+        if not bill:
+            raise ValueError('Tagihan tidak ditemukan')
+        if bill['status'] == 'paid' or bill['remaining'] <= 0:
+            raise ValueError('Tagihan sudah lunas')
+        if amount <= 0 or amount > bill['remaining']:
+            raise ValueError(f"Nominal melebihi sisa tagihan (Rp {bill['remaining']:,.0f})".replace(',', '.'))
+        cur.execute('''
+            INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
+            VALUES (?, ?, 'income', 'Pembayaran Santri', ?, ?, ?, ?)
+        ''', (user_id, bill['student_id'], amount, bill['title'], date, bill_id))
+        trans_id = cur.lastrowid
+        _apply_bill_payment(cur, bill_id, amount)
+        _apply_wallet(cur, user_id, amount)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return trans_id, get_bill(bill_id)
+
+
+def allocate_payment(student_id, user_id, amount, bill_ids=None, date=None):
+    """Bagi satu setoran ke beberapa tagihan belum lunas milik santri.
+
+    Urutan default: jatuh tempo paling lama dulu (tanpa jatuh tempo paling
+    akhir). bill_ids membatasi sekaligus menentukan urutan prioritas.
+    Transaksi per tagihan, paid_amount/status, saldo wallet dan satu entri
+    history ditulis dalam satu commit. Sisa tagihan dibaca setelah write lock
+    diambil (BEGIN IMMEDIATE), jadi dua alokasi bersamaan tidak bisa membayar
+    lebih. Raise ValueError bila setoran melebihi sisa tagihan. Mengembalikan
+    list alokasi {bill_id, title, amount, remaining, transaction_id}.
+    """
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    allocations = []
+    left = amount
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        bills = cur.execute('''
+            SELECT id, title, amount - paid_amount as remaining
+            FROM bills
+            WHERE student_id = ? AND status = 'unpaid' AND amount > paid_amount
+            ORDER BY due_date IS NULL, due_date, created_at, id
+        ''', (student_id,)).fetchall()
+        if bill_ids:
+            by_id = {b['id']: b for b in bills}
+            bills = [by_id[bid] for bid in dict.fromkeys(bill_ids) if bid in by_id]
+        outstanding = sum(b['remaining'] for b in bills)
+        if amount <= 0 or not bills:
+            raise ValueError('Tidak ada tagihan yang bisa dibayar')
+        if amount > outstanding:
+            raise ValueError(f'Setoran melebihi sisa tagihan (Rp {outstanding:,.0f})'.replace(',', '.'))
+
+        for bill in bills:
+            if left <= 0:
+                break
+            portion = min(left, bill['remaining'])
+            cur.execute('''
+                INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
+                VALUES (?, ?, 'income', 'Pembayaran Santri', ?, ?, ?, ?)
+            ''', (user_id, student_id, portion, bill['title'], date, bill['id']))
+            allocations.append({'bill_id': bill['id'], 'title': bill['title'], 'amount': portion,
+                                'remaining': bill['remaining'] - portion, 'transaction_id': cur.lastrowid})
+            _apply_bill_payment(cur, bill['id'], portion)
+            left -= portion
+        _apply_wallet(cur, user_id, amount)
+        meta = json.dumps({'amount': amount, 'bills': [a['bill_id'] for a in allocations]})
+        cur.execute('''
+            INSERT INTO history (user_id, action, target_type, target_id, meta)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, 'allocate', 'student', student_id, meta))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return allocations
+
+
+def get_transactions_by_ids(user_id, transaction_ids):
+    """Transaksi milik user (dengan info santri dan tagihan) untuk kuitansi gabungan.
+
+    Raise ValueError bila ada id yang tidak ditemukan atau transaksi milik
+    lebih dari satu santri (kuitansi hanya mencetak satu data santri).
+    """
+    transaction_ids = list(dict.fromkeys(transaction_ids))
+    if not transaction_ids:
+        return []
+    placeholders = ','.join('?' * len(transaction_ids))
+    rows = query_db(f'''
+        SELECT t.*, s.name as student_name, s.nisn as student_nisn, s.kelas as student_kelas,
+               b.title as bill_title
+        FROM transactions t
+        LEFT JOIN students s ON t.student_id = s.id
+        LEFT JOIN bills b ON t.bill_id = b.id
+        WHERE t.user_id = ? AND t.id IN ({placeholders})
+        ORDER BY t.id
+    ''', [user_id] + transaction_ids)
+    if rows and len(rows) != len(transaction_ids):
+        raise ValueError('Sebagian transaksi tidak ditemukan')
+    if len({r['student_id'] for r in rows}) > 1:
+        raise ValueError('Kuitansi gabungan hanya untuk transaksi satu santri')
+    return rows
+
+
+def update_transaction(trans, student_id, trans_type, category, amount, description, date):
+    """Update transaksi; paid_amount tagihan tertaut dan saldo wallet ikut disesuaikan dalam commit yang sama"""
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('''
+            UPDATE transactions SET student_id = ?, type = ?, category = ?, amount = ?, description = ?, date = ?
+            WHERE id = ?
+        ''', (student_id, trans_type, category, amount, description, date, trans['id']))
+        new_linked = amount if trans['bill_id'] and trans_type == 'income' else 0
+        _apply_bill_payment(cur, trans['bill_id'], new_linked - _linked_amount(trans))
+        _apply_wallet(cur, trans['user_id'],
+                      _wallet_amount(trans_type, amount) - _wallet_amount(trans['type'], trans['amount']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def delete_transaction(trans):
+    """Hapus transaksi; paid_amount tagihan tertaut dan saldo wallet dikembalikan dalam commit yang sama"""
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('DELETE FROM transactions WHERE id = ?', (trans['id'],))
+        _apply_bill_payment(cur, trans['bill_id'], -_linked_amount(trans))
+        _apply_wallet(cur, trans['user_id'], -_wallet_amount(trans['type'], trans['amount']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
 
-def create_bill(student_id, title, amount, due_date=None, created_by=None):
+
+def reconcile_bill_paid_amounts():
+    """Hitung ulang bills.paid_amount dari tabel transactions.
+
+    Hanya baris yang selisih yang diupdate; tagihan yang ternyata sudah lunas
+    ditandai 'paid'. Mengembalikan jumlah tagihan yang dikoreksi.
+    """
+    db = get_db()
+    cur = db.cursor()
+    paid_sql = "(SELECT COALESCE(SUM(t.amount), 0) FROM transactions t WHERE t.bill_id = bills.id AND t.type = 'income')"
+    cur.execute(f'UPDATE bills SET paid_amount = {paid_sql} WHERE paid_amount != {paid_sql}')
+    fixed = cur.rowcount
+    cur.execute('''
+        UPDATE bills SET status = 'paid', paid_at = COALESCE(paid_at, CURRENT_TIMESTAMP)
+        WHERE paid_amount >= amount AND status != 'paid'
+    ''')
+    db.commit()
+    cur.close()
+    return max(fixed, 0)
+
+
+def create_bills_bulk(title, amount, due_date=None, created_by=None, target='students', class_id=None, student_ids=None):
+    """Buat tagihan untuk banyak santri sekaligus dengan satu commit.
+
+    target: 'all' (semua santri aktif), 'kelas' (santri aktif di class_id) atau
+    'students' (daftar student_ids). Satu entri history ringkasan ditulis dalam
+    transaksi yang sama. Mengembalikan jumlah tagihan yang dibuat.
+    """
+    db = get_db()
+    cur = db.cursor()
+    try:
+        if target == 'all':
+            cur.execute('''
+                INSERT INTO bills (student_id, title, amount, due_date, created_by)
+                SELECT id, ?, ?, ?, ? FROM students WHERE status = 'aktif'
+            ''', (title, amount, due_date, created_by))
+        elif target == 'kelas':
+            cur.execute('''
+                INSERT INTO bills (student_id, title, amount, due_date, created_by)
+                SELECT id, ?, ?, ?, ? FROM students WHERE status = 'aktif' AND class_id = ?
+            ''', (title, amount, due_date, created_by, class_id))
+        else:
+            cur.executemany('''
+                INSERT INTO bills (student_id, title, amount, due_date, created_by)
+                SELECT id, ?, ?, ?, ? FROM students WHERE id = ?
+            ''', ((title, amount, due_date, created_by, sid) for sid in dict.fromkeys(student_ids or [])))
+        created = cur.rowcount
+        if created > 0:
+            meta = json.dumps({'title': title, 'amount': amount, 'count': created,
+                               'target': target, 'class_id': class_id})
+            cur.execute('''
+                INSERT INTO history (user_id, action, target_type, target_id, meta)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (created_by, 'bulk_create', 'bill', None, meta))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return max(created, 0)
+
+
+### Recurring bill templates ###
+def ensure_bill_templates_table():
+    """Tabel template tagihan berulang + kolom template_id/period pada bills (aman dipanggil berulang)"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS bill_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            class_id INTEGER,
+            student_status TEXT DEFAULT 'aktif',
+            cadence TEXT NOT NULL DEFAULT 'monthly',
+            start_month INTEGER DEFAULT 1,
+            due_day INTEGER DEFAULT 10,
+            is_active INTEGER DEFAULT 1,
+            last_period TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(class_id) REFERENCES classes(id)
+        )
+    ''')
+    cur.execute("PRAGMA table_info(bills)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'template_id' not in columns:
+        cur.execute("ALTER TABLE bills ADD COLUMN template_id INTEGER")
+    if 'period' not in columns:
+        cur.execute("ALTER TABLE bills ADD COLUMN period TEXT")
+    # Satu tagihan per (template, santri, periode): generate ulang cukup INSERT OR IGNORE
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_bills_template_period
+        ON bills(template_id, student_id, period) WHERE template_id IS NOT NULL
+    ''')
+    db.commit()
+    cur.close()
+
+
+def get_bill_templates(active_only=False):
+    query = '''
+        SELECT t.*, c.name as class_name
+        FROM bill_templates t
+        LEFT JOIN classes c ON c.id = t.class_id
+    '''
+    if active_only:
+        query += ' WHERE t.is_active = 1'
+    return query_db(query + ' ORDER BY t.title')
+
+
+def get_bill_template(template_id):
+    return query_db('SELECT * FROM bill_templates WHERE id = ?', (template_id,), one=True)
+
+
+def create_bill_template(title, amount, cadence='monthly', due_day=10, class_id=None, student_status='aktif',
+                         start_month=1, created_by=None):
     return execute_db('''
-        INSERT INTO bills (student_id, title, amount, due_date, created_by) VALUES (?, ?, ?, ?, ?)
-    ''', (student_id, title, amount, due_date, created_by))
+        INSERT INTO bill_templates (title, amount, class_id, student_status, cadence, start_month, due_day, created_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (title, amount, class_id, student_status, cadence, start_month, due_day, created_by))
+
+
+def set_bill_template_active(template_id, is_active):
+    return execute_db('UPDATE bill_templates SET is_active = ? WHERE id = ?', (1 if is_active else 0, template_id))
+
+
+def delete_bill_template(template_id):
+    return execute_db('DELETE FROM bill_templates WHERE id = ?', (template_id,))
+
+
+def generate_template_bills(template, period, title, due_date, commit=True):
+    """Buat tagihan satu template untuk satu periode (idempoten lewat unique index).
+
+    Mengembalikan jumlah tagihan baru; santri yang sudah punya tagihan periode ini dilewati.
+    """
+    db = get_db()
+    query = '''
+        INSERT OR IGNORE INTO bills (student_id, title, amount, due_date, created_by, template_id, period)
+        SELECT id, ?, ?, ?, ?, ?, ? FROM students WHERE status = ?
+    '''
+    params = [title, template['amount'], due_date, template['created_by'], template['id'], period,
+              template['student_status'] or 'aktif']
+    if template['class_id']:
+        query += ' AND class_id = ?'
+        params.append(template['class_id'])
+    created = db.execute(query, params).rowcount
+    if created > 0:
+        db.execute('''
+            INSERT INTO history (user_id, action, target_type, target_id, meta)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (template['created_by'], 'generate', 'bill_template', template['id'],
+              json.dumps({'period': period, 'count': created})))
+    db.execute('UPDATE bill_templates SET last_period = ? WHERE id = ?', (period, template['id']))
+    if commit:
+        db.commit()
+    return max(created, 0)
 
 
 def get_all_bills():
@@ -433,13 +1481,18 @@ def get_all_bills():
 
 
 def get_bill(bill_id):
-    return query_db('SELECT * FROM bills WHERE id = ?', (bill_id,), one=True)
+    return query_db('SELECT *, MAX(amount - paid_amount, 0) as remaining FROM bills WHERE id = ?', (bill_id,), one=True)
 
 
-def update_bill(bill_id, student_id, title, amount, due_date, status):
+def update_bill(bill_id, student_id, title, amount, due_date):
+    """Ubah data tagihan; status dan paid_at diturunkan dari paid_amount terhadap nominal baru"""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     return execute_db('''
-        UPDATE bills SET student_id = ?, title = ?, amount = ?, due_date = ?, status = ? WHERE id = ?
-    ''', (student_id, title, amount, due_date, status, bill_id))
+        UPDATE bills SET student_id = ?, title = ?, amount = ?, due_date = ?,
+            status = CASE WHEN paid_amount >= ? THEN 'paid' ELSE 'unpaid' END,
+            paid_at = CASE WHEN paid_amount >= ? THEN COALESCE(paid_at, ?) ELSE NULL END
+        WHERE id = ?
+    ''', (student_id, title, amount, due_date, amount, amount, now, bill_id))
 
 
 def delete_bill(bill_id):
@@ -453,7 +1506,10 @@ def mark_bill_paid(bill_id, paid_at=None):
 
 
 def get_student_bills(student_id):
-    return query_db('SELECT * FROM bills WHERE student_id = ? ORDER BY created_at DESC', (student_id,))
+    return query_db('''
+        SELECT *, MAX(amount - paid_amount, 0) as remaining
+        FROM bills WHERE student_id = ? ORDER BY created_at DESC
+    ''', (student_id,))
 
 
 def get_unpaid_bills_count():
@@ -461,46 +1517,753 @@ def get_unpaid_bills_count():
     return row['total'] if row else 0
 
 
-def get_student_unpaid_amount(student_id):
-    """Hitung total kekurangan pembayaran per santri"""
-    row = query_db('SELECT COALESCE(SUM(amount), 0) as total FROM bills WHERE student_id = ? AND status = "unpaid"', (student_id,), one=True)
-    return row['total'] if row else 0
+def get_unpaid_amounts(student_ids):
+    """Sisa tunggakan (amount - paid_amount) untuk sekumpulan santri dalam satu query, hasil {student_id: total}"""
+    student_ids = list(student_ids)
+    if not student_ids:
+        return {}
+    placeholders = ','.join('?' * len(student_ids))
+    rows = query_db(f'''
+        SELECT student_id, COALESCE(SUM(amount - paid_amount), 0) as total
+        FROM bills
+        WHERE status = 'unpaid' AND student_id IN ({placeholders})
+        GROUP BY student_id
+    ''', student_ids)
+    return {r['student_id']: r['total'] for r in rows}
 
 
 def get_bill_stats_by_class():
-    """Mengambil total tunggakan per kelas"""
+    """Mengambil sisa tunggakan (amount - paid_amount) per kelas"""
     return query_db('''
-        SELECT s.kelas, SUM(b.amount) as total_unpaid
+        SELECT t.class_id, COALESCE(c.name, '-') as kelas, t.total_unpaid
+        FROM (
+            SELECT s.class_id, SUM(b.amount - b.paid_amount) as total_unpaid
+            FROM bills b
+            JOIN students s ON b.student_id = s.id
+            WHERE b.status = 'unpaid'
+            GROUP BY s.class_id
+        ) t
+        LEFT JOIN classes c ON c.id = t.class_id
+        ORDER BY t.total_unpaid DESC
+    ''')
+
+### Idempotency keys ###
+def ensure_idempotency_table():
+    """Tabel kunci idempotensi; unik per (kunci, path, user) agar satu kunci tidak menulis dua kali"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT NOT NULL,
+            request_path TEXT NOT NULL,
+            user_id INTEGER,
+            response TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Kunci dipilih klien (header Idempotency-Key): user ikut di index agar respons user lain tidak bisa diputar ulang
+    cur.execute('DROP INDEX IF EXISTS idx_idempotency_key_path')
+    cur.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_idempotency_key_user_path
+        ON idempotency_keys(idem_key, request_path, IFNULL(user_id, 0))
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys(created_at)')
+    db.commit()
+    cur.close()
+
+
+IDEMPOTENCY_MATCH_SQL = 'idem_key = ? AND request_path = ? AND IFNULL(user_id, 0) = IFNULL(?, 0)'
+
+
+def claim_idempotency_key(key, path, user_id=None, ttl_hours=24, claim_timeout=60):
+    """Klaim kunci sebelum view menulis apa pun.
+
+    Hasil (True, None) bila kunci baru; (False, response) bila sudah pernah
+    dipakai, dengan response None selama permintaan pertama belum selesai.
+    Klaim tanpa respons yang lebih tua dari claim_timeout detik (proses mati
+    di tengah permintaan) dianggap batal sehingga kiriman ulang bisa diproses.
+    """
+    db = get_db()
+    try:
+        db.execute("DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)", (f'-{ttl_hours} hours',))
+        db.execute(f"""
+            DELETE FROM idempotency_keys
+            WHERE {IDEMPOTENCY_MATCH_SQL} AND response IS NULL AND created_at < datetime('now', ?)
+        """, (key, path, user_id, f'-{claim_timeout} seconds'))
+        db.execute('INSERT INTO idempotency_keys (idem_key, request_path, user_id) VALUES (?, ?, ?)',
+                   (key, path, user_id))
+        db.commit()
+        return True, None
+    except sqlite3.IntegrityError:
+        db.rollback()
+        row = query_db(f'SELECT response FROM idempotency_keys WHERE {IDEMPOTENCY_MATCH_SQL}',
+                       (key, path, user_id), one=True)
+        return False, row['response'] if row else None
+
+
+def complete_idempotency_key(key, path, user_id, response):
+    execute_db(f'UPDATE idempotency_keys SET response = ? WHERE {IDEMPOTENCY_MATCH_SQL}',
+               (response, key, path, user_id))
+
+
+def release_idempotency_key(key, path, user_id):
+    """Lepas kunci bila permintaan gagal/tidak menulis, sehingga boleh dikirim ulang"""
+    get_db().rollback()
+    execute_db(f'DELETE FROM idempotency_keys WHERE {IDEMPOTENCY_MATCH_SQL}', (key, path, user_id))
+
+
+### Student x month payment matrix ###
+# Bulan tagihan: period (template) atau bulan jatuh tempo / tanggal dibuat
+BILL_MONTH_SQL = "COALESCE(b.period, substr(COALESCE(b.due_date, b.created_at), 1, 7))"
+
+
+def _payment_matrix_query(year, class_id=None, paged=False):
+    """SQL pivot 12 bulan; santri dipilih (dan dipaging) dulu, tagihan diambil lewat index student_id"""
+    columns = []
+    for idx in range(1, 13):
+        month = f'{year}-{idx:02d}'
+        columns.append(f"SUM(CASE WHEN bm.month = '{month}' THEN bm.amount END) as billed_{idx:02d}")
+        columns.append(f"SUM(CASE WHEN bm.month = '{month}' THEN bm.outstanding END) as outstanding_{idx:02d}")
+        columns.append(f"SUM(CASE WHEN bm.month = '{month}' THEN bm.paid_amount END) as paid_{idx:02d}")
+    where, params = "WHERE st.status = 'aktif'", []
+    if class_id:
+        where += ' AND st.class_id = ?'
+        params.append(class_id)
+    sql = f'''
+        SELECT s.id, s.name, s.nisn, s.kelas,
+               {', '.join(columns)}
+        FROM (
+            SELECT st.id, st.name, st.nisn, COALESCE(c.name, '-') as kelas
+            FROM students st
+            LEFT JOIN classes c ON c.id = st.class_id
+            {where}
+            ORDER BY kelas, st.name
+            {'LIMIT ? OFFSET ?' if paged else ''}
+        ) s
+        LEFT JOIN (
+            SELECT b.student_id, {BILL_MONTH_SQL} as month, b.amount, b.paid_amount,
+                   CASE WHEN b.status = 'unpaid' THEN MAX(b.amount - b.paid_amount, 0) ELSE 0 END as outstanding
+            FROM bills b
+        ) bm ON bm.student_id = s.id AND bm.month LIKE ?
+        GROUP BY s.id
+        ORDER BY s.kelas, s.name
+    '''
+    return sql, params, [f'{year}-%']
+
+
+def matrix_cells(row):
+    """Ubah satu baris matrix menjadi 12 sel {status, billed, paid, outstanding}.
+
+    status: None (tidak ada tagihan), 'paid', 'partial' atau 'unpaid'.
+    """
+    cells = []
+    for idx in range(1, 13):
+        billed = row[f'billed_{idx:02d}']
+        outstanding = row[f'outstanding_{idx:02d}'] or 0
+        paid = row[f'paid_{idx:02d}'] or 0
+        if billed is None:
+            status = None
+        elif outstanding <= 0:
+            status = 'paid'
+        elif paid > 0:
+            status = 'partial'
+        else:
+            status = 'unpaid'
+        cells.append({'status': status, 'billed': billed or 0, 'paid': paid, 'outstanding': outstanding})
+    return cells
+
+
+def get_payment_matrix(year, class_id=None, page=1, per_page=50):
+    """Satu halaman matrix santri x bulan dari satu query agregat, hasil (rows, total_rows)"""
+    sql, params, join_params = _payment_matrix_query(year, class_id, paged=True)
+    rows = query_db(sql, params + [per_page, (max(page, 1) - 1) * per_page] + join_params)
+    count_sql = "SELECT COUNT(*) as total FROM students st WHERE st.status = 'aktif'"
+    if class_id:
+        count_sql += ' AND st.class_id = ?'
+    total = query_db(count_sql, params, one=True)['total']
+    return rows, total
+
+
+def iter_payment_matrix(year, class_id=None, batch_size=500):
+    """Semua baris matrix langsung dari cursor (untuk export streaming)"""
+    sql, params, join_params = _payment_matrix_query(year, class_id)
+    cursor = get_db().cursor()
+    try:
+        cursor.execute(sql, params + join_params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
+### Per-class payment grid ###
+def get_class_bill_titles(class_id):
+    """Judul tagihan yang masih terbuka di satu kelas, beserta jumlah santri"""
+    return query_db('''
+        SELECT b.title, COUNT(*) as bill_count, SUM(b.amount - b.paid_amount) as remaining
         FROM bills b
-        JOIN students s ON b.student_id = s.id
-        WHERE b.status = 'unpaid'
-        GROUP BY s.kelas
-        ORDER BY total_unpaid DESC
+        JOIN students s ON s.id = b.student_id
+        WHERE s.class_id = ? AND b.status = 'unpaid'
+        GROUP BY b.title
+        ORDER BY MIN(COALESCE(b.due_date, b.created_at)), b.title
+    ''', (class_id,))
+
+
+def get_class_bill_grid(class_id, title):
+    """Baris grid: semua santri aktif di kelas + tagihan terbuka berjudul title (bila ada)"""
+    return query_db('''
+        SELECT s.id as student_id, s.name, s.nisn,
+               b.id as bill_id, b.amount, b.paid_amount, b.amount - b.paid_amount as remaining
+        FROM students s
+        LEFT JOIN bills b ON b.student_id = s.id AND b.title = ? AND b.status = 'unpaid'
+        WHERE s.class_id = ? AND s.status = 'aktif'
+        ORDER BY s.name, b.id
+    ''', (title, class_id))
+
+
+def post_class_payments(class_id, entries, user_id, date=None):
+    """Posting pembayaran grid kelas: entries {bill_id: amount}.
+
+    Sisa tagihan dibaca setelah write lock diambil (BEGIN IMMEDIATE), seperti
+    allocate_payment. Semua baris divalidasi dulu (tagihan terbuka milik
+    santri di kelas ini, nominal tidak melebihi sisa); bila ada yang salah
+    tidak ada yang ditulis dan hasilnya (0, {bill_id: pesan}). Bila valid,
+    semua transaksi, paid_amount, satu delta saldo wallet dan satu entri
+    history ditulis dalam satu commit; hasilnya (total, {}).
+    """
+    entries = {bid: amt for bid, amt in entries.items() if amt}
+    if not entries:
+        return 0, {}
+    placeholders = ','.join('?' * len(entries))
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    total = sum(entries.values())
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        bills = {b['id']: b for b in cur.execute(f'''
+            SELECT b.id, b.student_id, b.title, b.status, b.amount - b.paid_amount as remaining, s.class_id
+            FROM bills b
+            JOIN students s ON s.id = b.student_id
+            WHERE b.id IN ({placeholders})
+        ''', list(entries)).fetchall()}
+
+        errors = {}
+        for bill_id, amount in entries.items():
+            bill = bills.get(bill_id)
+            if not bill or bill['class_id'] != class_id or bill['status'] != 'unpaid':
+                errors[bill_id] = 'Tagihan tidak valid untuk kelas ini'
+            elif amount < 0:
+                errors[bill_id] = 'Nominal tidak boleh negatif'
+            elif amount > bill['remaining']:
+                errors[bill_id] = f"Melebihi sisa tagihan (Rp {bill['remaining']:,.0f})".replace(',', '.')
+        if errors:
+            db.rollback()
+            return 0, errors
+
+        for bill_id, amount in entries.items():
+            bill = bills[bill_id]
+            cur.execute('''
+                INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
+                VALUES (?, ?, 'income', 'Pembayaran Santri', ?, ?, ?, ?)
+            ''', (user_id, bill['student_id'], amount, bill['title'], date, bill_id))
+            _apply_bill_payment(cur, bill_id, amount)
+        _apply_wallet(cur, user_id, total)
+        meta = json.dumps({'class_id': class_id, 'count': len(entries), 'amount': total})
+        cur.execute('''
+            INSERT INTO history (user_id, action, target_type, target_id, meta)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, 'bulk_pay', 'class', class_id, meta))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return total, {}
+
+
+### Bank statement import / reconciliation ###
+def ensure_statement_tables():
+    """Tabel impor mutasi bank + baris mutasi (antrian review untuk yang tidak cocok)"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS statement_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            line_count INTEGER DEFAULT 0,
+            matched_count INTEGER DEFAULT 0,
+            duplicate_count INTEGER DEFAULT 0,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS statement_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            line_no INTEGER,
+            trx_date TEXT,
+            description TEXT,
+            reference TEXT,
+            amount INTEGER NOT NULL,
+            nisn TEXT,
+            status TEXT DEFAULT 'unmatched',
+            bill_id INTEGER,
+            transaction_id INTEGER,
+            line_hash TEXT NOT NULL UNIQUE,
+            FOREIGN KEY(import_id) REFERENCES statement_imports(id)
+        )
     ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_statement_lines_status ON statement_lines(status, import_id)')
+    db.commit()
+    cur.close()
 
-def get_bill_total_paid(bill_id):
-    """Hitung total yang sudah dibayar untuk satu tagihan"""
-    row = query_db('SELECT COALESCE(SUM(amount), 0) as total FROM transactions WHERE bill_id = ? AND type = "income"', (bill_id,), one=True)
-    return row['total'] if row else 0
 
-def get_summarized_student_bills():
-    """Mendapatkan daftar santri yang memiliki tagihan dengan ringkasan totalnya"""
+def _open_bill_index():
+    """Index tagihan terbuka {(sisa, nisn): [bill, ...]} urut jatuh tempo terlama, plus {nisn: student_id}"""
+    rows = query_db('''
+        SELECT b.id, b.student_id, b.title, b.amount - b.paid_amount as remaining, s.nisn
+        FROM bills b
+        JOIN students s ON s.id = b.student_id
+        WHERE b.status = 'unpaid' AND b.amount > b.paid_amount AND s.nisn IS NOT NULL AND s.nisn != ''
+        ORDER BY b.due_date IS NULL, b.due_date, b.created_at, b.id
+    ''')
+    index, students = {}, {}
+    for r in rows:
+        index.setdefault((r['remaining'], r['nisn']), []).append(dict(r))
+        students[r['nisn']] = r['student_id']
+    return index, students
+
+
+def _match_nisn(runs, known_nisn, lengths):
+    """NISN dari deretan angka: sama persis, atau akhiran nomor virtual account (prefix bank + NISN)"""
+    for run in runs:
+        if run in known_nisn:
+            return run
+    for run in runs:
+        for n in lengths:
+            if len(run) > n and run[-n:] in known_nisn:
+                return run[-n:]
+    return None
+
+
+def _post_statement_payment(cur, line_id, bill, amount, trx_date, user_id):
+    cur.execute('''
+        INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
+        VALUES (?, ?, 'income', 'Pembayaran Santri', ?, ?, ?, ?)
+    ''', (user_id, bill['student_id'], amount, f"{bill['title']} (transfer)", trx_date, bill['id']))
+    trans_id = cur.lastrowid
+    _apply_bill_payment(cur, bill['id'], amount)
+    cur.execute('''
+        UPDATE statement_lines SET status = 'posted', bill_id = ?, transaction_id = ?
+        WHERE id = ? AND status = 'unmatched'
+    ''', (bill['id'], trans_id, line_id))
+    if cur.rowcount != 1:
+        raise ValueError('Baris mutasi sudah diproses')
+    return trans_id
+
+
+def import_statement(rows, filename, user_id, batch_size=200):
+    """Impor baris mutasi dan posting otomatis yang cocok.
+
+    Tagihan terbuka di-index berdasarkan (sisa tagihan, NISN); tiap baris
+    dicocokkan lewat lookup dict. Baris yang cocok langsung menjadi
+    transaksi + paid_amount + saldo wallet, satu commit per batch. Index
+    dibangun ulang di awal setiap batch setelah write lock diambil (BEGIN
+    IMMEDIATE), jadi pembayaran kasir/alokasi di antara batch ikut terlihat
+    dan tagihan tidak dibayar dua kali. Baris yang tidak cocok masuk antrian
+    review. Baris yang sudah pernah diimpor (line_hash sama) dilewati.
+
+    Bila terjadi error di tengah file, batch yang sudah di-commit tetap
+    tersimpan: jumlahnya dicatat di statement_imports + history (partial)
+    dan StatementError menyebutkan berapa baris yang sudah masuk.
+    """
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('INSERT INTO statement_imports (filename, created_by) VALUES (?, ?)', (filename, user_id))
+    import_id = cur.lastrowid
+    db.commit()
+
+    summary = {'import_id': import_id, 'lines': 0, 'matched': 0, 'duplicates': 0, 'posted_amount': 0}
+    committed = dict(summary)
+    pending, wallet_delta = 0, 0
+    index = None
+    try:
+        for row in rows:
+            if index is None:
+                cur.execute('BEGIN IMMEDIATE')
+                index, students = _open_bill_index()
+                known_nisn = set(students)
+                lengths = sorted({len(n) for n in known_nisn}, reverse=True)
+            nisn = _match_nisn(digit_runs(row['reference'], row['description']), known_nisn, lengths)
+            cur.execute('''
+                INSERT OR IGNORE INTO statement_lines
+                    (import_id, line_no, trx_date, description, reference, amount, nisn, line_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (import_id, row['line_no'], row['date'], row['description'], row['reference'],
+                  row['amount'], nisn, row['line_hash']))
+            if cur.rowcount == 0:
+                summary['duplicates'] += 1
+                continue
+            summary['lines'] += 1
+            candidates = index.get((row['amount'], nisn)) if nisn else None
+            if candidates:
+                # Tagihan yang sudah terpakai dikeluarkan dari index agar tidak dibayar dua kali
+                bill = candidates.pop(0)
+                _post_statement_payment(cur, cur.lastrowid, bill, row['amount'], row['date'], user_id)
+                summary['matched'] += 1
+                summary['posted_amount'] += row['amount']
+                wallet_delta += row['amount']
+            pending += 1
+            if pending >= batch_size:
+                _apply_wallet(cur, user_id, wallet_delta)
+                _record_statement_import(cur, import_id, user_id, summary)
+                db.commit()
+                committed = dict(summary)
+                pending, wallet_delta, index = 0, 0, None
+        _apply_wallet(cur, user_id, wallet_delta)
+        _record_statement_import(cur, import_id, user_id, summary, final=True)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        committed['error'] = str(e)
+        _record_statement_import(cur, import_id, user_id, committed, final=True)
+        db.commit()
+        raise StatementError(f"{str(e)} ({committed['lines']} baris sebelum error sudah tersimpan, "
+                             f"{committed['matched']} di antaranya diposting)") from e
+    finally:
+        cur.close()
+    return summary
+
+
+def _record_statement_import(cur, import_id, user_id, summary, final=False):
+    """Simpan hitungan impor; final=True juga mencatat history (dengan 'error' bila impor terhenti)"""
+    cur.execute('''
+        UPDATE statement_imports SET line_count = ?, matched_count = ?, duplicate_count = ? WHERE id = ?
+    ''', (summary['lines'], summary['matched'], summary['duplicates'], import_id))
+    if final:
+        cur.execute('''
+            INSERT INTO history (user_id, action, target_type, target_id, meta)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, 'import', 'statement', import_id, json.dumps(summary)))
+
+
+def get_statement_imports(limit=20):
+    return query_db('SELECT * FROM statement_imports ORDER BY id DESC LIMIT ?', (limit,))
+
+
+def get_unmatched_statement_lines(limit=200):
+    """Antrian review: baris mutasi yang belum cocok, dengan santri hasil deteksi NISN bila ada"""
     return query_db('''
-        SELECT 
-            s.id, 
-            s.name, 
-            s.nisn, 
+        SELECT l.*, s.id as student_id, s.name as student_name
+        FROM statement_lines l
+        LEFT JOIN students s ON s.nisn = l.nisn
+        WHERE l.status = 'unmatched'
+        ORDER BY l.import_id DESC, l.line_no
+        LIMIT ?
+    ''', (limit,))
+
+
+def resolve_statement_line(line_id, bill_id, user_id):
+    """Cocokkan manual satu baris mutasi ke tagihan; transaksi, paid_amount, wallet dalam satu commit.
+
+    Baris dan tagihan dibaca ulang setelah write lock diambil (BEGIN IMMEDIATE),
+    jadi dua resolve bersamaan tidak memposting baris yang sama dua kali.
+    Nominal mutasi tidak boleh melebihi sisa tagihan.
+    """
+    db = get_db()
+    cur = db.cursor()
+    try:
+        cur.execute('BEGIN IMMEDIATE')
+        line = cur.execute('SELECT * FROM statement_lines WHERE id = ?', (line_id,)).fetchone()
+        bill = cur.execute('SELECT * FROM bills WHERE id = ?', (bill_id,)).fetchone()
+        if not line or line['status'] != 'unmatched' or not bill or bill['status'] != 'unpaid':
+            raise ValueError('Baris mutasi atau tagihan tidak valid')
+        remaining = bill['amount'] - (bill['paid_amount'] or 0)
+        if line['amount'] > remaining:
+            raise ValueError(f"Nominal mutasi Rp {line['amount']:,} melebihi sisa tagihan Rp {remaining:,}".replace(',', '.'))
+        trans_id = _post_statement_payment(cur, line_id, bill, line['amount'], line['trx_date'], user_id)
+        _apply_wallet(cur, user_id, line['amount'])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return trans_id
+
+
+def ignore_statement_line(line_id):
+    """Tandai baris mutasi bukan pembayaran santri (keluar dari antrian review)"""
+    return execute_db("UPDATE statement_lines SET status = 'ignored' WHERE id = ? AND status = 'unmatched'", (line_id,))
+
+
+### Data version stamps ###
+# Tabel yang diberi trigger penghitung versi; laporan ber-cache membandingkan stamp ini
+VERSIONED_TABLES = ('bills', 'transactions', 'students', 'wallet', 'classes', 'settings')
+
+
+def ensure_data_versions():
+    """Tabel data_versions + trigger yang menaikkan versi setiap INSERT/UPDATE/DELETE"""
+    db = get_db()
+    cur = db.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in VERSIONED_TABLES:
+        cur.execute('INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)', (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            ''')
+    db.commit()
+    cur.close()
+
+
+def get_data_version(*tables):
+    """Stamp versi (tuple) untuk tabel-tabel yang diminta, plus path database"""
+    tables = tables or VERSIONED_TABLES
+    placeholders = ','.join('?' * len(tables))
+    rows = query_db(f'SELECT name, version FROM data_versions WHERE name IN ({placeholders})', tables)
+    versions = {r['name']: r['version'] for r in rows}
+    return (database_path(),) + tuple(versions.get(t) for t in tables)
+
+
+### Settings ###
+# Skema pengaturan: key -> (tipe, default)
+SETTINGS_SCHEMA = {
+    'pondok_name': (str, 'Pondok Pesantren Al Huda'),
+    'system_currency': (str, 'IDR'),
+}
+SETTINGS_CHECK_INTERVAL = 5  # detik antar pengecekan versi settings lintas proses
+
+_settings_cache = {}  # path database -> {'version', 'values', 'checked'}
+_settings_lock = threading.Lock()
+
+
+def _coerce_setting(key, value):
+    kind, default = SETTINGS_SCHEMA.get(key, (str, None))
+    if value is None:
+        return default
+    if kind is bool:
+        return str(value).strip().lower() in ('1', 'true', 'yes', 'ya', 'on')
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _settings_version():
+    row = query_db("SELECT version FROM data_versions WHERE name = 'settings'", one=True)
+    return row['version'] if row else None
+
+
+def _load_settings():
+    values = {key: default for key, (kind, default) in SETTINGS_SCHEMA.items()}
+    for row in query_db('SELECT key, value FROM settings'):
+        values[row['key']] = _coerce_setting(row['key'], row['value'])
+    return MappingProxyType(values)
+
+
+def _store_settings(path, version, values, checked):
+    with _settings_lock:
+        _settings_cache[path] = {'version': version, 'values': values, 'checked': checked}
+
+
+def get_settings():
+    """Semua pengaturan (sudah bertipe, read-only) dari cache proses.
+
+    Versi 'settings' di data_versions dicek paling sering sekali per
+    SETTINGS_CHECK_INTERVAL detik; tabel settings hanya dibaca ulang bila
+    versinya berubah (misalnya ditulis proses worker lain).
+    """
+    path = database_path()
+    now = time.monotonic()
+    with _settings_lock:
+        entry = _settings_cache.get(path)
+    if entry and now - entry['checked'] < SETTINGS_CHECK_INTERVAL:
+        return entry['values']
+    version = _settings_version()
+    if entry and version is not None and entry['version'] == version:
+        values = entry['values']
+    else:
+        values = _load_settings()
+    _store_settings(path, version, values, now)
+    return values
+
+
+def get_setting(key, default=None):
+    value = get_settings().get(key)
+    return default if value is None else value
+
+
+def set_settings(values):
+    """Simpan pengaturan (write-through): tabel dan cache proses diperbarui sekaligus"""
+    unknown = sorted(set(values) - set(SETTINGS_SCHEMA))
+    if unknown:
+        raise ValueError(f"Pengaturan tidak dikenal: {', '.join(unknown)}")
+    db = get_db()
+    cur = db.cursor()
+    try:
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = '1' if value else '0'
+            cur.execute('''
+                INSERT INTO settings (key, value) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            ''', (key, None if value is None else str(value)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    _store_settings(database_path(), _settings_version(), _load_settings(), time.monotonic())
+    return get_settings()
+
+
+# Batas bucket umur tunggakan (hari lewat jatuh tempo)
+AGING_BUCKETS = (
+    ('current', 'Belum Jatuh Tempo'),
+    ('d0_30', '0-30 Hari'),
+    ('d31_60', '31-60 Hari'),
+    ('d61_90', '61-90 Hari'),
+    ('d90_plus', '> 90 Hari'),
+)
+
+_aging_cache = VersionedCache(maxsize=16)
+
+
+def _compute_arrears_aging(as_of, class_id=None):
+    where, params = '', [as_of]
+    if class_id:
+        where = 'AND s.class_id = ?'
+        params.append(class_id)
+    # Bills tanpa due_date dihitung jatuh tempo sejak tanggal dibuat
+    rows = query_db(f'''
+        WITH overdue AS (
+            SELECT b.student_id,
+                   b.amount - b.paid_amount as remaining,
+                   CAST(julianday(?) - julianday(COALESCE(b.due_date, date(b.created_at))) AS INTEGER) as days
+            FROM bills b
+            WHERE b.status = 'unpaid' AND b.amount > b.paid_amount
+        ),
+        per_student AS (
+            SELECT s.id as student_id, s.name, s.nisn, s.class_id, COALESCE(c.name, '-') as kelas,
+                   COUNT(*) as bill_count,
+                   MAX(o.days) as max_days,
+                   SUM(CASE WHEN o.days < 0 THEN o.remaining ELSE 0 END) as current,
+                   SUM(CASE WHEN o.days BETWEEN 0 AND 30 THEN o.remaining ELSE 0 END) as d0_30,
+                   SUM(CASE WHEN o.days BETWEEN 31 AND 60 THEN o.remaining ELSE 0 END) as d31_60,
+                   SUM(CASE WHEN o.days BETWEEN 61 AND 90 THEN o.remaining ELSE 0 END) as d61_90,
+                   SUM(CASE WHEN o.days > 90 THEN o.remaining ELSE 0 END) as d90_plus,
+                   SUM(o.remaining) as total
+            FROM overdue o
+            JOIN students s ON s.id = o.student_id
+            LEFT JOIN classes c ON c.id = s.class_id
+            WHERE 1 = 1 {where}
+            GROUP BY s.id
+        )
+        SELECT p.*,
+               COUNT(*) OVER w as class_students,
+               SUM(current) OVER w as class_current,
+               SUM(d0_30) OVER w as class_d0_30,
+               SUM(d31_60) OVER w as class_d31_60,
+               SUM(d61_90) OVER w as class_d61_90,
+               SUM(d90_plus) OVER w as class_d90_plus,
+               SUM(total) OVER w as class_total
+        FROM per_student p
+        WINDOW w AS (PARTITION BY class_id)
+        ORDER BY kelas, class_id, total DESC, name
+    ''', params)
+
+    keys = [k for k, _ in AGING_BUCKETS]
+    students, classes = [], []
+    totals = dict.fromkeys(keys + ['total'], 0)
+    for r in rows:
+        students.append({k: r[k] for k in ('student_id', 'name', 'nisn', 'kelas', 'bill_count', 'max_days',
+                                           'total', *keys)})
+        if not classes or classes[-1]['class_id'] != r['class_id']:
+            classes.append({'class_id': r['class_id'], 'kelas': r['kelas'], 'students': r['class_students'],
+                            'total': r['class_total'], **{k: r[f'class_{k}'] for k in keys}})
+            for k in keys + ['total']:
+                totals[k] += r[f'class_{k}']
+    return {'as_of': as_of, 'students': students, 'classes': classes, 'totals': totals}
+
+
+def get_arrears_aging(as_of=None, class_id=None):
+    """Laporan umur tunggakan per santri dan per kelas dalam satu query (window per kelas).
+
+    Hasil di-cache selama versi data bills/students tidak berubah; tanggal
+    acuan ikut menjadi bagian kunci karena umur tunggakan bertambah tiap hari.
+    """
+    as_of = as_of or datetime.now().strftime('%Y-%m-%d')
+    version = get_data_version('bills', 'students')
+    return _aging_cache.get_or_compute((as_of, class_id), version,
+                                       lambda: _compute_arrears_aging(as_of, class_id))
+
+
+def get_bill_total_paid(bill_id):
+    """Total yang sudah dibayar untuk satu tagihan (kolom paid_amount)"""
+    row = query_db('SELECT paid_amount FROM bills WHERE id = ?', (bill_id,), one=True)
+    return row['paid_amount'] if row else 0
+
+# Filter status ringkasan tagihan per santri -> kondisi HAVING
+SUMMARY_STATUS_FILTERS = {
+    'unpaid': 'remaining > 0 AND total_paid = 0',
+    'partial': 'remaining > 0 AND total_paid > 0',
+    'paid': 'remaining = 0',
+}
+
+
+def get_summarized_student_bills(class_id=None, status=None, page=1, per_page=50):
+    """Ringkasan tagihan per santri (satu halaman), hasil (rows, total_rows).
+
+    Agregat langsung dari kolom bills.paid_amount dalam satu GROUP BY; sisa
+    hanya dihitung dari tagihan berstatus 'unpaid'. status: 'unpaid' (belum
+    bayar), 'partial' (cicilan) atau 'paid' (lunas).
+    """
+    where, params = '', []
+    if class_id:
+        where = 'WHERE s.class_id = ?'
+        params.append(class_id)
+    having = f'HAVING {SUMMARY_STATUS_FILTERS[status]}' if status in SUMMARY_STATUS_FILTERS else ''
+    params += [per_page, (max(page, 1) - 1) * per_page]
+    rows = query_db(f'''
+        SELECT
+            s.id,
+            s.name,
+            s.nisn,
             s.kelas,
             COUNT(b.id) as bill_count,
             SUM(b.amount) as total_amount,
-            (SELECT COALESCE(SUM(t.amount), 0) 
-             FROM transactions t 
-             WHERE t.student_id = s.id AND t.type = 'income' AND t.bill_id IS NOT NULL) as total_paid
+            SUM(b.paid_amount) as total_paid,
+            SUM(CASE WHEN b.status = 'unpaid' THEN MAX(b.amount - b.paid_amount, 0) ELSE 0 END) as remaining,
+            COUNT(*) OVER () as total_rows
         FROM students s
         JOIN bills b ON s.id = b.student_id
+        {where}
         GROUP BY s.id
+        {having}
         ORDER BY s.name ASC
-    ''')
+        LIMIT ? OFFSET ?
+    ''', params)
+    total = rows[0]['total_rows'] if rows else 0
+    return rows, total
 
 
 # ===== CATEGORY MANAGEMENT CRUD =====
@@ -0,0 +1,140 @@
+"""
+Arsip Riwayat (retensi) untuk PonPay
+Entri history yang lebih tua dari HISTORY_RETENTION_MONTHS dipindah ke file
+gzip NDJSON per bulan, sehingga tabel history live tetap kecil; arsip tetap
+bisa dicari lewat search_history_archive
+"""
+import glob
+import gzip
+import json
+import os
+import re
+from datetime import date, datetime, timedelta
+from flask import current_app
+from db import get_db, query_db, database_path, flush_history, history_cursor, shift_months
+
+ARCHIVE_PATTERN = re.compile(r'^history-(\d{4}-\d{2})\.ndjson\.gz$')
+
+
+def archive_dir(db_path=None):
+    """HISTORY_ARCHIVE_DIR (atau archive/ di samping database) / <nama database>"""
+    db_path = os.path.abspath(db_path or database_path())
+    root = current_app.config.get('HISTORY_ARCHIVE_DIR') or os.path.join(os.path.dirname(db_path), 'archive')
+    return os.path.join(root, os.path.splitext(os.path.basename(db_path))[0])
+
+
+def archive_file(month, db_path=None):
+    return os.path.join(archive_dir(db_path), f'history-{month}.ndjson.gz')
+
+
+def retention_cutoff(months=None, today=None):
+    """Awal bulan tertua yang tetap di tabel live: entri sebelum tanggal ini diarsipkan"""
+    months = months if months is not None else current_app.config.get('HISTORY_RETENTION_MONTHS', 12)
+    return shift_months((today or date.today()).replace(day=1), -months)
+
+
+def _read_partition(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _write_partition(path, entries):
+    """Tulis ulang satu partisi bulan lewat file sementara + rename (tidak pernah setengah jadi)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+    os.replace(tmp, path)
+
+
+def archive_history(months=None, today=None):
+    """Pindahkan entri lebih tua dari `months` bulan ke arsip bulanan; {bulan: jumlah entri}.
+
+    Per bulan: entri dibaca lewat idx_history_created, digabung dengan isi
+    partisi yang sudah ada (id yang sama dilewati, jadi aman diulang bila
+    proses sempat terhenti setelah file ditulis), file ditulis ulang, lalu
+    baris live dihapus dalam satu transaksi. Harus dipanggil di app context.
+    """
+    flush_history()
+    cutoff = retention_cutoff(months, today).strftime('%Y-%m-%d')
+    db = get_db()
+    months_found = [r['month'] for r in query_db('''
+        SELECT DISTINCT substr(created_at, 1, 7) as month FROM history
+        WHERE created_at < ? ORDER BY month
+    ''', (cutoff,))]
+    moved = {}
+    for month in months_found:
+        start = f'{month}-01'
+        end = min(shift_months(start, 1).strftime('%Y-%m-%d'), cutoff)
+        rows = query_db('''
+            SELECT h.id, h.user_id, u.username, h.action, h.target_type, h.target_id, h.meta, h.created_at
+            FROM history h
+            LEFT JOIN users u ON u.id = h.user_id
+            WHERE h.created_at >= ? AND h.created_at < ?
+            ORDER BY h.created_at, h.id
+        ''', (start, end))
+        if not rows:
+            continue
+        path = archive_file(month)
+        existing = _read_partition(path) if os.path.exists(path) else []
+        known = {e['id'] for e in existing}
+        fresh = [dict(r) for r in rows if r['id'] not in known]
+        entries = sorted(existing + fresh, key=lambda e: (e['created_at'] or '', e['id']))
+        _write_partition(path, entries)
+        try:
+            db.execute('DELETE FROM history WHERE created_at >= ? AND created_at < ? AND id <= ?',
+                       (start, end, max(r['id'] for r in rows)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        moved[month] = len(rows)
+    return moved
+
+
+def get_history_archives(db_path=None):
+    """Daftar partisi arsip tenant aktif: [{'month', 'path', 'size'}], terbaru dulu"""
+    archives = []
+    for path in glob.glob(os.path.join(archive_dir(db_path), 'history-*.ndjson.gz')):
+        match = ARCHIVE_PATTERN.match(os.path.basename(path))
+        if match:
+            archives.append({'month': match.group(1), 'path': path, 'size': os.path.getsize(path)})
+    return sorted(archives, key=lambda a: a['month'], reverse=True)
+
+
+def search_history_archive(user_id=None, action=None, target_type=None, target_id=None,
+                           date_from=None, date_to=None, before=None, limit=50):
+    """Cari entri di arsip dengan filter yang sama seperti get_history_page (terbaru dulu).
+
+    Hanya partisi bulan dalam rentang tanggal yang dibuka; halaman berikutnya
+    lewat cursor `before` ('<created_at>~<id>', lihat history_cursor).
+    Mengembalikan {'entries', 'older', 'newer'} (newer selalu None).
+    """
+    date_to_next = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') if date_to else None
+    cursor = None
+    if before and '~' in before:
+        created_at, entry_id = before.rsplit('~', 1)
+        cursor = (created_at, int(entry_id)) if entry_id.isdigit() else None
+
+    def matches(e):
+        return ((not user_id or e['user_id'] == user_id)
+                and (not action or e['action'] == action)
+                and (not target_type or e['target_type'] == target_type)
+                and (not target_id or e['target_id'] == target_id)
+                and (not date_from or (e['created_at'] or '') >= date_from)
+                and (not date_to_next or (e['created_at'] or '') < date_to_next)
+                and (not cursor or ((e['created_at'] or ''), e['id']) < cursor))
+
+    entries = []
+    for archive in get_history_archives():
+        month = archive['month']
+        if (date_from and month < date_from[:7]) or (date_to and month > date_to[:7]) \
+                or (cursor and month > cursor[0][:7]):
+            continue
+        for entry in reversed(_read_partition(archive['path'])):
+            if matches(entry):
+                entries.append(entry)
+                if len(entries) > limit:
+                    return {'entries': entries[:limit], 'older': history_cursor(entries[limit - 1]), 'newer': None}
+    return {'entries': entries, 'older': None, 'newer': None}
@@ -0,0 +1,181 @@
+"""
+Penulis Riwayat (audit log) Asinkron untuk PonPay
+record_history tidak lagi commit sendiri di setiap request: entri masuk antrean
+dan ditulis per batch (satu transaksi untuk banyak entri) oleh thread latar belakang
+"""
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+INSERT_HISTORY_SQL = '''
+    INSERT INTO history (user_id, action, target_type, target_id, meta, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def history_timestamp():
+    """Format sama dengan CURRENT_TIMESTAMP SQLite (UTC), diambil saat aksi terjadi, bukan saat flush"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class HistoryWriter:
+    """Antrean riwayat berbatas + thread penulis batch.
+
+    Entri dikelompokkan per file database (tenant) lalu ditulis dengan
+    executemany dalam satu transaksi, jadi N aksi = 1 commit, bukan N.
+    Bila antrean penuh, pemanggil menulis sendiri secara sinkron (tidak ada
+    entri yang dibuang karena beban). Sisa antrean ditulis saat stop().
+    """
+
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._connections = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'batches': 0, 'max_batch': 0,
+                       'overflow': 0, 'failed': 0, 'last_flush_at': None, 'last_error': None}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._start_lock:
+            if self.running:
+                return self._thread
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='history-writer', daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def stop(self, timeout=10):
+        """Hentikan thread setelah seluruh antrean ditulis"""
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, database, row):
+        """Masukkan entri ke antrean; False bila penuh (pemanggil menulis sinkron)"""
+        try:
+            self._queue.put_nowait((database, row))
+        except queue.Full:
+            self._count(overflow=1)
+            return False
+        self._count(enqueued=1)
+        return True
+
+    def flush(self, timeout=5):
+        """Tunggu sampai entri yang sudah diantre tertulis (mis. sebelum menampilkan halaman riwayat)"""
+        deadline = time.monotonic() + timeout
+        while self.running and self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(running=self.running, queue_depth=self._queue.qsize(), queue_max=self._queue.maxsize,
+                     batch_size=self.batch_size, flush_interval=self.flush_interval)
+        return stats
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for key, delta in deltas.items():
+                self._stats[key] += delta
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+            elif self._stop.is_set():
+                break
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def _connection(self, database):
+        conn = self._connections.get(database)
+        if conn is None:
+            conn = self._connections[database] = sqlite3.connect(database, timeout=30)
+        return conn
+
+    def _write(self, batch):
+        grouped = {}
+        for database, row in batch:
+            grouped.setdefault(database, []).append(row)
+        for database, rows in grouped.items():
+            conn = self._connection(database)
+            try:
+                with conn:
+                    conn.executemany(INSERT_HISTORY_SQL, rows)
+            except sqlite3.Error as e:
+                self._count(failed=len(rows))
+                with self._stats_lock:
+                    self._stats['last_error'] = str(e)
+                logger.error(f"Gagal menulis {len(rows)} entri riwayat ke {database}: {str(e)}")
+                continue
+            with self._stats_lock:
+                self._stats['written'] += len(rows)
+                self._stats['batches'] += 1
+                self._stats['max_batch'] = max(self._stats['max_batch'], len(rows))
+                self._stats['last_flush_at'] = history_timestamp()
+
+
+writer = HistoryWriter()
+_atexit_registered = False
+
+
+def start_history_writer(app):
+    """Aktifkan penulisan riwayat per batch untuk proses ini; antrean dikosongkan saat proses berhenti"""
+    global _atexit_registered
+    writer._queue.maxsize = app.config.get('HISTORY_QUEUE_SIZE', writer._queue.maxsize)
+    writer.batch_size = app.config.get('HISTORY_BATCH_SIZE', writer.batch_size)
+    writer.flush_interval = app.config.get('HISTORY_FLUSH_INTERVAL', writer.flush_interval)
+    thread = writer.start()
+    if not _atexit_registered:
+        atexit.register(writer.stop)
+        _atexit_registered = True
+    return thread
+
+
+def ensure_history_writer(app):
+    """Start writer saat entri pertama dicatat (True bila aktif).
+
+    Dimulai secara lazy di proses yang benar-benar melayani request (reloader
+    child, `flask run --no-reload`, worker gunicorn setelah fork), bukan di
+    proses induk reloader. HISTORY_FLUSH_INTERVAL = 0 menonaktifkan batch.
+    """
+    if writer.running:
+        return True
+    if not app.config.get('HISTORY_FLUSH_INTERVAL'):
+        return False
+    start_history_writer(app)
+    return writer.running
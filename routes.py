@@ -2,20 +2,25 @@
 Routes/Blueprints untuk PonPay
 """
 from flask import Blueprint, render_template, request, redirect, url_for, g, session, send_file, current_app, flash, jsonify
-from db import (query_db, execute_db, get_dashboard_stats, get_monthly_stats, get_category_stats,
-                get_all_students, get_student, get_student_payments, get_student_payment_stats,
-                add_student, update_student, delete_student, record_history, get_history,
+from db import (query_db, execute_db, get_dashboard_stats, get_branch_summary, get_monthly_series, get_category_stats, get_settings, get_setting, set_settings,
+                get_all_students, iter_students, iter_student_payment_summary, get_student,
+                find_student_by_name, find_student_by_nisn, find_similar_students, search_students,
+                get_all_classes, get_class, rename_class, move_class_students, set_class_status, get_student_payments, get_student_payment_stats,
+                add_student, update_student, delete_student, record_history, flush_history, get_history_page, HISTORY_ACTIONS, HISTORY_TARGET_TYPES,
                 get_all_users, get_user, create_user, update_user, delete_user, set_user_password, get_user_by_username,
-                get_all_bills, create_bill, get_bill, update_bill, delete_bill, mark_bill_paid, get_student_unpaid_amount, get_bill_stats_by_class,
+                get_all_bills, create_bills_bulk, get_bill, get_student_bills,
+                get_bill_templates, get_bill_template, create_bill_template, set_bill_template_active, delete_bill_template, update_bill, delete_bill, pay_bill, allocate_payment, get_transactions_by_ids,
+                get_class_bill_titles, get_class_bill_grid, post_class_payments, get_payment_matrix, iter_payment_matrix, matrix_cells,
+                import_statement, get_statement_imports, get_unmatched_statement_lines, resolve_statement_line, ignore_statement_line, add_transaction, update_transaction, delete_transaction, get_unpaid_amounts, get_bill_stats_by_class, get_data_version, period_range, get_rollup_comparison, get_arrears_aging, AGING_BUCKETS,
                 get_all_categories, get_all_categories_admin, get_category, create_category, update_category, delete_category, ensure_categories_table)
 from werkzeug.security import check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
+import hashlib
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from io import BytesIO
 import os
-from fpdf import FPDF
 from werkzeug.utils import secure_filename
 from functools import wraps
 from utils.validation import (
@@ -25,6 +30,13 @@ from utils.validation import (
     validate_file_upload, validate_student_data, validate_transaction_data,
     validate_user_data, ValidationError, check_rate_limit, flash_validation_errors
 )
+from utils import excel
+from utils.idempotency import idempotent
+from utils.statements import iter_statement_rows, StatementError
+from utils.receipts import build_receipt_pdf
+from scheduler import run_scheduler_tick, CADENCE_MONTHS, MONTHS_ID
+from snapshot import reads_snapshot
+from tenants import DEFAULT_TENANT, TenantError, get_tenants, use_tenant, current_tenant, fan_out
 
 def _is_admin():
     return session.get('role') == 'admin'
@@ -55,14 +67,22 @@ auth_bp = Blueprint('auth', __name__)
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Halaman login"""
+    tenants = get_tenants()
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
+        # Setiap cabang punya database (dan daftar user) sendiri
+        tenant = request.form.get('tenant') or DEFAULT_TENANT
+        try:
+            use_tenant(tenant)
+        except TenantError:
+            return render_template('login.html', error='Cabang tidak ditemukan', tenants=tenants)
         user = get_user_by_username(username)
         if user:
             stored_pw = user['password']
             # Normal path: stored password is a hash
             if check_password_hash(stored_pw, password):
+                session['tenant'] = tenant
                 session['user_id'] = user['id']
                 session['username'] = user['username']
                 # sqlite3.Row does not implement .get(), so access safely
@@ -90,6 +110,7 @@ def login():
                     set_user_password(user['id'], password)
                 except Exception:
                     pass
+                session['tenant'] = tenant
                 session['user_id'] = user['id']
                 session['username'] = user['username']
                 try:
@@ -104,9 +125,9 @@ def login():
                 session['role'] = role
                 return redirect(url_for('dashboard.index'))
 
-        return render_template('login.html', error='Username atau password salah')
+        return render_template('login.html', error='Username atau password salah', tenants=tenants)
     
-    return render_template('login.html')
+    return render_template('login.html', tenants=tenants)
 
 @auth_bp.route('/logout')
 def logout():
@@ -123,37 +144,35 @@ def index():
     user_id = session.get('user_id', 1)
     
     stats = get_dashboard_stats(user_id)
-    monthly_data = get_monthly_stats(user_id, months=1)
-    
-    # Format data untuk Chart.js
-    months_list = []
-    income_data = []
-    expense_data = []
-    
-    today = datetime.now()
-    for i in range(11, -1, -1):
-        date = today - timedelta(days=30*i)
-        month_str = date.strftime('%Y-%m')
-        months_list.append(date.strftime('%b'))
-        
-        # Cari data untuk bulan ini
-        income = 0
-        expense = 0
-        for row in monthly_data:
-            if row['month'] == month_str:
-                if row['type'] == 'income':
-                    income = row['total']
-                else:
-                    expense = row['total']
-        
-        income_data.append(income)
-        expense_data.append(expense)
-    
+    series = get_monthly_series(user_id, months=12)
+
     return render_template('dashboard.html',
                          stats=stats,
-                         months=json.dumps(months_list),
-                         income_data=json.dumps(income_data),
-                         expense_data=json.dumps(expense_data))
+                         months=json.dumps(series['labels']),
+                         income_data=json.dumps(series['income']),
+                         expense_data=json.dumps(series['expense']))
+
+
+@dashboard_bp.route('/api/monthly-series')
+def monthly_series_api():
+    """Seri grafik bulanan (JSON): ?months=12, maksimal 36"""
+    user_id = session.get('user_id', 1)
+    months = min(max(request.args.get('months', 12, type=int) or 12, 1), 36)
+    response = jsonify(get_monthly_series(user_id, months=months))
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+@dashboard_bp.route('/consolidated')
+@admin_required
+def consolidated():
+    """Laporan gabungan semua cabang (khusus admin pusat); database cabang dibaca paralel"""
+    if current_tenant() != DEFAULT_TENANT:
+        flash('Laporan gabungan hanya untuk admin pusat', 'danger')
+        return redirect(url_for('dashboard.index'))
+    results = fan_out(get_branch_summary)
+    keys = ('income', 'expense', 'balance', 'arrears', 'students')
+    totals = {k: sum(summary[k] for _, summary, error in results if summary) for k in keys}
+    return render_template('consolidated_report.html', results=results, totals=totals)
 
 # Transaction Blueprint
 transaction_bp = Blueprint('transaction', __name__, url_prefix='/transaction')
@@ -214,6 +233,7 @@ def index():
                          filter_month=filter_month)
 
 @transaction_bp.route('/add', methods=['GET', 'POST'])
+@idempotent
 def add():
     """Tambah transaksi"""
     user_id = session.get('user_id', 1)
@@ -247,8 +267,9 @@ def add():
         if error_msg:
             flash(error_msg, 'danger')
             # Return template with entered values so user doesn't lose data
-            students = get_all_students()
-            students = [dict(s) for s in students] if students else []
+            # Hanya santri yang dipilih sebelumnya; daftar lain dimuat via autocomplete
+            selected = get_student(student_id) if student_id else None
+            students = [dict(selected)] if selected else []
             categories_income = get_all_categories('income')
             categories_expense = get_all_categories('expense')
             categories_income = [dict(c) for c in categories_income] if categories_income else []
@@ -266,23 +287,8 @@ def add():
                                    prev_description=description,
                                    prev_student_id=student_id)
 
-        # Insert transaksi dengan student_id
-        trans_id = execute_db(
-            '''INSERT INTO transactions (user_id, student_id, type, category, amount, description, date)
-               VALUES (?, ?, ?, ?, ?, ?, ?)''',
-            (user_id, student_id, trans_type, category, amount, description, date)
-        )
-
-        # Update saldo wallet
-        wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
-        current_balance = wallet['balance'] if wallet else 0
-
-        if trans_type == 'income':
-            new_balance = current_balance + amount
-        else:
-            new_balance = current_balance - amount
-
-        execute_db('UPDATE wallet SET balance = ? WHERE user_id = ?', (new_balance, user_id))
+        # Insert transaksi + saldo wallet dalam satu commit
+        trans_id = add_transaction(user_id, student_id, trans_type, category, amount, description, date)
         try:
             record_history(user_id, 'create', 'transaction', trans_id, f"{category}:{amount}")
         except Exception:
@@ -290,10 +296,8 @@ def add():
 
         return redirect(url_for('transaction.index'))
     
-    # Get all students untuk dropdown
-    students = get_all_students()
-    # Convert sqlite3.Row to plain dicts so templates render cleanly (avoid printing Row repr)
-    students = [dict(s) for s in students] if students else []
+    # Daftar santri dimuat lewat autocomplete (students.api_search)
+    students = []
 
     # Get categories from database
     today = datetime.now().strftime('%Y-%m-%d')
@@ -310,6 +314,7 @@ def add():
 
 
 @transaction_bp.route('/export-excel')
+@reads_snapshot
 def export_excel():
     """Export transaksi ke Excel dengan filter yang sama seperti halaman daftar"""
     user_id = session.get('user_id', 1)
@@ -431,30 +436,8 @@ def edit(id):
             except (ValueError, TypeError):
                 student_id = None
         
-        # Hitung perubahan saldo
-        wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
-        current_balance = wallet['balance'] if wallet else 0
-
-        # Kembalikan nilai lama terlebih dahulu
-        if trans['type'] == 'income':
-            current_balance -= trans['amount']
-        else:
-            current_balance += trans['amount']
-
-        # Terapkan nilai baru
-        if trans_type == 'income':
-            current_balance += amount
-        else:
-            current_balance -= amount
-
-        execute_db('UPDATE wallet SET balance = ? WHERE user_id = ?', (current_balance, user_id))
-
-        # Update transaksi dengan student_id
-        execute_db(
-            '''UPDATE transactions SET student_id = ?, type = ?, category = ?, amount = ?, description = ?, date = ?
-               WHERE id = ?''',
-            (student_id, trans_type, category, amount, description, date, id)
-        )
+        # Update transaksi (paid_amount tagihan tertaut dan saldo wallet ikut disesuaikan)
+        update_transaction(trans, student_id, trans_type, category, amount, description, date)
         try:
             record_history(user_id, 'update', 'transaction', id, f"{category}:{amount}")
         except Exception:
@@ -492,19 +475,8 @@ def delete(id):
     trans = query_db('SELECT * FROM transactions WHERE id = ? AND user_id = ?', (id, user_id), one=True)
     
     if trans:
-        # Update saldo
-        wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
-        current_balance = wallet['balance'] if wallet else 0
-
-        if trans['type'] == 'income':
-            current_balance -= trans['amount']
-        else:
-            current_balance += trans['amount']
-
-        execute_db('UPDATE wallet SET balance = ? WHERE user_id = ?', (current_balance, user_id))
-
-        # Hapus transaksi
-        execute_db('DELETE FROM transactions WHERE id = ?', (id,))
+        # Hapus transaksi (paid_amount tagihan tertaut dan saldo wallet ikut dikembalikan)
+        delete_transaction(trans)
         try:
             record_history(user_id, 'delete', 'transaction', id, None)
         except Exception:
@@ -530,93 +502,9 @@ def receipt(id):
         flash('Transaksi tidak ditemukan', 'danger')
         return redirect(url_for('transaction.index'))
 
-    # Ambil setting nama pondok
-    settings = query_db('SELECT `key`, value FROM settings')
-    settings_dict = {row['key']: row['value'] for row in settings}
-    pondok_name = settings_dict.get('pondok_name', 'Pondok Pesantren Al Huda')
-
-    # Buat PDF
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # Header
-    pdf.set_font("Helvetica", "B", 16)
-    pdf.cell(0, 10, pondok_name.upper(), 0, 1, "C")
-    pdf.set_font("Helvetica", "", 10)
-    pdf.cell(0, 5, "Sistem Pembayaran Terpadu (PonPay)", 0, 1, "C")
-    pdf.ln(5)
-    pdf.line(10, pdf.get_y(), 200, pdf.get_y())
-    pdf.ln(10)
-
-    # Title
-    pdf.set_font("Helvetica", "B", 14)
-    pdf.cell(0, 10, "BUKTI PEMBAYARAN", 0, 1, "C")
-    pdf.ln(5)
-
-    # Info Transaksi
-    pdf.set_font("Helvetica", "", 11)
-    
-    col_width = 45
-    
-    def add_row(label, value):
-        pdf.set_font("Helvetica", "B", 11)
-        pdf.cell(col_width, 8, label, 0, 0)
-        pdf.set_font("Helvetica", "", 11)
-        pdf.cell(0, 8, f": {value}", 0, 1)
-
-    add_row("No. Transaksi", f"TRX-{trans['id']}")
-    add_row("Tanggal", trans['date'])
-    add_row("Penerima", session.get('full_name', 'Bendahara'))
-    pdf.ln(5)
-
-    # Info Santri
-    if trans['student_name']:
-        pdf.set_font("Helvetica", "B", 11)
-        pdf.cell(0, 8, "Data Santri:", 0, 1)
-        pdf.set_font("Helvetica", "", 11)
-        add_row("Nama", trans['student_name'])
-        add_row("NISN", trans['student_nisn'] or "-")
-        add_row("Kelas", trans['student_kelas'] or "-")
-        pdf.ln(5)
-
-    # Rincian
-    pdf.set_font("Helvetica", "B", 11)
-    pdf.cell(0, 8, "Rincian Pembayaran:", 0, 1)
-    pdf.set_font("Helvetica", "", 11)
-    
-    # Table Header
-    pdf.set_fill_color(240, 240, 240)
-    pdf.cell(130, 10, "Keterangan / Kategori", 1, 0, "C", True)
-    pdf.cell(60, 10, "Jumlah", 1, 1, "C", True)
-    
-    # Table Content
-    description = f"{trans['category']} - {trans['description']}"
-    pdf.cell(130, 20, description, 1, 0, "L")
-    
-    # Format Rupiah manual for PDF
-    amount_str = f"Rp {int(trans['amount']):,.0f}".replace(',', '.')
-    pdf.set_font("Helvetica", "B", 12)
-    pdf.cell(60, 20, amount_str, 1, 1, "R")
-    
-    pdf.ln(20)
-
-    # Tanda Tangan
-    current_date = datetime.now().strftime("%d %m %Y")
-    pdf.set_font("Helvetica", "", 11)
-    pdf.cell(120, 8, "", 0, 0)
-    pdf.cell(0, 8, f"Dicetak pada: {current_date}", 0, 1, "C")
-    pdf.ln(20)
-    pdf.cell(120, 8, "", 0, 0)
-    pdf.cell(0, 8, "( ____________________ )", 0, 1, "C")
-    pdf.cell(120, 8, "", 0, 0)
-    pdf.cell(0, 8, "Bendahara Pondok", 0, 1, "C")
-
-    # Output to BytesIO
-    output = BytesIO()
-    pdf_content = pdf.output(dest='S')
-    output.write(pdf_content)
-    output.seek(0)
-
+    student = {'name': trans['student_name'], 'nisn': trans['student_nisn'], 'kelas': trans['student_kelas']}
+    output = build_receipt_pdf(get_setting('pondok_name'), session.get('full_name', 'Bendahara'), [trans['id']],
+                               trans['date'], student, [(f"{trans['category']} - {trans['description']}", trans['amount'])])
     return send_file(
         output,
         mimetype='application/pdf',
@@ -627,42 +515,113 @@ def receipt(id):
 # Statistics Blueprint
 statistics_bp = Blueprint('statistics', __name__, url_prefix='/statistics')
 
+STAT_PERIODS = ('1', '3', '6', '12')
+STAT_MAX_RANGE_DAYS = 366 * 10
+
+
+def _stat_period():
+    period = request.args.get('period', '1')
+    return period if period in STAT_PERIODS else '1'
+
+
+def _stat_range():
+    """(start, end) dari ?start=&end= (YYYY-MM-DD) atau ?period=N bulan terakhir; ValueError bila tidak valid"""
+    start_arg, end_arg = request.args.get('start'), request.args.get('end')
+    if not start_arg and not end_arg:
+        start, end = period_range(int(_stat_period()))
+    else:
+        start = datetime.strptime(start_arg or '', '%Y-%m-%d').date()
+        end = datetime.strptime(end_arg or '', '%Y-%m-%d').date()
+        if start > end:
+            raise ValueError('Tanggal awal harus sebelum tanggal akhir')
+        if (end - start).days > STAT_MAX_RANGE_DAYS:
+            raise ValueError('Rentang maksimal 10 tahun')
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def _etag_json(stamp, compute):
+    """JSON dengan ETag kuat dari stamp versi data; 304 tanpa query bila klien sudah punya versi yang sama"""
+    etag = hashlib.sha1(repr(stamp).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(compute())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @statistics_bp.route('/')
+@reads_snapshot
 def index():
-    """Halaman statistik"""
-    user_id = session.get('user_id', 1)
-
-    filter_period = request.args.get('period', '1')  # 1, 3, 6, 12 bulan
-    period_months = int(filter_period)
+    """Halaman statistik; data grafik diambil terpisah lewat /statistics/api/..."""
+    custom = bool(request.args.get('start') or request.args.get('end'))
+    return render_template('statistics.html',
+                         filter_period='' if custom else _stat_period(),
+                         filter_start=request.args.get('start', ''),
+                         filter_end=request.args.get('end', ''))
 
-    # Ambil data kategori
-    expense_categories = get_category_stats(user_id, 'expense', period_months)
-    income_categories = get_category_stats(user_id, 'income', period_months)
 
-    # Format data untuk chart - konversi Decimal ke float dan handle None
-    expense_labels = [r['category'] for r in expense_categories] if expense_categories else []
-    expense_values = [float(r['total']) if r['total'] is not None else 0.0 for r in expense_categories] if expense_categories else []
+@statistics_bp.route('/api/categories')
+@reads_snapshot
+def category_series_api():
+    """Total per kategori (JSON): ?type=income|expense & period=1|3|6|12 atau start=&end="""
+    user_id = session.get('user_id', 1)
+    trans_type = request.args.get('type', 'expense')
+    if trans_type not in ('income', 'expense'):
+        return jsonify({'error': 'type harus income atau expense'}), 400
+    try:
+        start, end = _stat_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def compute():
+        rows = get_category_stats(user_id, trans_type, start=start, end=end)
+        return {
+            'start': start,
+            'end': end,
+            'labels': [r['category'] for r in rows],
+            'values': [float(r['total'] or 0) for r in rows],
+        }
 
-    income_labels = [r['category'] for r in income_categories] if income_categories else []
-    income_values = [float(r['total']) if r['total'] is not None else 0.0 for r in income_categories] if income_categories else []
+    # Rentang tanggal ikut di stamp karena jendela periode bergeser tiap hari
+    stamp = (get_data_version('transactions'), user_id, trans_type, start, end)
+    return _etag_json(stamp, compute)
 
-    # Warna untuk chart
-    colors = ['#2E7D32', '#43A047', '#66BB6A', '#81C784', '#A5D6A7', '#C8E6C9']
 
-    # Ambil statistik tunggakan per kelas - konversi Decimal ke float dan handle None
-    class_stats = get_bill_stats_by_class()
-    class_labels = [r['kelas'] for r in class_stats] if class_stats else []
-    class_values = [float(r['total_unpaid']) if r['total_unpaid'] is not None else 0.0 for r in class_stats] if class_stats else []
+@statistics_bp.route('/api/comparison')
+@reads_snapshot
+def comparison_series_api():
+    """Pemasukan vs pengeluaran rentang terpilih dan rentang yang sama tahun lalu (JSON)"""
+    user_id = session.get('user_id', 1)
+    try:
+        start, end = _stat_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def compute():
+        result = get_rollup_comparison(user_id, start, end, group_by=('type',))
+        for key in ('current', 'previous'):
+            totals = {r['type']: r['total'] or 0 for r in result[key]}
+            result[key] = {'income': totals.get('income', 0), 'expense': totals.get('expense', 0)}
+        return result
+
+    stamp = (get_data_version('transactions'), user_id, start, end)
+    return _etag_json(stamp, compute)
+
+
+@statistics_bp.route('/api/class-arrears')
+@reads_snapshot
+def class_arrears_series_api():
+    """Total tunggakan per kelas (JSON)"""
+    def compute():
+        rows = get_bill_stats_by_class()
+        return {
+            'labels': [r['kelas'] for r in rows],
+            'values': [float(r['total_unpaid'] or 0) for r in rows],
+        }
 
-    return render_template('statistics.html',
-                         expense_labels=json.dumps(expense_labels),
-                         expense_values=json.dumps(expense_values),
-                         income_labels=json.dumps(income_labels),
-                         income_values=json.dumps(income_values),
-                         class_labels=json.dumps(class_labels),
-                         class_values=json.dumps(class_values),
-                         colors=json.dumps(colors),
-                         filter_period=filter_period)
+    return _etag_json(get_data_version('bills', 'students', 'classes'), compute)
 
 # Wallet Blueprint
 wallet_bp = Blueprint('wallet', __name__, url_prefix='/wallet')
@@ -697,11 +656,31 @@ def index():
     user_id = session.get('user_id', 1)
 
     user = query_db('SELECT * FROM users WHERE id = ?', (user_id,), one=True)
-    settings = query_db('SELECT `key`, `value` FROM settings')
 
-    settings_dict = {row['key']: row['value'] for row in settings}
+    return render_template('settings.html', user=user, settings=get_settings())
+
+@settings_bp.route('/update-app', methods=['POST'])
+@admin_required
+def update_app_settings():
+    """Update pengaturan aplikasi (nama pondok, mata uang)"""
+    user_id = session.get('user_id', 1)
+    pondok_name = request.form.get('pondok_name', '').strip()
+    if not pondok_name:
+        flash('Nama pondok tidak boleh kosong', 'danger')
+        return redirect(url_for('settings.index'))
+    try:
+        set_settings({'pondok_name': pondok_name})
+    except Exception as e:
+        flash(f'Gagal menyimpan pengaturan: {str(e)}', 'danger')
+        return redirect(url_for('settings.index'))
+
+    try:
+        record_history(user_id, 'update', 'settings', None, pondok_name)
+    except Exception:
+        pass
 
-    return render_template('settings.html', user=user, settings=settings_dict)
+    flash('Pengaturan aplikasi berhasil disimpan', 'success')
+    return redirect(url_for('settings.index'))
 
 @settings_bp.route('/update-profile', methods=['POST'])
 @admin_required
@@ -852,6 +831,26 @@ def detail(student_id):
     
     return render_template('student_detail.html', student=student, payments=payments, stats=stats)
 
+@students_bp.route('/api/search')
+def api_search():
+    """API autocomplete santri (prefix nama/NISN/kelas) beserta total tunggakan"""
+    q = request.args.get('q', '')
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 50)
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        limit, page = 20, 1
+
+    # Ambil satu baris ekstra untuk mengetahui apakah masih ada halaman berikutnya
+    rows = search_students(q, limit + 1, (page - 1) * limit)
+    has_more = len(rows) > limit
+    results = [dict(r) for r in rows[:limit]]
+    unpaid = get_unpaid_amounts(r['id'] for r in results)
+    for r in results:
+        r['unpaid_amount'] = unpaid.get(r['id'], 0)
+
+    return jsonify({'results': results, 'page': page, 'has_more': has_more})
+
 @students_bp.route('/add', methods=['GET', 'POST'])
 def add():
     """Tambah santri baru"""
@@ -864,8 +863,24 @@ def add():
         parent_name = request.form.get('parent_name')
         parent_phone = request.form.get('parent_phone')
         alamat = request.form.get('alamat')
+
+        # Cek duplikasi lewat index name_key / nisn / name_phonetic
+        error_msg = None
+        if nisn and find_student_by_nisn(nisn):
+            error_msg = 'NISN sudah terdaftar'
+        elif find_student_by_name(name, kelas):
+            error_msg = 'Sudah ada santri dengan nama yang sama di kelas ini'
+        if error_msg:
+            flash(error_msg, 'danger')
+            return render_template('add_student.html', form=request.form)
+
+        if not request.form.get('confirm_similar'):
+            similar = [dict(s) for s in find_similar_students(name)]
+            if similar:
+                flash('Ditemukan santri dengan nama mirip. Periksa kembali sebelum menyimpan.', 'warning')
+                return render_template('add_student.html', form=request.form, similar=similar)
         
-        new_id = add_student(name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat)
+        new_id = add_student(name, nisn or None, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat)
         try:
             record_history(session.get('user_id'), 'create', 'student', new_id, name)
         except Exception:
@@ -953,6 +968,7 @@ def delete(student_id):
     return redirect(url_for('students.index'))
 
 @students_bp.route('/<int:student_id>/add-payment', methods=['POST'])
+@idempotent
 def add_payment(student_id):
     """Tambah pembayaran untuk santri"""
     amount = int(request.form.get('amount', 0))
@@ -961,54 +977,25 @@ def add_payment(student_id):
     
     user_id = session.get('user_id', 1)
     
-    # Insert transaksi
-    execute_db('''
-        INSERT INTO transactions (user_id, student_id, type, category, amount, description, date)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, student_id, 'income', 'Pembayaran Santri', amount, description, date_str))
-
-    # Update balance
-    wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
-    new_balance = wallet['balance'] + amount
-    execute_db('UPDATE wallet SET balance = ? WHERE user_id = ?', (new_balance, user_id))
+    # Insert transaksi + saldo wallet dalam satu commit
+    add_transaction(user_id, student_id, 'income', 'Pembayaran Santri', amount, description, date_str)
     
     return redirect(url_for('students.detail', student_id=student_id))
 
 
 @students_bp.route('/export-excel')
+@reads_snapshot
 def export_excel():
-    """Export data santri ke Excel"""
-    students_data = get_all_students()
-    
-    # Create workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Data Santri"
-    
-    # Define styles
-    header_fill = PatternFill(start_color="6366F1", end_color="6366F1", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Add headers
+    """Export data santri ke Excel (streaming, mode write-only)"""
+    # Workbook write-only: style header didaftarkan sekali sebagai named style
+    wb = excel.new_workbook()
+    ws = excel.create_sheet(wb, "Data Santri", [5, 20, 15, 12, 15, 15, 20, 15, 25, 12])
+
     headers = ['No.', 'Nama Santri', 'NISN', 'Kelas', 'Jenis Kelamin', 'No. HP', 'Nama Orang Tua', 'No. HP Orang Tua', 'Alamat', 'Status']
-    ws.append(headers)
-    
-    # Style headers
-    for cell in ws[1]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = header_alignment
-        cell.border = border
-    
-    # Add data
-    for idx, student in enumerate(students_data, 1):
+    excel.append_header(ws, headers)
+
+    # Baris dibaca bertahap dari cursor dan langsung ditulis ke sheet
+    for idx, student in enumerate(iter_students(), 1):
         ws.append([
             idx,
             student['name'],
@@ -1021,27 +1008,13 @@ def export_excel():
             student['alamat'],
             student['status']
         ])
-    
-    # Set column widths
-    ws.column_dimensions['A'].width = 5
-    ws.column_dimensions['B'].width = 20
-    ws.column_dimensions['C'].width = 15
-    ws.column_dimensions['D'].width = 12
-    ws.column_dimensions['E'].width = 15
-    ws.column_dimensions['F'].width = 15
-    ws.column_dimensions['G'].width = 20
-    ws.column_dimensions['H'].width = 15
-    ws.column_dimensions['I'].width = 25
-    ws.column_dimensions['J'].width = 12
-    
-    # Save to bytes
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
+
+    # Simpan ke file sementara agar export besar tidak ditahan di memori
+    output = excel.save_to_tempfile(wb)
+
     return send_file(
         output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        mimetype=excel.XLSX_MIMETYPE,
         as_attachment=True,
         download_name=f'data_santri_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
     )
@@ -1124,13 +1097,6 @@ def import_excel():
             wb = load_workbook(file)
             ws = wb.active
             
-            # Collect existing NISN to check duplicates
-            existing_nisns = set(row['nisn'] for row in get_all_students() if row['nisn'])
-            existing_names = {}
-            for row in get_all_students():
-                key = (row['name'].lower().strip(), row['kelas'])
-                existing_names[key] = row['id']
-            
             imported = 0
             duplicates = []
             errors = []
@@ -1156,9 +1122,8 @@ def import_excel():
                         errors.append(f"Baris {row_idx}: Nama santri tidak boleh kosong")
                         continue
                     
-                    # Check for exact duplicate (same name in same class)
-                    name_key = (name.lower(), kelas)
-                    if name_key in existing_names:
+                    # Check for duplicate name (normalized name in same class) via index
+                    if find_student_by_name(name, kelas):
                         duplicates.append({
                             'name': name,
                             'kelas': kelas,
@@ -1168,7 +1133,7 @@ def import_excel():
                         continue
                     
                     # Check if NISN already exists (if NISN provided)
-                    if nisn and nisn in existing_nisns:
+                    if nisn and find_student_by_nisn(nisn):
                         duplicates.append({
                             'name': name,
                             'kelas': kelas,
@@ -1178,9 +1143,7 @@ def import_excel():
                         continue
                     
                     # Add student
-                    add_student(name, nisn, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status)
-                    existing_nisns.add(nisn)
-                    existing_names[name_key] = True
+                    add_student(name, nisn or None, kelas, jenis_kelamin, phone, parent_name, parent_phone, alamat, status)
                     imported += 1
                     
                 except Exception as e:
@@ -1197,52 +1160,68 @@ def import_excel():
     return render_template('import_students.html')
 
 
+def _month_period(month_str):
+    """Ubah 'YYYY-MM' menjadi (start, end, label); default bulan berjalan"""
+    try:
+        start = datetime.strptime(month_str, '%Y-%m') if month_str else None
+    except ValueError:
+        start = None
+    if start is None:
+        today = datetime.now()
+        start = datetime(today.year, today.month, 1)
+    if start.month == 12:
+        end = datetime(start.year + 1, 1, 1)
+    else:
+        end = datetime(start.year, start.month + 1, 1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), start.strftime('%m-%Y')
+
+
+def _sheet_title(name, used):
+    """Nama sheet Excel yang valid (maks 31 karakter, tanpa karakter terlarang) dan unik"""
+    title = ''.join('_' if ch in '[]:*?/\\' else ch for ch in (name or 'Tanpa Kelas'))[:31] or 'Tanpa Kelas'
+    base, n = title, 2
+    while title.lower() in used:
+        suffix = f" ({n})"
+        title = base[:31 - len(suffix)] + suffix
+        n += 1
+    used.add(title.lower())
+    return title
+
+
 @students_bp.route('/download-report')
+@reads_snapshot
 def download_report():
-    """Download laporan data santri dengan statistik pembayaran"""
-    students_data = get_all_students()
-    
-    # Create workbook
-    wb = Workbook()
-    
+    """Download laporan data santri dengan statistik pembayaran
+
+    Semua sheet diisi dari satu query agregat dalam satu kali iterasi.
+    Parameter opsional ?period=YYYY-MM menentukan bulan untuk kolom pembayaran periode.
+    """
+    period_start, period_end, period_label = _month_period(request.args.get('period', ''))
+
+    wb = excel.new_workbook()
+
     # Sheet 1: Data Santri dengan Statistik
-    ws1 = wb.active
-    ws1.title = "Laporan Santri"
-    
-    # Header styling
-    header_fill = PatternFill(start_color="6366F1", end_color="6366F1", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Title
-    ws1['A1'] = "LAPORAN DATA SANTRI"
-    ws1['A1'].font = Font(bold=True, size=14, color="6366F1")
-    ws1.merge_cells('A1:K1')
-    ws1['A2'] = f"Tanggal: {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"
-    ws1.merge_cells('A2:K2')
-    
-    # Headers
-    headers = ['No.', 'Nama Santri', 'NISN', 'Kelas', 'Jenis Kelamin', 'No. HP', 'Nama Orang Tua', 
-               'No. HP Orang Tua', 'Status', 'Total Pembayaran', 'Pembayaran Bulan Ini']
+    ws1 = excel.create_sheet(wb, "Laporan Santri", [5, 20, 15, 12, 15, 15, 20, 15, 12, 15, 15])
+    # Sheet 2: Ringkasan Statistik (diisi setelah iterasi selesai)
+    ws2 = excel.create_sheet(wb, "Statistik", [25, 20, 15, 18, 18, 15])
+    used_titles = {'laporan santri', 'statistik'}
+
+    excel.append_title(ws1, "LAPORAN DATA SANTRI")
+    ws1.append([f"Tanggal: {datetime.now().strftime('%d-%m-%Y %H:%M:%S')}"])
+    ws1.append([f"Periode: {period_label}"])
     ws1.append([])  # Blank row
-    ws1.append(headers)
-    
-    # Style headers
-    for cell in ws1[4]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = header_alignment
-        cell.border = border
-    
-    # Add data with payment stats
-    for idx, student in enumerate(students_data, 1):
-        stats = get_student_payment_stats(student['id'])
+
+    period_header = f'Pembayaran {period_label}'
+    excel.append_header(ws1, ['No.', 'Nama Santri', 'NISN', 'Kelas', 'Jenis Kelamin', 'No. HP', 'Nama Orang Tua',
+                              'No. HP Orang Tua', 'Status', 'Total Pembayaran', period_header])
+    class_headers = ['No.', 'Nama Santri', 'NISN', 'Status', 'Total Pembayaran', period_header]
+
+    total_students = aktif_count = belum_bayar_count = total_payment = 0
+    class_summary = []  # urut sesuai ORDER BY kelas (classes.name)
+    current_class = object()
+    ws_class = None
+
+    for idx, student in enumerate(iter_student_payment_summary(period_start, period_end), 1):
         ws1.append([
             idx,
             student['name'],
@@ -1253,85 +1232,199 @@ def download_report():
             student['parent_name'],
             student['parent_phone'],
             student['status'],
-            stats['total_payment'],
-            stats['month_payment']
+            student['total_payment'],
+            student['period_payment']
         ])
-    
-    # Set column widths
-    widths = [5, 20, 15, 12, 15, 15, 20, 15, 12, 15, 15]
-    for idx, width in enumerate(widths, 1):
-        ws1.column_dimensions[chr(64 + idx)].width = width
-    
-    # Sheet 2: Ringkasan Statistik
-    ws2 = wb.create_sheet("Statistik")
-    
-    total_students = len(students_data)
-    aktif_count = sum(1 for s in students_data if s['status'] == 'aktif')
-    non_aktif_count = total_students - aktif_count
-    
-    # Hitung total pembayaran
-    total_payment = sum(get_student_payment_stats(s['id'])['total_payment'] for s in students_data)
-    belum_bayar_count = sum(1 for s in students_data if get_student_payment_stats(s['id'])['month_payment'] == 0)
-    
-    ws2['A1'] = "RINGKASAN STATISTIK"
-    ws2['A1'].font = Font(bold=True, size=14, color="6366F1")
-    ws2.merge_cells('A1:B1')
-    
-    # Statistics
+
+        # Sheet per kelas dibuat saat kelas baru ditemui
+        if student['class_id'] != current_class:
+            current_class, current_kelas = student['class_id'], student['kelas']
+            ws_class = excel.create_sheet(wb, _sheet_title(current_kelas, used_titles), [5, 20, 15, 12, 18, 18])
+            excel.append_title(ws_class, f"LAPORAN {(current_kelas or 'Tanpa Kelas').upper()}")
+            ws_class.append([])
+            excel.append_header(ws_class, class_headers)
+            class_summary.append({'kelas': current_kelas or '-', 'count': 0, 'aktif': 0,
+                                  'total': 0, 'period': 0, 'belum_bayar': 0})
+        summary = class_summary[-1]
+        summary['count'] += 1
+        ws_class.append([summary['count'], student['name'], student['nisn'], student['status'],
+                         student['total_payment'], student['period_payment']])
+
+        is_aktif = student['status'] == 'aktif'
+        belum_bayar = student['period_payment'] == 0
+        total_students += 1
+        aktif_count += is_aktif
+        belum_bayar_count += belum_bayar
+        total_payment += student['total_payment']
+        summary['aktif'] += is_aktif
+        summary['total'] += student['total_payment']
+        summary['period'] += student['period_payment']
+        summary['belum_bayar'] += belum_bayar
+
+    excel.append_title(ws2, "RINGKASAN STATISTIK")
+    ws2.append([])
     stats_data = [
         ('Total Santri', total_students),
         ('Santri Aktif', aktif_count),
-        ('Santri Non-Aktif', non_aktif_count),
+        ('Santri Non-Aktif', total_students - aktif_count),
         ('Total Pembayaran', f"Rp {total_payment:,.0f}"),
-        ('Belum Bayar Bulan Ini', belum_bayar_count),
+        (f'Belum Bayar {period_label}', belum_bayar_count),
     ]
-    
-    ws2.append([])
     for label, value in stats_data:
-        ws2.append([label, value])
-    
-    # Style statistics
-    for row in ws2.iter_rows(min_row=3, max_row=7):
-        row[0].font = Font(bold=True)
-        row[0].fill = PatternFill(start_color="E0E7FF", end_color="E0E7FF", fill_type="solid")
-        row[1].border = border
-    
-    ws2.column_dimensions['A'].width = 25
-    ws2.column_dimensions['B'].width = 20
-    
-    # Save to bytes
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
+        excel.append_label_value(ws2, label, value)
+
+    ws2.append([])
+    excel.append_header(ws2, ['Kelas', 'Jumlah Santri', 'Santri Aktif', 'Total Pembayaran', period_header, 'Belum Bayar'])
+    for summary in class_summary:
+        ws2.append([summary['kelas'], summary['count'], summary['aktif'],
+                    summary['total'], summary['period'], summary['belum_bayar']])
+
+    output = excel.save_to_tempfile(wb)
+
     return send_file(
         output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        mimetype=excel.XLSX_MIMETYPE,
         as_attachment=True,
         download_name=f'laporan_santri_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
     )
 
 
+@students_bp.route('/classes')
+def classes():
+    """Halaman daftar kelas"""
+    classes = [dict(c) for c in get_all_classes()]
+    return render_template('classes.html', classes=classes)
+
+
+@students_bp.route('/classes/<int:class_id>/rename', methods=['POST'])
+@admin_required
+def rename_class_view(class_id):
+    """Ganti nama kelas (digabung otomatis bila nama sudah dipakai kelas lain)"""
+    new_name = request.form.get('name', '').strip()
+    if not get_class(class_id) or not new_name:
+        flash('Nama kelas tidak valid', 'danger')
+        return redirect(url_for('students.classes'))
+    result_id = rename_class(class_id, new_name)
+    try:
+        record_history(session.get('user_id'), 'update', 'class', result_id, new_name)
+    except Exception:
+        pass
+    flash(f'Kelas berhasil diubah menjadi "{new_name}"', 'success')
+    return redirect(url_for('students.classes'))
+
+
+@students_bp.route('/classes/<int:class_id>/move', methods=['POST'])
+@admin_required
+def move_class_view(class_id):
+    """Pindahkan semua santri ke kelas lain (naik kelas) atau gabungkan kelas"""
+    try:
+        target_id = int(request.form.get('target_id', 0))
+    except ValueError:
+        target_id = 0
+    merge = bool(request.form.get('merge'))
+    if not get_class(class_id) or not get_class(target_id) or target_id == class_id:
+        flash('Kelas tujuan tidak valid', 'danger')
+        return redirect(url_for('students.classes'))
+    moved = move_class_students(class_id, target_id, delete_source=merge)
+    try:
+        record_history(session.get('user_id'), 'merge' if merge else 'move', 'class', class_id,
+                       json.dumps({'target_id': target_id, 'students': moved}))
+    except Exception:
+        pass
+    flash(f'{moved} santri berhasil dipindahkan', 'success')
+    return redirect(url_for('students.classes'))
+
+
+@students_bp.route('/classes/<int:class_id>/status', methods=['POST'])
+@admin_required
+def class_status_view(class_id):
+    """Ubah status seluruh santri dalam satu kelas"""
+    status = request.form.get('status')
+    if not get_class(class_id) or status not in ('aktif', 'non-aktif'):
+        flash('Status tidak valid', 'danger')
+        return redirect(url_for('students.classes'))
+    updated = set_class_status(class_id, status)
+    try:
+        record_history(session.get('user_id'), 'update', 'class', class_id, f"status:{status}:{updated}")
+    except Exception:
+        pass
+    flash(f'Status {updated} santri diubah menjadi {status}', 'success')
+    return redirect(url_for('students.classes'))
+
+
 # History / Activity Log Blueprint
 history_bp = Blueprint('history', __name__, url_prefix='/history')
 
 
+def _history_filters():
+    """Filter riwayat dari query string; nilai tidak valid diabaikan"""
+    args = request.args
+    filters = {
+        'user_id': args.get('user_id', type=int),
+        'action': args.get('action') if args.get('action') in HISTORY_ACTIONS else None,
+        'target_type': args.get('target_type') if args.get('target_type') in HISTORY_TARGET_TYPES else None,
+        'target_id': args.get('target_id', type=int),
+    }
+    for key in ('date_from', 'date_to'):
+        try:
+            filters[key] = datetime.strptime(args.get(key, ''), '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            filters[key] = None
+    return filters
+
+
 @history_bp.route('/')
 def index():
-    """Tampilkan riwayat aktivitas"""
-    # Optionally limit or paginate
-    entries = get_history(500)
-    entries = [dict(e) for e in entries] if entries else []
-    return render_template('history.html', entries=entries)
+    """Tampilkan riwayat aktivitas (keyset pagination + filter); source=archive mencari di arsip"""
+    from history_archive import search_history_archive, get_history_archives, retention_cutoff
+    filters = _history_filters()
+    archived = request.args.get('source') == 'archive'
+    if archived:
+        page = search_history_archive(before=request.args.get('before'), **filters)
+    else:
+        flush_history()
+        page = get_history_page(before=request.args.get('before'), after=request.args.get('after'), **filters)
+    active = {k: v for k, v in filters.items() if v}
+    if archived:
+        active['source'] = 'archive'
+    return render_template('history.html', entries=page['entries'], older=page['older'], newer=page['newer'],
+                           filters=filters, active_filters=active, users=get_all_users(),
+                           actions=HISTORY_ACTIONS, target_types=HISTORY_TARGET_TYPES, archived=archived,
+                           archives=get_history_archives(), retention_cutoff=retention_cutoff())
 
 
 @history_bp.route('/delete/<int:entry_id>', methods=['POST'])
 def delete(entry_id):
     """Hapus satu entri history"""
     execute_db('DELETE FROM history WHERE id = ?', (entry_id,))
+    return redirect(request.referrer or url_for('history.index'))
+
+
+@history_bp.route('/archive', methods=['POST'])
+@admin_required
+def archive():
+    """Pindahkan riwayat lama (lebih dari HISTORY_RETENTION_MONTHS) ke arsip gzip per bulan"""
+    from history_archive import archive_history
+    try:
+        moved = archive_history()
+    except Exception as e:
+        flash(f'Gagal mengarsipkan riwayat: {str(e)}', 'danger')
+        return redirect(url_for('history.index'))
+    if moved:
+        flash(f'{sum(moved.values())} entri riwayat dipindah ke arsip ({", ".join(moved)})', 'success')
+    else:
+        flash('Tidak ada riwayat yang perlu diarsipkan', 'warning')
     return redirect(url_for('history.index'))
 
 
+@history_bp.route('/api/writer')
+@admin_required
+def writer_stats():
+    """Metrik penulis riwayat batch: antrean, entri tertulis, batch, overflow, gagal"""
+    from history_writer import writer
+    return jsonify(writer.stats())
+
+
 # --- User management (admin only) ---
 users_bp = Blueprint('users', __name__, url_prefix='/users')
 
@@ -1413,29 +1506,101 @@ def index_payments():
         return redirect(url_for('dashboard.index'))
     
     from db import get_summarized_student_bills
-    students_bills = get_summarized_student_bills()
-    
-    return render_template('payments_list.html', students_bills=students_bills)
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        class_id = int(request.args['class_id']) if request.args.get('class_id') else None
+    except ValueError:
+        page, class_id = 1, None
+    status = request.args.get('status', '')
+    per_page = 50
+    students_bills, total = get_summarized_student_bills(class_id, status, page, per_page)
+    total_pages = max((total + per_page - 1) // per_page, 1)
+
+    return render_template('payments_list.html', students_bills=students_bills,
+                           classes=[dict(c) for c in get_all_classes()],
+                           filter_class_id=class_id, filter_status=status,
+                           page=page, per_page=per_page, total=total, total_pages=total_pages)
+
+def _aging_args():
+    """Parameter laporan umur tunggakan: ?as_of=YYYY-MM-DD&class_id="""
+    as_of = request.args.get('as_of', '')
+    try:
+        as_of = datetime.strptime(as_of, '%Y-%m-%d').strftime('%Y-%m-%d') if as_of else None
+        class_id = int(request.args['class_id']) if request.args.get('class_id') else None
+    except ValueError:
+        as_of, class_id = None, None
+    return as_of, class_id
+
+
+@payments_bp.route('/aging')
+@reads_snapshot
+def aging_report():
+    """Laporan umur tunggakan per kelas dan per santri"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    as_of, class_id = _aging_args()
+    report = get_arrears_aging(as_of, class_id)
+    return render_template('aging_report.html', report=report, buckets=AGING_BUCKETS,
+                           classes=[dict(c) for c in get_all_classes()], filter_class_id=class_id)
+
+
+@payments_bp.route('/aging/export')
+@reads_snapshot
+def export_aging_report():
+    """Export laporan umur tunggakan ke Excel (sheet per kelas + rincian santri)"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    as_of, class_id = _aging_args()
+    report = get_arrears_aging(as_of, class_id)
+    labels = [label for _, label in AGING_BUCKETS]
+    keys = [key for key, _ in AGING_BUCKETS]
+
+    wb = excel.new_workbook()
+    ws1 = excel.create_sheet(wb, "Ringkasan Kelas", [20, 12] + [16] * len(keys) + [18])
+    excel.append_title(ws1, "LAPORAN UMUR TUNGGAKAN")
+    ws1.append([f"Per tanggal: {report['as_of']}"])
+    ws1.append([])
+    excel.append_header(ws1, ['Kelas', 'Santri'] + labels + ['Total'])
+    for c in report['classes']:
+        ws1.append([c['kelas'], c['students']] + [c[k] for k in keys] + [c['total']])
+    ws1.append(excel.styled_row(ws1, ['TOTAL', sum(c['students'] for c in report['classes'])]
+                                + [report['totals'][k] for k in keys] + [report['totals']['total']], 'ponpay_label'))
+
+    ws2 = excel.create_sheet(wb, "Rincian Santri", [5, 25, 15, 15, 10, 12] + [16] * len(keys) + [18])
+    excel.append_header(ws2, ['No.', 'Nama Santri', 'NISN', 'Kelas', 'Tagihan', 'Maks. Hari'] + labels + ['Total'])
+    for idx, s in enumerate(report['students'], 1):
+        ws2.append([idx, s['name'], s['nisn'], s['kelas'], s['bill_count'], max(s['max_days'], 0)]
+                   + [s[k] for k in keys] + [s['total']])
+
+    output = excel.save_to_tempfile(wb)
+    return send_file(
+        output,
+        mimetype=excel.XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=f"umur_tunggakan_{report['as_of'].replace('-', '')}.xlsx"
+    )
+
 
 @payments_bp.route('/student/<int:student_id>')
 def student_detail(student_id):
     if session.get('role') not in ('admin', 'staff'):
         return redirect(url_for('dashboard.index'))
     
-    from db import get_student, get_student_bills, get_bill_total_paid
+    from db import get_student, get_student_bills
     student = get_student(student_id)
     if not student:
         flash('Santri tidak ditemukan', 'danger')
         return redirect(url_for('payments.index_payments'))
     
-    bills_data = get_student_bills(student_id)
-    bills = []
-    for b in bills_data:
-        b_dict = dict(b)
-        b_dict['paid_amount'] = get_bill_total_paid(b['id'])
-        bills.append(b_dict)
-        
-    return render_template('student_payment_detail.html', student=student, bills=bills)
+    # paid_amount sudah tersimpan di baris tagihan
+    bills = [dict(b) for b in get_student_bills(student_id)]
+    receipt_ids = request.args.get('receipt', '')
+    # Urutan alokasi default: jatuh tempo terlama dulu
+    unpaid_bills = sorted((b for b in bills if b['status'] == 'unpaid' and b['remaining'] > 0),
+                          key=lambda b: (b['due_date'] is None, b['due_date'] or '', b['created_at'], b['id']))
+
+    return render_template('student_payment_detail.html', student=student, bills=bills, unpaid_bills=unpaid_bills,
+                           receipt_ids=receipt_ids)
 
 
 
@@ -1448,52 +1613,130 @@ def create_bill_view():
         amount = int(request.form.get('amount', 0))
         due_date = request.form.get('due_date') or None
 
-        # Support multiple student selection via checkboxes (student_ids)
-        student_ids = request.form.getlist('student_ids')  # may be []
-
-        created = []
-        if student_ids:
-            for sid in student_ids:
-                try:
-                    sid_int = int(sid)
-                except Exception:
-                    continue
-                b_id = create_bill(sid_int, title, amount, due_date, session.get('user_id'))
-                created.append(b_id)
-        else:
+        # Target: daftar santri terpilih (student_ids), satu kelas, atau semua santri aktif
+        target = request.form.get('target', 'students')
+        class_id = None
+        student_ids = []
+        if target == 'kelas':
+            try:
+                class_id = int(request.form.get('class_id', 0))
+            except ValueError:
+                class_id = None
+        elif target != 'all':
+            target = 'students'
             # Fallback to single student_id (old behavior)
-            student_id = request.form.get('student_id')
-            if student_id:
+            raw_ids = request.form.getlist('student_ids') or [request.form.get('student_id')]
+            for sid in raw_ids:
                 try:
-                    sid_int = int(student_id)
-                    b_id = create_bill(sid_int, title, amount, due_date, session.get('user_id'))
-                    created.append(b_id)
-                except Exception:
-                    pass
+                    student_ids.append(int(sid))
+                except (TypeError, ValueError):
+                    continue
 
-        # Record history for created bills
-        try:
-            for b in created:
-                record_history(session.get('user_id'), 'create', 'bill', b, f"{title}:{amount}")
-        except Exception:
-            pass
+        created = 0
+        if target != 'kelas' or class_id:
+            created = create_bills_bulk(title, amount, due_date, session.get('user_id'),
+                                        target=target, class_id=class_id, student_ids=student_ids)
 
         if created:
-            flash(f"Berhasil membuat {len(created)} tagihan", 'success')
+            flash(f"Berhasil membuat {created} tagihan", 'success')
         else:
             flash('Tidak ada tagihan dibuat. Pastikan Anda memilih santri.', 'warning')
 
         return redirect(url_for('payments.index_payments'))
 
-    # GET -> form
-    students = get_all_students()
-    students = [dict(s) for s in students] if students else []
-    
-    # Add unpaid amount for each student
-    for student in students:
-        student['unpaid_amount'] = get_student_unpaid_amount(student['id'])
-    
-    return render_template('payment_form.html', students=students, bill=None)
+    # GET -> form (santri dipilih lewat autocomplete, tidak dikirim semua)
+    classes = [dict(c) for c in get_all_classes()]
+    return render_template('payment_form.html', students=[], classes=classes, bill=None)
+
+
+@payments_bp.route('/api/bulk-bills', methods=['POST'])
+def api_bulk_bills():
+    """API pembuatan tagihan massal: {title, amount, due_date, target, class_id, student_ids}"""
+    if session.get('role') not in ('admin', 'staff'):
+        return jsonify({'error': 'forbidden'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        title = str(data.get('title') or '').strip()
+        amount = int(data.get('amount', 0))
+        target = data.get('target', 'students')
+        class_id = int(data['class_id']) if data.get('class_id') is not None else None
+        student_ids = [int(sid) for sid in data.get('student_ids') or []]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid payload'}), 400
+    if not title or amount <= 0 or target not in ('all', 'kelas', 'students') or (target == 'kelas' and not class_id):
+        return jsonify({'error': 'invalid payload'}), 400
+
+    created = create_bills_bulk(title, amount, data.get('due_date') or None, session.get('user_id'),
+                                target=target, class_id=class_id, student_ids=student_ids)
+    return jsonify({'created': created})
+
+
+@payments_bp.route('/templates', methods=['GET', 'POST'])
+def bill_templates():
+    """Daftar & tambah template tagihan berulang"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    if request.method == 'POST':
+        title = request.form.get('title', '').strip()
+        cadence = request.form.get('cadence', 'monthly')
+        student_status = request.form.get('student_status', 'aktif')
+        try:
+            amount = int(request.form.get('amount', 0))
+            due_day = int(request.form.get('due_day', 10))
+            start_month = int(request.form.get('start_month', 1))
+            class_id = int(request.form['class_id']) if request.form.get('class_id') else None
+        except ValueError:
+            amount = 0
+        if not title or amount <= 0 or cadence not in CADENCE_MONTHS or student_status not in ('aktif', 'non-aktif'):
+            flash('Data template tidak valid', 'danger')
+            return redirect(url_for('payments.bill_templates'))
+        new_id = create_bill_template(title, amount, cadence, min(max(due_day, 1), 31), class_id,
+                                      student_status, min(max(start_month, 1), 12),
+                                      session.get('user_id'))
+        try:
+            record_history(session.get('user_id'), 'create', 'bill_template', new_id, f"{title}:{amount}")
+        except Exception:
+            pass
+        flash(f'Template "{title}" berhasil ditambahkan', 'success')
+        return redirect(url_for('payments.bill_templates'))
+
+    templates = [dict(t) for t in get_bill_templates()]
+    classes = [dict(c) for c in get_all_classes()]
+    return render_template('bill_templates.html', templates=templates, classes=classes,
+                           cadences=CADENCE_MONTHS, months=MONTHS_ID)
+
+
+@payments_bp.route('/templates/<int:template_id>/toggle', methods=['POST'])
+def toggle_bill_template(template_id):
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    template = get_bill_template(template_id)
+    if template:
+        set_bill_template_active(template_id, not template['is_active'])
+    return redirect(url_for('payments.bill_templates'))
+
+
+@payments_bp.route('/templates/<int:template_id>/delete', methods=['POST'])
+def delete_bill_template_view(template_id):
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    delete_bill_template(template_id)
+    try:
+        record_history(session.get('user_id'), 'delete', 'bill_template', template_id, None)
+    except Exception:
+        pass
+    return redirect(url_for('payments.bill_templates'))
+
+
+@payments_bp.route('/templates/run', methods=['POST'])
+def run_bill_templates():
+    """Jalankan scheduler sekarang (semua template atau satu template)"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    template_id = request.form.get('template_id', type=int)
+    results = run_scheduler_tick(template_id=template_id)
+    flash(f"{sum(results.values())} tagihan baru dibuat dari {len(results)} template", 'success')
+    return redirect(url_for('payments.bill_templates'))
 
 
 @payments_bp.route('/edit/<int:bill_id>', methods=['GET', 'POST'])
@@ -1508,20 +1751,20 @@ def edit_bill_view(bill_id):
         title = request.form.get('title')
         amount = int(request.form.get('amount', 0))
         due_date = request.form.get('due_date') or None
-        status = request.form.get('status', 'unpaid')
-        update_bill(bill_id, student_id, title, amount, due_date, status)
+        if amount <= 0 or amount < (bill['paid_amount'] or 0):
+            flash(f"Nominal tagihan harus lebih dari 0 dan tidak kurang dari yang sudah dibayar "
+                  f"(Rp {bill['paid_amount'] or 0:,.0f})".replace(',', '.'), 'warning')
+            return redirect(url_for('payments.edit_bill_view', bill_id=bill_id))
+        update_bill(bill_id, student_id, title, amount, due_date)
         try:
             record_history(session.get('user_id'), 'update', 'bill', bill_id, f"{title}:{amount}")
         except Exception:
             pass
         return redirect(url_for('payments.index_payments'))
 
-    students_data = get_all_students()
-    students = []
-    for s in students_data:
-        s_dict = dict(s)
-        s_dict['unpaid_amount'] = get_student_unpaid_amount(s['id'])
-        students.append(s_dict)
+    # Hanya santri pemilik tagihan; pilihan lain dimuat lewat autocomplete
+    student = get_student(bill['student_id'])
+    students = [dict(student)] if student else []
 
     try:
         bill = dict(bill)
@@ -1543,6 +1786,7 @@ def delete_bill_view(bill_id):
 
 
 @payments_bp.route('/pay/<int:bill_id>', methods=['POST'])
+@idempotent
 def pay_bill_view(bill_id):
     if session.get('role') not in ('admin', 'staff'):
         return redirect(url_for('dashboard.index'))
@@ -1552,44 +1796,275 @@ def pay_bill_view(bill_id):
 
     try:
         amount_to_pay = int(request.form.get('amount', 0))
-        if amount_to_pay <= 0:
-            flash('Jumlah pembayaran harus lebih dari 0', 'warning')
-            return redirect(url_for('payments.index_payments'))
-            
+    except ValueError:
+        amount_to_pay = 0
+    if amount_to_pay <= 0:
+        flash('Jumlah pembayaran harus lebih dari 0', 'warning')
+        return redirect(url_for('payments.index_payments'))
+
+    try:
         user_id = session.get('user_id', 1)
         student_id = bill['student_id']
         title = bill['title']
         today = datetime.now().strftime('%Y-%m-%d')
 
-        # Insert transaction (income) linked to bill
-        execute_db(
-            '''INSERT INTO transactions (user_id, student_id, type, category, amount, description, date, bill_id)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-            (user_id, student_id, 'income', 'Pembayaran Santri', amount_to_pay, title, today, bill_id)
-        )
+        # Transaksi income + paid_amount tagihan + saldo wallet dalam satu commit
+        _, bill = pay_bill(bill_id, user_id, amount_to_pay, today)
 
-        # Update wallet balance
-        wallet = query_db('SELECT balance FROM wallet WHERE user_id = ?', (user_id,), one=True)
-        current_balance = wallet['balance'] if wallet else 0
-        new_balance = current_balance + amount_to_pay
-        execute_db('UPDATE wallet SET balance = ? WHERE user_id = ?', (new_balance, user_id))
-
-        # Check if bill is now fully paid
-        from db import get_bill_total_paid
-        total_paid = get_bill_total_paid(bill_id)
-        if total_paid >= bill['amount']:
-            mark_bill_paid(bill_id)
+        if bill['status'] == 'paid':
             flash(f"Pembayaran Rp {amount_to_pay:,.0f} berhasil. Tagihan '{title}' sekarang Lunas.", 'success')
         else:
-            flash(f"Pembayaran Rp {amount_to_pay:,.0f} berhasil. Sisa tagihan: Rp {(bill['amount'] - total_paid):,.0f}", 'success')
+            flash(f"Pembayaran Rp {amount_to_pay:,.0f} berhasil. Sisa tagihan: Rp {bill['remaining']:,.0f}", 'success')
 
         record_history(user_id, 'pay', 'bill', bill_id, f"{title}:{amount_to_pay}")
+    except ValueError as e:
+        flash(f'Pembayaran gagal: {str(e)}', 'warning')
     except Exception as e:
         flash(f'Terjadi masalah saat memproses pembayaran: {str(e)}', 'danger')
 
     return redirect(url_for('payments.index_payments'))
 
 
+def _parse_allocation(source):
+    """Ambil amount & bill_ids (urutan prioritas) dari form atau payload JSON"""
+    if hasattr(source, 'getlist'):
+        amount, bill_ids = source.get('amount', 0), source.getlist('bill_ids')
+    else:
+        amount, bill_ids = source.get('amount', 0), source.get('bill_ids') or []
+    return int(amount), [int(bid) for bid in bill_ids]
+
+
+@payments_bp.route('/student/<int:student_id>/allocate', methods=['POST'])
+@idempotent
+def allocate_payment_view(student_id):
+    """Satu setoran dibagi ke beberapa tagihan (jatuh tempo terlama dulu)"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    try:
+        amount, bill_ids = _parse_allocation(request.form)
+        allocations = allocate_payment(student_id, session.get('user_id', 1), amount, bill_ids)
+    except ValueError as e:
+        flash(f'Pembayaran gagal: {str(e)}', 'warning')
+        return redirect(url_for('payments.student_detail', student_id=student_id))
+    except Exception as e:
+        flash(f'Terjadi masalah saat memproses pembayaran: {str(e)}', 'danger')
+        return redirect(url_for('payments.student_detail', student_id=student_id))
+
+    flash(f"Pembayaran Rp {amount:,.0f} dialokasikan ke {len(allocations)} tagihan.".replace(',', '.'), 'success')
+    return redirect(url_for('payments.student_detail', student_id=student_id,
+                            receipt=','.join(str(a['transaction_id']) for a in allocations)))
+
+
+@payments_bp.route('/api/allocate', methods=['POST'])
+@idempotent
+def api_allocate_payment():
+    """API alokasi setoran: {student_id, amount, bill_ids?} -> rincian alokasi + URL kuitansi gabungan"""
+    if session.get('role') not in ('admin', 'staff'):
+        return jsonify({'error': 'forbidden'}), 403
+    data = request.get_json(silent=True) or {}
+    try:
+        student_id = int(data.get('student_id'))
+        amount, bill_ids = _parse_allocation(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid payload'}), 400
+    try:
+        allocations = allocate_payment(student_id, session.get('user_id', 1), amount, bill_ids)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    ids = ','.join(str(a['transaction_id']) for a in allocations)
+    return jsonify({'allocations': allocations, 'amount': amount,
+                    'receipt_url': url_for('payments.combined_receipt', ids=ids)})
+
+
+def _matrix_args():
+    """Parameter matrix pembayaran: ?year=YYYY&class_id="""
+    try:
+        year = int(request.args.get('year') or datetime.now().year)
+        class_id = int(request.args['class_id']) if request.args.get('class_id') else None
+    except ValueError:
+        year, class_id = datetime.now().year, None
+    return year, class_id
+
+
+@payments_bp.route('/matrix')
+def payment_matrix():
+    """Matrix status pembayaran santri x bulan (lunas / cicilan / belum)"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    year, class_id = _matrix_args()
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+    per_page = 50
+    rows, total = get_payment_matrix(year, class_id, page, per_page)
+    matrix = [{'id': r['id'], 'name': r['name'], 'nisn': r['nisn'], 'kelas': r['kelas'],
+               'cells': matrix_cells(r)} for r in rows]
+    return render_template('payment_matrix.html', matrix=matrix, year=year, months=MONTHS_ID,
+                           classes=[dict(c) for c in get_all_classes()], filter_class_id=class_id,
+                           page=page, per_page=per_page, total=total,
+                           total_pages=max((total + per_page - 1) // per_page, 1))
+
+
+@payments_bp.route('/matrix/export')
+@reads_snapshot
+def export_payment_matrix():
+    """Export matrix santri x bulan ke Excel (streaming write-only)"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    year, class_id = _matrix_args()
+    labels = {'paid': 'Lunas', 'partial': 'Cicilan', 'unpaid': 'Belum', None: '-'}
+
+    wb = excel.new_workbook()
+    ws = excel.create_sheet(wb, f"Matrix {year}", [5, 25, 15, 12] + [11] * 12 + [16])
+    excel.append_title(ws, f"STATUS PEMBAYARAN SANTRI TAHUN {year}")
+    ws.append([])
+    excel.append_header(ws, ['No.', 'Nama Santri', 'NISN', 'Kelas'] + [m[:3] for m in MONTHS_ID] + ['Sisa Tagihan'])
+    for idx, row in enumerate(iter_payment_matrix(year, class_id), 1):
+        cells = matrix_cells(row)
+        ws.append([idx, row['name'], row['nisn'], row['kelas']]
+                  + [labels[c['status']] for c in cells] + [sum(c['outstanding'] for c in cells)])
+
+    output = excel.save_to_tempfile(wb)
+    return send_file(
+        output,
+        mimetype=excel.XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=f'matrix_pembayaran_{year}.xlsx'
+    )
+
+
+@payments_bp.route('/class-grid', methods=['GET', 'POST'])
+@idempotent
+def class_payment_grid():
+    """Input pembayaran satu kelas untuk satu judul tagihan sekaligus"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    class_id = request.values.get('class_id', type=int)
+    title = request.values.get('title', '')
+    errors, entered = {}, {}
+
+    if request.method == 'POST' and class_id:
+        for key, value in request.form.items():
+            bill_key = key[7:] if key.startswith('amount_') else ''
+            # Hanya field amount_<id tagihan>; kunci lain (mis. amount_abc) diabaikan
+            if not bill_key.isdigit() or not value.strip():
+                continue
+            bill_id = int(bill_key)
+            try:
+                entered[bill_id] = int(value)
+            except ValueError:
+                errors[bill_id] = 'Nominal tidak valid'
+        if not errors:
+            total, errors = post_class_payments(class_id, entered, session.get('user_id', 1),
+                                                request.form.get('date') or None)
+        if not errors:
+            flash(f"{len([a for a in entered.values() if a])} pembayaran tersimpan, total "
+                  f"Rp {total:,.0f}".replace(',', '.'), 'success')
+            return redirect(url_for('payments.class_payment_grid', class_id=class_id, title=title))
+        flash('Periksa kembali baris yang ditandai; belum ada pembayaran yang disimpan', 'danger')
+
+    titles = [dict(t) for t in get_class_bill_titles(class_id)] if class_id else []
+    if class_id and not title and titles:
+        title = titles[0]['title']
+    rows = [dict(r) for r in get_class_bill_grid(class_id, title)] if class_id and title else []
+    return render_template('class_payment_grid.html', classes=[dict(c) for c in get_all_classes()],
+                           class_id=class_id, title=title, titles=titles, rows=rows,
+                           errors=errors, entered=entered, today=datetime.now().strftime('%Y-%m-%d'))
+
+
+@payments_bp.route('/statements')
+def statements():
+    """Impor mutasi bank/e-wallet dan antrian review baris yang belum cocok"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    lines = [dict(l) for l in get_unmatched_statement_lines()]
+    # Pilihan tagihan terbuka untuk baris yang santrinya terdeteksi dari NISN
+    student_ids = {l['student_id'] for l in lines if l['student_id']}
+    open_bills = {}
+    for sid in student_ids:
+        open_bills[sid] = [dict(b) for b in get_student_bills(sid) if b['status'] == 'unpaid' and b['remaining'] > 0]
+    return render_template('statements.html', imports=[dict(i) for i in get_statement_imports()],
+                           lines=lines, open_bills=open_bills)
+
+
+@payments_bp.route('/statements/import', methods=['POST'])
+def import_statement_view():
+    """Upload CSV mutasi; baris yang cocok (nominal + NISN/VA) langsung diposting"""
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        flash('Pilih file CSV mutasi terlebih dahulu', 'warning')
+        return redirect(url_for('payments.statements'))
+    if not file.filename.lower().endswith(('.csv', '.txt')):
+        flash('File harus berformat CSV', 'danger')
+        return redirect(url_for('payments.statements'))
+
+    # Seluruh file (maks MAX_CONTENT_LENGTH) dibaca & divalidasi dulu: error decode/format tidak memposting apa pun
+    try:
+        rows = list(iter_statement_rows(file.stream))
+    except (StatementError, UnicodeDecodeError) as e:
+        flash(f'Gagal membaca file mutasi: {str(e)}', 'danger')
+        return redirect(url_for('payments.statements'))
+    try:
+        summary = import_statement(rows, secure_filename(file.filename), session.get('user_id', 1))
+    except StatementError as e:
+        flash(f'Impor mutasi terhenti: {str(e)}', 'danger')
+        return redirect(url_for('payments.statements'))
+
+    unmatched = summary['lines'] - summary['matched']
+    posted = f"Rp {summary['posted_amount']:,.0f}".replace(',', '.')
+    message = (f"{summary['lines']} baris diimpor: {summary['matched']} otomatis diposting ({posted}), "
+               f"{unmatched} perlu review")
+    if summary['duplicates']:
+        message += f", {summary['duplicates']} baris sudah pernah diimpor"
+    flash(message, 'success')
+    return redirect(url_for('payments.statements'))
+
+
+@payments_bp.route('/statements/<int:line_id>/resolve', methods=['POST'])
+@idempotent
+def resolve_statement_line_view(line_id):
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    try:
+        resolve_statement_line(line_id, request.form.get('bill_id', type=int), session.get('user_id', 1))
+        flash('Baris mutasi berhasil diposting ke tagihan', 'success')
+    except ValueError as e:
+        flash(str(e), 'warning')
+    return redirect(url_for('payments.statements'))
+
+
+@payments_bp.route('/statements/<int:line_id>/ignore', methods=['POST'])
+def ignore_statement_line_view(line_id):
+    if session.get('role') not in ('admin', 'staff'):
+        return redirect(url_for('dashboard.index'))
+    ignore_statement_line(line_id)
+    return redirect(url_for('payments.statements'))
+
+
+@payments_bp.route('/receipt/combined')
+def combined_receipt():
+    """Kuitansi PDF gabungan untuk beberapa transaksi pembayaran tagihan satu santri"""
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i]
+    except ValueError:
+        ids = []
+    try:
+        rows = get_transactions_by_ids(session.get('user_id', 1), ids)
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('payments.index_payments'))
+    if not rows:
+        flash('Transaksi tidak ditemukan', 'danger')
+        return redirect(url_for('payments.index_payments'))
+    first = rows[0]
+    student = {'name': first['student_name'], 'nisn': first['student_nisn'], 'kelas': first['student_kelas']}
+    lines = [(t['bill_title'] or t['description'] or t['category'], t['amount']) for t in rows]
+    output = build_receipt_pdf(get_setting('pondok_name'), session.get('full_name', 'Bendahara'),
+                               [t['id'] for t in rows], first['date'], student, lines)
+    return send_file(output, mimetype='application/pdf', as_attachment=False,
+                     download_name=f"kwitansi_gabungan_{first['id']}.pdf")
+
+
 @payments_bp.route('/receipt/<int:bill_id>')
 def bill_receipt(bill_id):
     """Lookup transaction for a bill and redirect to receipt"""
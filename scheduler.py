@@ -0,0 +1,78 @@
+"""
+Scheduler Tagihan Berulang (SPP bulanan, uang semester, dll)
+Dijalankan lewat CLI (`flask --app app generate-bills`) atau thread latar belakang
+"""
+import calendar
+import logging
+import threading
+import time
+from datetime import date
+from db import get_db, get_bill_templates, generate_template_bills
+from tenants import for_each_tenant
+
+logger = logging.getLogger(__name__)
+
+MONTHS_ID = ['Januari', 'Februari', 'Maret', 'April', 'Mei', 'Juni', 'Juli',
+             'Agustus', 'September', 'Oktober', 'November', 'Desember']
+
+# Panjang satu periode (dalam bulan) untuk setiap cadence
+CADENCE_MONTHS = {'monthly': 1, 'quarterly': 3, 'semester': 6, 'yearly': 12}
+
+
+def current_period(template, today):
+    """Tanggal awal periode yang sedang berjalan untuk template pada hari `today`"""
+    length = CADENCE_MONTHS.get(template['cadence'], 1)
+    start_month = template['start_month'] or 1
+    offset = (today.month - start_month) % length
+    month_index = today.year * 12 + (today.month - 1) - offset
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def period_bill_fields(template, period_start):
+    """(period key, judul tagihan, jatuh tempo) untuk satu periode"""
+    last_day = calendar.monthrange(period_start.year, period_start.month)[1]
+    due_day = min(max(template['due_day'] or 1, 1), last_day)
+    period = period_start.strftime('%Y-%m')
+    title = f"{template['title']} {MONTHS_ID[period_start.month - 1]} {period_start.year}"
+    return period, title, period_start.replace(day=due_day).strftime('%Y-%m-%d')
+
+
+def run_scheduler_tick(today=None, template_id=None):
+    """Buat tagihan periode berjalan untuk semua template aktif; satu commit untuk seluruh tick.
+
+    Aman dijalankan berulang: tagihan yang sudah ada untuk (template, santri, periode) dilewati.
+    Harus dipanggil di dalam app context. Mengembalikan {template_id: jumlah tagihan baru}.
+    """
+    today = today or date.today()
+    results = {}
+    db = get_db()
+    try:
+        for template in get_bill_templates(active_only=True):
+            if template_id and template['id'] != template_id:
+                continue
+            period, title, due_date = period_bill_fields(template, current_period(template, today))
+            results[template['id']] = generate_template_bills(template, period, title, due_date, commit=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return results
+
+
+def start_background_scheduler(app, interval=3600):
+    """Jalankan tick scheduler secara periodik di thread daemon, untuk setiap cabang"""
+    def loop():
+        while True:
+            try:
+                with app.app_context():
+                    results = for_each_tenant(run_scheduler_tick)
+                created = sum(sum(r.values()) for r in results.values())
+                if created:
+                    logger.info("Scheduler tagihan: %s tagihan baru dibuat", created)
+            except Exception as e:
+                logger.error(f"Scheduler tagihan gagal: {str(e)}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='bill-scheduler', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,141 @@
+"""
+Reporting Snapshot untuk PonPay
+Salinan read-only database (SQLite online backup API) untuk laporan berat dan export,
+supaya query laporan tidak bersaing dengan penulisan kasir di file database yang sama
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from urllib.request import pathname2url
+from flask import g, current_app, make_response
+from db import database_path
+from tenants import for_each_tenant
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SUFFIX = '.report.db'
+
+
+def snapshot_path(db_path=None):
+    """ponpay.db -> ponpay.report.db (per database tenant)"""
+    base, _ = os.path.splitext(os.path.abspath(db_path or database_path()))
+    return base + SNAPSHOT_SUFFIX
+
+
+def _versions(conn):
+    try:
+        return dict(conn.execute('SELECT name, version FROM data_versions').fetchall())
+    except sqlite3.OperationalError:
+        return None
+
+
+def refresh_snapshot(pages=1024, sleep=0.005):
+    """Salin database aktif ke snapshot; True bila file snapshot ditulis ulang.
+
+    Backup berjalan bertahap `pages` halaman per langkah dan melepas lock di
+    antara langkah, jadi penulisan kasir tidak tertahan selama penyalinan.
+    Hasil ditulis ke file sementara lalu di-rename, pembaca lama tetap
+    memegang salinan sebelumnya. Bila stamp data_versions tidak berubah,
+    snapshot hanya ditandai segar (mtime) tanpa disalin ulang.
+    """
+    source_path = database_path()
+    target = snapshot_path(source_path)
+    src = sqlite3.connect(source_path)
+    try:
+        if os.path.exists(target):
+            current = sqlite3.connect(f'file:{pathname2url(target)}?mode=ro', uri=True)
+            try:
+                versions = _versions(current)
+            finally:
+                current.close()
+            if versions is not None and versions == _versions(src):
+                os.utime(target)
+                return False
+        tmp = f'{target}.{os.getpid()}.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst, pages=pages, sleep=sleep)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.replace(tmp, target)
+    return True
+
+
+def snapshot_info(path=None):
+    """{'taken_at', 'age_seconds'} snapshot tenant aktif, atau None bila belum ada"""
+    path = path or snapshot_path()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    return {
+        'taken_at': datetime.fromtimestamp(mtime).strftime('%d-%m-%Y %H:%M'),
+        'age_seconds': max(int(time.time() - mtime), 0),
+    }
+
+
+@contextmanager
+def report_snapshot():
+    """Selama blok ini get_db()/query_db() membaca snapshot read-only.
+
+    Bila snapshot belum ada atau lebih tua dari REPORT_SNAPSHOT_MAX_AGE,
+    blok tetap berjalan di database live (g.report_snapshot = None).
+    """
+    path = snapshot_path()
+    info = snapshot_info(path)
+    max_age = current_app.config.get('REPORT_SNAPSHOT_MAX_AGE', 900)
+    if info is None or info['age_seconds'] > max_age:
+        g.report_snapshot = None
+        yield None
+        return
+    conn = sqlite3.connect(f'file:{pathname2url(path)}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    live = g.pop('db', None)
+    g.db = conn
+    g.report_snapshot = info
+    try:
+        yield conn
+    finally:
+        g.pop('db', None)
+        conn.close()
+        if live is not None:
+            g.db = live
+
+
+def reads_snapshot(view):
+    """Decorator untuk view laporan/export: baca dari snapshot, header X-Report-Snapshot berisi waktu snapshot"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with report_snapshot() as conn:
+            response = make_response(view(*args, **kwargs))
+        response.headers['X-Report-Snapshot'] = g.report_snapshot['taken_at'] if conn else 'live'
+        return response
+    return wrapper
+
+
+def start_snapshot_refresher(app, interval=300):
+    """Perbarui snapshot setiap cabang secara periodik di thread daemon"""
+    def loop():
+        while True:
+            try:
+                with app.app_context():
+                    results = for_each_tenant(refresh_snapshot)
+                copied = [slug for slug, written in results.items() if written]
+                if copied:
+                    logger.info("Snapshot laporan diperbarui: %s", ', '.join(copied))
+            except Exception as e:
+                logger.error(f"Snapshot laporan gagal: {str(e)}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='report-snapshot', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,164 @@
+"""
+Tenant Registry untuk PonPay (multi cabang pondok dalam satu deployment)
+Setiap cabang punya file database SQLite sendiri sehingga tidak berbagi write lock;
+tenant 'default' selalu memakai app.config['DATABASE']
+"""
+import os
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, current_app
+from utils.cache import VersionedCache
+
+DEFAULT_TENANT = 'default'
+SLUG_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{1,31}$')
+
+_registry_cache = VersionedCache(maxsize=4)
+
+
+class TenantError(Exception):
+    """Tenant tidak dikenal / data tenant tidak valid"""
+    pass
+
+
+def registry_path():
+    """File registry: TENANT_REGISTRY, atau tenants.db di folder database default"""
+    return current_app.config.get('TENANT_REGISTRY') or os.path.join(
+        os.path.dirname(os.path.abspath(current_app.config['DATABASE'])), 'tenants.db')
+
+
+def tenant_data_dir():
+    return current_app.config.get('TENANT_DATA_DIR') or os.path.join(
+        os.path.dirname(os.path.abspath(current_app.config['DATABASE'])), 'tenants')
+
+
+def _connect_registry():
+    conn = sqlite3.connect(registry_path())
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def ensure_tenant_registry():
+    conn = _connect_registry()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tenants (
+                slug TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                database TEXT NOT NULL,
+                active INTEGER NOT NULL DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _load_registry(path):
+    tenants = {DEFAULT_TENANT: {'slug': DEFAULT_TENANT, 'name': 'Pusat',
+                                'database': current_app.config['DATABASE'], 'active': 1}}
+    if not os.path.exists(path):
+        return tenants
+    conn = _connect_registry()
+    try:
+        for row in conn.execute('SELECT slug, name, database, active FROM tenants ORDER BY name'):
+            tenants[row['slug']] = dict(row)
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        conn.close()
+    return tenants
+
+
+def _registry():
+    """Registry di-cache per proses; mtime file registry dipakai sebagai stamp versi"""
+    path = registry_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    version = (current_app.config['DATABASE'], mtime)
+    return _registry_cache.get_or_compute(path, version, lambda: _load_registry(path))
+
+
+def get_tenants(active_only=True):
+    return [t for t in _registry().values() if t['active'] or not active_only]
+
+
+def get_tenant(slug):
+    return _registry().get(slug or DEFAULT_TENANT)
+
+
+def register_tenant(slug, name, database=None):
+    """Daftarkan cabang baru; database default: TENANT_DATA_DIR/<slug>.db. Skema dibuat oleh pemanggil."""
+    slug = (slug or '').strip().lower()
+    if not SLUG_PATTERN.match(slug) or slug == DEFAULT_TENANT:
+        raise TenantError('Kode cabang hanya huruf kecil, angka, - atau _ (2-32 karakter)')
+    if get_tenant(slug):
+        raise TenantError(f'Cabang {slug} sudah terdaftar')
+    if not database:
+        os.makedirs(tenant_data_dir(), exist_ok=True)
+        database = os.path.join(tenant_data_dir(), f'{slug}.db')
+    ensure_tenant_registry()
+    conn = _connect_registry()
+    try:
+        conn.execute('INSERT INTO tenants (slug, name, database) VALUES (?, ?, ?)', (slug, name.strip() or slug, database))
+        conn.commit()
+    finally:
+        conn.close()
+    _registry_cache.clear()
+    return get_tenant(slug)
+
+
+def current_tenant():
+    return g.get('tenant') or DEFAULT_TENANT
+
+
+def use_tenant(slug):
+    """Arahkan get_db() di app context ini ke database tenant; koneksi tenant lain ditutup"""
+    tenant = get_tenant(slug)
+    if not tenant or not tenant['active']:
+        raise TenantError(f'Cabang {slug} tidak ditemukan')
+    if g.get('database') != tenant['database']:
+        db = g.pop('db', None)
+        if db is not None:
+            db.close()
+    g.tenant = tenant['slug']
+    g.database = tenant['database']
+    return tenant
+
+
+def for_each_tenant(func):
+    """Jalankan func() berurutan untuk setiap tenant aktif (CLI, scheduler); hasil {slug: nilai}"""
+    app = current_app._get_current_object()
+    results = {}
+    for tenant in get_tenants():
+        with app.app_context():
+            use_tenant(tenant['slug'])
+            results[tenant['slug']] = func()
+    return results
+
+
+def fan_out(func, tenants=None, max_workers=8):
+    """Jalankan func() paralel di setiap tenant (thread + koneksi sendiri per tenant).
+
+    Untuk laporan gabungan lintas cabang: setiap database dibaca bersamaan
+    sehingga waktu total mendekati tenant paling lambat, bukan jumlah semuanya.
+    Mengembalikan [(tenant, hasil, error)] sesuai urutan tenant.
+    """
+    app = current_app._get_current_object()
+    tenants = tenants if tenants is not None else get_tenants()
+
+    def run(tenant):
+        with app.app_context():
+            try:
+                use_tenant(tenant['slug'])
+                return tenant, func(), None
+            except Exception as e:
+                return tenant, None, str(e)
+
+    if not tenants:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tenants))) as pool:
+        return list(pool.map(run, tenants))
@@ -0,0 +1,30 @@
+"""
+Tes kunci kelas (utils.names.normalize_class_name)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.names import normalize_class_name
+
+
+def test_ejaan_kelas_sama_menghasilkan_kunci_sama():
+    keys = {normalize_class_name(k) for k in ('Kelas 1', 'kelas1', 'KLS I', 'Kelas  1', 'kel. 1')}
+    assert keys == {'kelas 1'}
+
+
+def test_angka_romawi_setara_angka():
+    assert normalize_class_name('Kelas XII') == normalize_class_name('Kelas 12') == 'kelas 12'
+
+
+def test_kelas_berbeda_tidak_digabung():
+    assert normalize_class_name('Kelas 1-2') != normalize_class_name('Kelas 12')
+    assert normalize_class_name('Kelas 1 1') != normalize_class_name('Kelas 11')
+    assert normalize_class_name('Kelas VII-1') != normalize_class_name('Kelas 71')
+    assert normalize_class_name('Kelas 1A') == normalize_class_name('Kelas 1 A') != normalize_class_name('Kelas 1')
+
+
+def test_kelas_kosong():
+    assert normalize_class_name('') == ''
+    assert normalize_class_name(None) == ''
@@ -0,0 +1,42 @@
+"""
+Cache Utilities for PonPay
+Cache in-process untuk laporan berat; entri dianggap basi bila stamp versi data berubah
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """Cache LRU kecil: nilai disimpan bersama stamp versi data saat dihitung.
+
+    Stamp biasanya tuple dari get_data_version(); selama stamp sama, hasil
+    lama dipakai ulang tanpa menyentuh tabel besar. ttl (detik) opsional
+    membatasi umur entri walaupun stamp tidak berubah.
+    """
+
+    def __init__(self, maxsize=64, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, version, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version and (entry[2] is None or entry[2] > now):
+                self._data.move_to_end(key)
+                return entry[1]
+        value = compute()
+        expires = now + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (version, value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,96 @@
+"""
+Excel Export Utilities for PonPay
+Helper untuk membuat workbook openpyxl mode write-only (streaming)
+"""
+import tempfile
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+from openpyxl.utils import get_column_letter
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Batas ukuran file yang disimpan di memori sebelum ditulis ke disk
+SPOOL_MAX_SIZE = 5 * 1024 * 1024
+
+
+def _thin_border():
+    return Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+
+
+def new_workbook():
+    """Membuat workbook write-only dengan named style standar PonPay.
+
+    Style didaftarkan sekali di level workbook sehingga setiap sel cukup
+    mereferensikan nama style, bukan membuat objek Font/Fill sendiri.
+    """
+    wb = Workbook(write_only=True)
+
+    header = NamedStyle(name='ponpay_header')
+    header.font = Font(bold=True, color='FFFFFF', size=11)
+    header.fill = PatternFill(start_color='6366F1', end_color='6366F1', fill_type='solid')
+    header.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    header.border = _thin_border()
+    wb.add_named_style(header)
+
+    title = NamedStyle(name='ponpay_title')
+    title.font = Font(bold=True, size=14, color='6366F1')
+    wb.add_named_style(title)
+
+    label = NamedStyle(name='ponpay_label')
+    label.font = Font(bold=True)
+    label.fill = PatternFill(start_color='E0E7FF', end_color='E0E7FF', fill_type='solid')
+    wb.add_named_style(label)
+
+    value = NamedStyle(name='ponpay_value')
+    value.border = _thin_border()
+    wb.add_named_style(value)
+
+    return wb
+
+
+def create_sheet(wb, title, widths=None):
+    """Membuat sheet baru; lebar kolom harus diset sebelum baris pertama ditulis"""
+    ws = wb.create_sheet(title)
+    for idx, width in enumerate(widths or [], 1):
+        ws.column_dimensions[get_column_letter(idx)].width = width
+    return ws
+
+
+def styled_row(ws, values, style):
+    """Membuat satu baris sel dengan named style yang sama"""
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        cells.append(cell)
+    return cells
+
+
+def append_header(ws, headers):
+    ws.append(styled_row(ws, headers, 'ponpay_header'))
+
+
+def append_title(ws, text):
+    ws.append(styled_row(ws, [text], 'ponpay_title'))
+
+
+def append_label_value(ws, label, value):
+    label_cell = WriteOnlyCell(ws, value=label)
+    label_cell.style = 'ponpay_label'
+    value_cell = WriteOnlyCell(ws, value=value)
+    value_cell.style = 'ponpay_value'
+    ws.append([label_cell, value_cell])
+
+
+def save_to_tempfile(wb):
+    """Simpan workbook ke file sementara (spool ke disk bila besar) dan kembalikan file object-nya"""
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    wb.save(output)
+    output.seek(0)
+    return output
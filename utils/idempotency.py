@@ -0,0 +1,91 @@
+"""
+Idempotency Utilities for PonPay
+Kunci idempotensi untuk form/API pembayaran: kiriman ulang (double-click, retry
+browser/load balancer) mengembalikan hasil pertama tanpa menulis ulang
+"""
+import json
+import uuid
+from functools import wraps
+from flask import request, session, flash, redirect, jsonify, make_response
+
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Kategori flash yang menandakan view gagal (redirect kembali ke form)
+ERROR_CATEGORIES = ('danger', 'warning', 'error')
+
+
+def new_idempotency_key():
+    """Kunci baru untuk satu form (dipanggil dari template)"""
+    return uuid.uuid4().hex
+
+
+def _snapshot(response, flashes):
+    """Simpan hasil yang bisa diputar ulang: redirect (+flash) atau body JSON"""
+    if response.is_json:
+        return {'status': response.status_code, 'json': response.get_json(), 'flashes': flashes}
+    return {'status': response.status_code, 'location': response.headers.get('Location'), 'flashes': flashes}
+
+
+def _succeeded(response, flashes):
+    """JSON 2xx, atau redirect tanpa flash error (danger/warning) dari view"""
+    if response.is_json:
+        return response.status_code < 400
+    if not 300 <= response.status_code < 400:
+        return False
+    return not any(category in ERROR_CATEGORIES for category, _ in flashes)
+
+
+def _replay(stored):
+    for category, message in stored.get('flashes', []):
+        flash(message, category)
+    if 'json' in stored:
+        response = make_response(jsonify(stored['json']), stored['status'])
+    else:
+        response = redirect(stored['location'], code=stored['status'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _in_progress():
+    if request.headers.get(IDEMPOTENCY_HEADER):
+        return jsonify({'error': 'request with this idempotency key is still being processed'}), 409
+    flash('Permintaan yang sama sedang diproses, silakan tunggu sebentar', 'warning')
+    return redirect(request.referrer or '/')
+
+
+def idempotent(view):
+    """Decorator untuk view POST yang menulis transaksi.
+
+    Kunci diambil dari header Idempotency-Key atau field form idempotency_key;
+    tanpa kunci view berjalan seperti biasa. Hanya respons sukses yang
+    disimpan untuk diputar ulang (lihat _succeeded); respons gagal melepas
+    kunci sehingga kiriman ulang benar-benar mencoba lagi.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from db import claim_idempotency_key, complete_idempotency_key, release_idempotency_key
+
+        key = request.headers.get(IDEMPOTENCY_HEADER) or request.form.get(IDEMPOTENCY_FIELD)
+        if request.method != 'POST' or not key:
+            return view(*args, **kwargs)
+        key = key.strip()[:100]
+        path = request.path
+        user_id = session.get('user_id')
+
+        claimed, stored = claim_idempotency_key(key, path, user_id)
+        if not claimed:
+            return _replay(json.loads(stored)) if stored else _in_progress()
+
+        flashes_before = len(session.get('_flashes', []))
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(key, path, user_id)
+            raise
+        flashes = [list(f) for f in session.get('_flashes', [])[flashes_before:]]
+        if _succeeded(response, flashes):
+            complete_idempotency_key(key, path, user_id, json.dumps(_snapshot(response, flashes)))
+        else:
+            release_idempotency_key(key, path, user_id)
+        return response
+    return wrapper
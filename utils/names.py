@@ -0,0 +1,67 @@
+"""
+Name Normalization Utilities for PonPay
+Kunci nama ternormalisasi dan kunci fonetik untuk deteksi santri duplikat
+"""
+import re
+import unicodedata
+
+# Gelar/sapaan yang sering ikut tertulis di depan nama
+HONORIFICS = {
+    'h', 'hj', 'haji', 'hajjah', 'kh', 'kyai', 'kiai', 'ust', 'ustad', 'ustadz', 'ustaz',
+    'ustadzah', 'ustazah', 'gus', 'ning', 'sdr', 'sdri', 'dr', 'drs', 'dra', 'ir', 'prof',
+    'bpk', 'bapak', 'ibu', 'syekh', 'habib', 'sayyid', 'syarifah',
+}
+
+# Ejaan yang sering bervariasi pada nama Indonesia/Arab (diterapkan berurutan)
+_PHONETIC_RULES = [
+    ('kh', 'k'), ('dh', 'd'), ('dz', 'z'), ('th', 't'), ('sh', 's'), ('sy', 's'),
+    ('ph', 'f'), ('gh', 'g'), ('oe', 'u'), ('dj', 'j'), ('tj', 'c'), ('ch', 'h'),
+    ('q', 'k'), ('v', 'f'), ('x', 'ks'), ('z', 's'), ('w', 'u'), ('y', 'i'),
+]
+
+
+def normalize_name(name):
+    """Kunci nama ternormalisasi: huruf kecil, tanpa diakritik/tanda baca, spasi tunggal, tanpa gelar depan"""
+    if not name:
+        return ''
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^a-z0-9\s]", ' ', text.lower())
+    tokens = text.split()
+    while len(tokens) > 1 and tokens[0] in HONORIFICS:
+        tokens.pop(0)
+    return ' '.join(tokens)
+
+
+def phonetic_key(name):
+    """Kunci fonetik sederhana per kata; 'Muhammad', 'Mohamad' dan 'Muhamad' menghasilkan kunci yang sama"""
+    return ' '.join(_phonetic_token(t) for t in normalize_name(name).split())
+
+
+def _phonetic_token(token):
+    # 'h' di akhir kata setelah vokal sering tidak ditulis (Fatimah/Fatima)
+    key = re.sub(r'([aiueo])h$', r'\1', token)
+    for src, dst in _PHONETIC_RULES:
+        key = key.replace(src, dst)
+    # Huruf pertama dipertahankan, vokal setelahnya dibuang, huruf ganda digabung
+    head, tail = key[:1], re.sub(r'[aiueo]', '', key[1:])
+    return re.sub(r'(.)\1+', r'\1', head + tail)
+
+
+_ROMAN = {
+    'i': '1', 'ii': '2', 'iii': '3', 'iv': '4', 'v': '5', 'vi': '6',
+    'vii': '7', 'viii': '8', 'ix': '9', 'x': '10', 'xi': '11', 'xii': '12',
+}
+
+
+def normalize_class_name(kelas):
+    """Kunci kelas: 'Kelas 1', 'kelas1', 'KLS I' dan 'Kelas  1' menghasilkan kunci yang sama ('kelas 1').
+
+    Token dipisah spasi agar 'Kelas 1-2' ('kelas 1 2') tidak sama dengan 'Kelas 12',
+    dan 'Kelas VII-1' tidak sama dengan 'Kelas 71'.
+    """
+    if not kelas:
+        return ''
+    tokens = re.findall(r'[a-z]+|[0-9]+', str(kelas).lower())
+    tokens = ['kelas' if t in ('kls', 'kelas', 'kel') else _ROMAN.get(t, t) for t in tokens]
+    return ' '.join(tokens)
@@ -0,0 +1,99 @@
+"""
+Receipt (Kuitansi) Utilities for PonPay
+Satu builder PDF untuk kuitansi transaksi tunggal dan kuitansi gabungan
+"""
+from datetime import datetime
+from io import BytesIO
+from fpdf import FPDF
+
+
+def format_rupiah(value):
+    return f"Rp {int(value):,.0f}".replace(',', '.')
+
+
+def build_receipt_pdf(pondok_name, receiver, numbers, date, student, lines):
+    """Kuitansi PDF sebagai BytesIO.
+
+    numbers: daftar id transaksi; student: dict name/nisn/kelas atau None;
+    lines: [(keterangan, jumlah)]. Satu baris dicetak sebagai rincian tunggal,
+    lebih dari satu baris sebagai tabel per tagihan dengan baris TOTAL.
+    """
+    pdf = FPDF()
+    pdf.add_page()
+
+    # Header
+    pdf.set_font("Helvetica", "B", 16)
+    pdf.cell(0, 10, pondok_name.upper(), 0, 1, "C")
+    pdf.set_font("Helvetica", "", 10)
+    pdf.cell(0, 5, "Sistem Pembayaran Terpadu (PonPay)", 0, 1, "C")
+    pdf.ln(5)
+    pdf.line(10, pdf.get_y(), 200, pdf.get_y())
+    pdf.ln(10)
+
+    # Title
+    pdf.set_font("Helvetica", "B", 14)
+    pdf.cell(0, 10, "BUKTI PEMBAYARAN", 0, 1, "C")
+    pdf.ln(5)
+
+    col_width = 45
+
+    def add_row(label, value):
+        pdf.set_font("Helvetica", "B", 11)
+        pdf.cell(col_width, 8, label, 0, 0)
+        pdf.set_font("Helvetica", "", 11)
+        pdf.cell(0, 8, f": {value}", 0, 1)
+
+    # Info Transaksi
+    add_row("No. Transaksi", ', '.join(f"TRX-{n}" for n in numbers))
+    add_row("Tanggal", date)
+    add_row("Penerima", receiver)
+    pdf.ln(5)
+
+    # Info Santri
+    if student and student.get('name'):
+        pdf.set_font("Helvetica", "B", 11)
+        pdf.cell(0, 8, "Data Santri:", 0, 1)
+        add_row("Nama", student['name'])
+        add_row("NISN", student.get('nisn') or "-")
+        add_row("Kelas", student.get('kelas') or "-")
+        pdf.ln(5)
+
+    # Rincian
+    single = len(lines) == 1
+    pdf.set_font("Helvetica", "B", 11)
+    pdf.cell(0, 8, "Rincian Pembayaran:", 0, 1)
+    pdf.set_fill_color(240, 240, 240)
+    pdf.cell(130, 10, "Keterangan / Kategori" if single else "Tagihan", 1, 0, "C", True)
+    pdf.cell(60, 10, "Jumlah", 1, 1, "C", True)
+    if single:
+        label, amount = lines[0]
+        pdf.set_font("Helvetica", "", 11)
+        pdf.cell(130, 20, label, 1, 0, "L")
+        pdf.set_font("Helvetica", "B", 12)
+        pdf.cell(60, 20, format_rupiah(amount), 1, 1, "R")
+    else:
+        pdf.set_font("Helvetica", "", 11)
+        for label, amount in lines:
+            pdf.cell(130, 10, label, 1, 0, "L")
+            pdf.cell(60, 10, format_rupiah(amount), 1, 1, "R")
+        pdf.set_font("Helvetica", "B", 12)
+        pdf.cell(130, 10, "TOTAL", 1, 0, "R")
+        pdf.cell(60, 10, format_rupiah(sum(amount for _, amount in lines)), 1, 1, "R")
+
+    pdf.ln(20)
+
+    # Tanda Tangan
+    current_date = datetime.now().strftime("%d %m %Y")
+    pdf.set_font("Helvetica", "", 11)
+    pdf.cell(120, 8, "", 0, 0)
+    pdf.cell(0, 8, f"Dicetak pada: {current_date}", 0, 1, "C")
+    pdf.ln(20)
+    pdf.cell(120, 8, "", 0, 0)
+    pdf.cell(0, 8, "( ____________________ )", 0, 1, "C")
+    pdf.cell(120, 8, "", 0, 0)
+    pdf.cell(0, 8, "Bendahara Pondok", 0, 1, "C")
+
+    output = BytesIO()
+    output.write(pdf.output(dest='S'))
+    output.seek(0)
+    return output
@@ -0,0 +1,157 @@
+"""
+Bank Statement Utilities for PonPay
+Parser CSV mutasi rekening/e-wallet dan ekstraksi referensi (NISN / virtual account)
+"""
+import csv
+import hashlib
+import io
+import re
+from datetime import datetime
+
+# Nama kolom yang dikenali (huruf kecil, tanpa spasi di tepi)
+DATE_COLUMNS = ('tanggal', 'tgl', 'date', 'tanggal transaksi', 'transaction date')
+DESCRIPTION_COLUMNS = ('keterangan', 'deskripsi', 'description', 'remark', 'berita', 'catatan')
+CREDIT_COLUMNS = ('kredit', 'credit', 'cr')
+DEBIT_COLUMNS = ('debet', 'debit', 'db')
+# Kolom nominal tanpa arah: arah diambil dari kolom tipe atau penanda DB/CR pada nilainya
+AMOUNT_COLUMNS = ('jumlah', 'amount', 'nominal', 'mutasi')
+DIRECTION_COLUMNS = ('tipe', 'type', 'jenis', 'd/k', 'db/cr', 'cr/db', 'dk', 'arah')
+REFERENCE_COLUMNS = ('referensi', 'reference', 'ref', 'no. referensi', 'virtual account', 'va', 'nisn')
+
+CREDIT_MARKERS = {'cr', 'k', 'kr', 'kredit', 'credit', 'masuk', 'in'}
+DEBIT_MARKERS = {'db', 'd', 'dr', 'debet', 'debit', 'keluar', 'out'}
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d/%m/%y', '%d.%m.%Y', '%Y/%m/%d')
+
+
+class StatementError(Exception):
+    """Format file mutasi tidak dikenali"""
+    pass
+
+
+def parse_amount(value):
+    """'Rp 1.500.000,00', '1,500,000.00' dan '1500000' -> 1500000 (rupiah bulat)"""
+    text = re.sub(r'[^0-9,.\-]', '', str(value or ''))
+    if not text or text == '-':
+        return 0
+    # Dua digit terakhir setelah pemisah terakhir dianggap sen
+    match = re.match(r'^(.*?)[,.](\d{1,2})$', text)
+    if match:
+        text = match.group(1)
+    digits = re.sub(r'[^0-9\-]', '', text)
+    return int(digits) if digits not in ('', '-') else 0
+
+
+def parse_direction(value):
+    """'credit' / 'debit' dari penanda seperti '250,000.00 DB', 'CR', 'Kredit'; None bila tidak ada"""
+    words = {w.lower() for w in re.findall(r'[A-Za-z]+', str(value or ''))}
+    if words & CREDIT_MARKERS:
+        return 'credit'
+    if words & DEBIT_MARKERS:
+        return 'debit'
+    if re.match(r'^\s*-\s*\d', str(value or '')):
+        return 'debit'
+    return None
+
+
+def parse_date(value):
+    value = str(value or '').strip()[:10]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def digit_runs(*texts, min_length=4):
+    """Semua deretan angka (kandidat NISN / nomor VA) dalam teks"""
+    runs = []
+    for text in texts:
+        runs.extend(re.findall(rf'\d{{{min_length},}}', str(text or '')))
+    return runs
+
+
+def _find_column(fieldnames, candidates):
+    normalized = {name.strip().lower(): name for name in fieldnames if name}
+    for candidate in candidates:
+        if candidate in normalized:
+            return normalized[candidate]
+    return None
+
+
+def iter_statement_rows(stream, encoding='utf-8-sig'):
+    """Baca CSV mutasi baris demi baris dari file upload.
+
+    Menghasilkan dict {line_no, date, description, amount, reference,
+    line_hash}. Hanya baris kredit (uang masuk) yang dihasilkan; baris
+    debit/nol dilewati. Arah diambil dari kolom Kredit/Debet terpisah, atau
+    dari kolom tipe / penanda DB/CR pada kolom nominal umum (jumlah, mutasi).
+    Baris tanpa arah yang jelas membuat seluruh file ditolak (StatementError).
+    line_hash stabil untuk baris yang sama sehingga file yang diunggah dua
+    kali tidak dicatat ulang.
+    """
+    text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+    sample = text.readline()
+    if not sample:
+        raise StatementError('File kosong')
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(_chain_first(sample, text), dialect=dialect)
+
+    fields = reader.fieldnames or []
+    date_col = _find_column(fields, DATE_COLUMNS)
+    credit_col = _find_column(fields, CREDIT_COLUMNS)
+    amount_col = credit_col or _find_column(fields, AMOUNT_COLUMNS)
+    direction_col = None if credit_col else _find_column(fields, DIRECTION_COLUMNS)
+    desc_col = _find_column(fields, DESCRIPTION_COLUMNS)
+    ref_col = _find_column(fields, REFERENCE_COLUMNS)
+    if not date_col or not amount_col:
+        raise StatementError('Kolom tanggal dan kredit/jumlah tidak ditemukan di header CSV')
+    # Header diperiksa saat fungsi dipanggil; baris data dibaca bertahap oleh generator
+    return _iter_rows(reader, date_col, amount_col, bool(credit_col), direction_col, desc_col, ref_col)
+
+
+def _row_direction(row, amount_col, is_credit_col, direction_col):
+    """Arah satu baris: kolom Kredit selalu uang masuk kecuali nilainya bertanda DB"""
+    marker = parse_direction(row.get(amount_col))
+    if is_credit_col:
+        return marker or 'credit'
+    if direction_col:
+        return parse_direction(row.get(direction_col)) or marker
+    return marker
+
+
+def _iter_rows(reader, date_col, amount_col, is_credit_col, direction_col, desc_col, ref_col):
+    seen = {}
+    for line_no, row in enumerate(reader, 2):
+        amount = parse_amount(row.get(amount_col))
+        trx_date = parse_date(row.get(date_col))
+        if amount == 0 or not trx_date:
+            continue
+        direction = _row_direction(row, amount_col, is_credit_col, direction_col)
+        if direction is None:
+            raise StatementError(f'Baris {line_no}: arah mutasi (DB/CR) tidak diketahui untuk nominal '
+                                 f'"{row.get(amount_col)}"; gunakan kolom Kredit/Debet atau kolom tipe')
+        if direction == 'debit' or amount < 0:
+            continue
+        description = (row.get(desc_col) or '').strip() if desc_col else ''
+        reference = (row.get(ref_col) or '').strip() if ref_col else ''
+        base = f'{trx_date}|{amount}|{description}|{reference}'
+        # Baris identik dalam satu file dibedakan dengan urutan kemunculannya
+        seen[base] = seen.get(base, 0) + 1
+        yield {
+            'line_no': line_no,
+            'date': trx_date,
+            'description': description,
+            'amount': amount,
+            'reference': reference,
+            'line_hash': hashlib.sha1(f'{base}|{seen[base]}'.encode('utf-8')).hexdigest(),
+        }
+
+
+def _chain_first(first, rest):
+    yield first
+    yield from rest